@@ -1,12 +1,22 @@
 
 import os
 from git_index_helper import *
-from git_object_helper import object_hash
+from git_object_helper import object_hash, object_batch_begin, object_batch_end
+from git_pack_helper import pack_bulk_begin, pack_bulk_end
+from git_trace_helper import trace_function
 
+# When adding at least this many files, their blobs are streamed into
+# a single new pack instead of one loose object (and inode) each.
+ADD_BULK_CHECKIN_THRESHOLD = 256
+
+@trace_function("rm")
 def rm(repo, paths, delete=True, skip_missing=False):
-    # Find and read the index
-    index = index_read(repo)
+    with index_locked(repo):
+        index = index_read(repo)
+        index_rm(repo, index, paths, delete, skip_missing)
+        index_write(repo, index)
 
+def index_rm(repo, index, paths, delete=True, skip_missing=False):
     worktree = repo.worktree + os.sep
 
     # Make paths absolute
@@ -33,6 +43,8 @@ def rm(repo, paths, delete=True, skip_missing=False):
         if full_path in abspaths:
             remove.append(full_path)
             abspaths.remove(full_path)
+            index_cache_tree_invalidate(index, e.name)
+            index_fsmonitor_invalidate(index, e.name)
         else:
             kept_entries.append(e) # Preserve entry
 
@@ -45,14 +57,27 @@ def rm(repo, paths, delete=True, skip_missing=False):
         for path in remove:
             os.unlink(path)
 
-    # Update the list of entries in the index, and write it back.
+    # Update the list of entries in the index.
     index.entries = kept_entries
-    index_write(repo, index)
 
-def add(repo, paths, delete=True, skip_missing=False):
+@trace_function("add")
+def add(repo, paths):
+    with index_locked(repo):
+        index = index_read(repo)
+        index_add(repo, index, paths)
+        index_write(repo, index)
+
+def index_add(repo, index, paths):
+    # Like git, refuse paths inside sparse directories: the index
+    # doesn't know their files.
+    sparse = [ e.name for e in index.entries if e.mode_type == 0b0100 ]
+    for path in paths:
+        relpath = os.path.relpath(os.path.abspath(path), repo.worktree)
+        if any(relpath.startswith(d) for d in sparse):
+            raise Exception(f"Outside of the sparse checkout: {path}")
 
     # First remove all paths from the index, if they exist.
-    rm (repo, paths, delete=False, skip_missing=True)
+    index_rm(repo, index, paths, delete=False, skip_missing=True)
 
     worktree = repo.worktree + os.sep
 
@@ -66,30 +91,34 @@ def add(repo, paths, delete=True, skip_missing=False):
         relpath = os.path.relpath(abspath, repo.worktree)
         clean_paths.add((abspath,  relpath))
 
-    # Find and read the index.  It was modified by rm.  (This isn't
-    # optimal, good enough for wyag!)
-    #
-    # @FIXME, though: we could just move the index through
-    # commands instead of reading and writing it over again.
-    index = index_read(repo)
-
-    for (abspath, relpath) in clean_paths:
-        with open(abspath, "rb") as fd:
-            sha = object_hash(fd, b"blob", repo)
-
-            stat = os.stat(abspath)
-
-            ctime_s = int(stat.st_ctime)
-            ctime_ns = stat.st_ctime_ns % 10**9
-            mtime_s = int(stat.st_mtime)
-            mtime_ns = stat.st_mtime_ns % 10**9
-
-            entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
-                                  mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                                  fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                                  flag_stage=False, name=relpath)
-            index.entries.append(entry)
-
-    # Write the index back
-    index_write(repo, index)
+    bulk = len(clean_paths) >= ADD_BULK_CHECKIN_THRESHOLD
+    if bulk:
+        pack_bulk_begin(repo)
+    else:
+        object_batch_begin(repo)
+
+    try:
+        for (abspath, relpath) in clean_paths:
+            with open(abspath, "rb") as fd:
+                sha = object_hash(fd, b"blob", repo)
+
+                stat = os.stat(abspath)
+
+                ctime_s = int(stat.st_ctime)
+                ctime_ns = stat.st_ctime_ns % 10**9
+                mtime_s = int(stat.st_mtime)
+                mtime_ns = stat.st_mtime_ns % 10**9
+
+                entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
+                                      mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
+                                      fsize=stat.st_size, sha=sha, flag_assume_valid=False,
+                                      flag_stage=False, name=relpath)
+                index.entries.append(entry)
+                index_cache_tree_invalidate(index, relpath)
+                index_fsmonitor_invalidate(index, relpath)
+    finally:
+        if bulk:
+            pack_bulk_end(repo)
+        else:
+            object_batch_end(repo)
 
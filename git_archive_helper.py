@@ -0,0 +1,98 @@
+import time
+
+from git_object_helper import object_find, object_read, object_read_raw
+
+# Exporting a tree as an archive, straight from the object store: each
+# blob is read, written to the archive and dropped, so memory stays at
+# the size of the largest blob, whatever the size of the tree.  Like
+# git, entries get the modes of the tree (with git's default umask,
+# 002), and the commit's time, or the current time for a bare tree.
+
+def archive(repo, name, out, fmt="tar", prefix=""):
+    """Write tree-ish name to the binary stream out, as an archive in
+format fmt, with paths under prefix."""
+    tree = object_find(repo, name, fmt=b"tree")
+    commit = object_find(repo, name, fmt=b"commit")
+    if commit:
+        # The committer line ends with "<timestamp> <tz>".
+        mtime = int(object_read(repo, commit).kvlm[b'committer'].split()[-2])
+    else:
+        mtime = int(time.time())
+
+    entries = archive_walk(repo, tree, prefix)
+    match fmt:
+        case "tar" | "tar.gz":
+            archive_tar(repo, entries, out, mtime, commit, fmt == "tar.gz")
+        case "zip":
+            archive_zip(repo, entries, out, mtime)
+        case _:
+            raise Exception(f"Unknown archive format {fmt}.")
+
+def archive_walk(repo, tree, prefix):
+    """Yield (path, mode, sha) for everything in tree, directories first,
+then their contents."""
+    for item in object_read(repo, tree).items:
+        path = prefix + item.path
+        yield (path, item.mode, item.sha)
+        if item.mode.startswith(b"04"):
+            yield from archive_walk(repo, item.sha, path + "/")
+
+def archive_perms(mode):
+    """Return the permissions of tree leaf mode mode, as git archive sets
+them."""
+    if mode.startswith(b"04") or mode.startswith(b"16") or mode == b"100755":
+        return 0o775
+    if mode.startswith(b"12"):
+        return 0o777
+    return 0o664
+
+def archive_tar(repo, entries, out, mtime, commit, gzip):
+    import io
+    import tarfile
+
+    # As git does, the commit goes in a global header, for git
+    # get-tar-commit-id.
+    headers = { "comment": commit } if commit else {}
+    with tarfile.open(fileobj=out, mode="w|gz" if gzip else "w|",
+                      format=tarfile.PAX_FORMAT, pax_headers=headers) as tar:
+        for (path, mode, sha) in entries:
+            info = tarfile.TarInfo(path)
+            info.mtime = mtime
+            info.mode = archive_perms(mode)
+            info.uname = info.gname = "root"
+            data = None
+            if mode.startswith(b"04") or mode.startswith(b"16"):
+                info.type = tarfile.DIRTYPE # Submodules are empty directories.
+            else:
+                data = object_read_raw(repo, sha)[1]
+                if mode.startswith(b"12"):
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = data.decode("utf8", "surrogateescape")
+                    data = None
+                else:
+                    info.size = len(data)
+            tar.addfile(info, io.BytesIO(data) if data is not None else None)
+
+def archive_zip(repo, entries, out, mtime):
+    import zipfile
+
+    # Zip has no time zones: local time, as git writes it.
+    date_time = time.localtime(max(mtime, 315532800))[:6] # Not before 1980.
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as z:
+        for (path, mode, sha) in entries:
+            directory = mode.startswith(b"04") or mode.startswith(b"16")
+            info = zipfile.ZipInfo(path + "/" if directory else path, date_time)
+            info.create_system = 3 # Unix, for the modes below.
+            if directory:
+                info.external_attr = ((0o040000 | archive_perms(mode)) << 16) | 0x10 # MS-DOS directory flag.
+                z.writestr(info, b"")
+                continue
+
+            data = object_read_raw(repo, sha)[1]
+            if mode.startswith(b"12"):
+                info.external_attr = (0o120000 | archive_perms(mode)) << 16
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.external_attr = (0o100000 | archive_perms(mode)) << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+            z.writestr(info, data)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Benchmarks for my_git.
+
+Generates synthetic repositories of a few shapes and sizes with
+my_git's own add and commit, times the main commands on each, and
+compares the results with a stored baseline:
+
+    ./git_bench.py                      # run, compare with bench_baseline.json
+    ./git_bench.py --scale small        # only one scale
+    ./git_bench.py --save               # record the results as the new baseline
+
+Every operation runs in a fresh Python process, so its peak RSS can be
+measured on its own.  Timings exclude interpreter startup: they're the
+median of several in-process runs.  Except for "startup", which times
+a whole my_git rev-parse HEAD process, cold, as scripts run it."""
+
+import os
+import io
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+import subprocess
+import contextlib
+from time import perf_counter
+from datetime import datetime
+from argparse import Namespace
+
+# Repository shapes: number of files, directory depth and fan-out,
+# file size in lines, commits, and one merge every merge_every commits
+# (0 for none).
+BENCH_SCALES = {
+    "small"  : dict(files=200,   depth=2, fanout=4,  lines=40, commits=20,  merge_every=5),
+    "medium" : dict(files=2000,  depth=3, fanout=6,  lines=40, commits=50,  merge_every=10),
+    "large"  : dict(files=20000, depth=4, fanout=8,  lines=40, commits=100, merge_every=10),
+}
+
+# Operations, in the order they run.  The last ones modify the
+# repository, so they must come after those that expect it unchanged.
+BENCH_OPS = [ "startup", "index-read", "index-write", "rev-parse", "ls-tree", "log",
+              "status-clean", "checkout", "status-dirty", "add", "commit" ]
+
+# How much slower (or bigger) than the baseline counts as a regression.
+# Differences under a couple of milliseconds are just noise.
+BENCH_TOLERANCE = 0.25
+BENCH_MIN_DELTA = 0.002
+
+BENCH_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+BENCH_MY_GIT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "my_git")
+
+def bench_generate(path, files, depth, fanout, lines, commits, merge_every, seed=0):
+    """Create a repository at path, with the given shape.  The first
+commit adds every file, each later one modifies a few of them."""
+    from git_utilities import repo_create
+    from git_add_rm import add
+    from git_main import cmd_commit
+    from git_commit_helper import commit_create
+    from git_commit_helper import tree_from_index
+    from git_index_helper import index_read
+    from git_ref_helper import ref_resolve, ref_write
+
+    rnd = random.Random(seed)
+    repo = repo_create(path)
+    os.chdir(path)
+
+    # Spread the files over a tree of directories.
+    paths = list()
+    for i in range(0, files):
+        parts = [ f"d{rnd.randrange(fanout)}" for _ in range(rnd.randint(0, depth)) ]
+        paths.append(os.path.join(*parts, f"file{i}.txt"))
+
+    for p in paths:
+        bench_write_file(rnd, p, lines)
+
+    add(repo, paths)
+    bench_silent(cmd_commit, Namespace(message="Initial commit"))
+
+    side = None
+    for c in range(1, commits):
+        changed = rnd.sample(paths, min(5, len(paths)))
+        for p in changed:
+            bench_write_file(rnd, p, lines)
+        add(repo, changed)
+
+        if merge_every and c % merge_every == 0 and side:
+            # A merge of a side branch we forked earlier.  There's no
+            # merge command to do it, so we write the commit ourselves.
+            head = ref_resolve(repo, "HEAD")
+            tree = tree_from_index(repo, index_read(repo))
+            merge = commit_create(repo, tree, [ head, side ], "Bench <bench@example.com>",
+                                  datetime.now(), f"Merge {c}")
+            ref_write(repo, "refs/heads/main", merge)
+            side = None
+        else:
+            bench_silent(cmd_commit, Namespace(message=f"Commit {c}"))
+            if merge_every and side is None:
+                # Fork a side branch from here, with one commit on it.
+                head = ref_resolve(repo, "HEAD")
+                tree = tree_from_index(repo, index_read(repo))
+                side = commit_create(repo, tree, head, "Bench <bench@example.com>",
+                                     datetime.now(), f"Side {c}")
+    return repo
+
+def bench_write_file(rnd, path, lines):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        for _ in range(0, lines):
+            f.write(f"{rnd.random()} {rnd.random()}\n")
+
+def bench_silent(fn, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args)
+
+def bench_op(op, path, repeat):
+    """Run op on the repository at path repeat times, in this process,
+and return the list of durations.  Setup isn't timed."""
+    import git_main
+    from git_utilities import repo_find
+    from git_index_helper import index_read, index_write
+    from git_add_rm import add
+
+    os.chdir(path)
+    repo = repo_find()
+    rnd = random.Random(1)
+    index = index_read(repo)
+    names = [ e.name for e in index.entries ]
+
+    if op == "status-dirty":
+        # Modify one file in a hundred.
+        for name in rnd.sample(names, max(1, len(names) // 100)):
+            with open(name, "a") as f:
+                f.write("dirty\n")
+
+    times = list()
+    for i in range(0, repeat):
+        if op in ("add", "commit"):
+            # Stage a few changes to work on.
+            changed = rnd.sample(names, min(10, len(names)))
+            for name in changed:
+                with open(name, "a") as f:
+                    f.write(f"change {i}\n")
+            if op == "commit":
+                add(repo, changed)
+        if op == "checkout":
+            target = tempfile.mkdtemp(prefix="bench_checkout_")
+            os.rmdir(target)
+
+        start = perf_counter()
+        match op:
+            case "startup"      : subprocess.run([ sys.executable, BENCH_MY_GIT, "rev-parse", "HEAD" ],
+                                                 check=True, stdout=subprocess.DEVNULL)
+            case "index-read"   : index_read(repo)
+            case "index-write"  : index_write(repo, index)
+            case "rev-parse"    : bench_silent(git_main.cmd_rev_parse, Namespace(type=None, name="HEAD"))
+            case "ls-tree"      : bench_silent(git_main.cmd_ls_tree, Namespace(tree="HEAD", recursive=True))
+            case "log"          : bench_silent(git_main.cmd_log, Namespace(commit="HEAD"))
+            case "status-clean" : bench_silent(git_main.cmd_status, None)
+            case "status-dirty" : bench_silent(git_main.cmd_status, None)
+            case "checkout"     : git_main.cmd_checkout(Namespace(commit="HEAD", path=target))
+            case "add"          : add(repo, changed)
+            case "commit"       : bench_silent(git_main.cmd_commit, Namespace(message=f"Bench {i}"))
+        times.append(perf_counter() - start)
+
+        if op == "checkout":
+            shutil.rmtree(target)
+
+    return times
+
+def bench_run(scale, repeat, workdir):
+    """Generate a repository for scale, and benchmark every operation
+on it.  Return {op: {"time": seconds, "rss_kb": peak RSS}}."""
+    path = os.path.join(workdir, scale)
+
+    # Commits need an identity: give the children one of their own,
+    # rather than depending on the user's configuration.
+    env = dict(os.environ)
+    env["XDG_CONFIG_HOME"] = os.path.join(workdir, "config")
+    os.makedirs(os.path.join(env["XDG_CONFIG_HOME"], "git"), exist_ok=True)
+    with open(os.path.join(env["XDG_CONFIG_HOME"], "git", "config"), "w") as f:
+        f.write("[user]\nname = Bench\nemail = bench@example.com\n")
+
+    start = perf_counter()
+    # Generating takes a while, and grows this process: do it in a
+    # child too.
+    subprocess.run([ sys.executable, __file__, "--generate", scale, path ], check=True, env=env)
+    print(f"{scale}: generated in {perf_counter() - start:.1f}s", file=sys.stderr)
+
+    ret = dict()
+    for op in BENCH_OPS:
+        out = subprocess.run([ sys.executable, __file__, "--child", op, path, str(repeat) ],
+                             check=True, capture_output=True, text=True, env=env).stdout
+        times, rss = json.loads(out)
+        times.sort()
+        ret[op] = { "time": times[len(times) // 2], "rss_kb": rss }
+    return ret
+
+def bench_compare(results, baseline, tolerance):
+    """Print results next to baseline, and return the list of
+regressions."""
+    regressions = list()
+    print(f"{'scale':8} {'operation':14} {'time (ms)':>10} {'baseline':>10} {'peak RSS (MB)':>14} {'baseline':>10}")
+    for scale, ops in results.items():
+        for op, r in ops.items():
+            base = baseline.get(scale, {}).get(op)
+            flag = ""
+            if base:
+                if r["time"] > base["time"] * (1 + tolerance) and r["time"] - base["time"] > BENCH_MIN_DELTA:
+                    flag += " SLOWER"
+                if r["rss_kb"] > base["rss_kb"] * (1 + tolerance):
+                    flag += " BIGGER"
+                if flag:
+                    regressions.append((scale, op))
+                base_time = f"{base['time'] * 1000:.1f}"
+                base_rss = f"{base['rss_kb'] / 1024:.1f}"
+            else:
+                base_time = base_rss = "-"
+            print(f"{scale:8} {op:14} {r['time'] * 1000:10.1f} {base_time:>10} {r['rss_kb'] / 1024:14.1f} {base_rss:>10}{flag}")
+    return regressions
+
+def main(argv=sys.argv[1:]):
+    argparser = argparse.ArgumentParser(description="Benchmark my_git.")
+    argparser.add_argument("--scale", action="append", choices=list(BENCH_SCALES.keys()),
+                           help="Scale to run, can be repeated.  Default: small and medium.")
+    argparser.add_argument("--repeat", type=int, default=5, help="Runs per operation.")
+    argparser.add_argument("--baseline", default=BENCH_BASELINE, help="Baseline file.")
+    argparser.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE,
+                           help="Allowed slowdown before flagging a regression, eg 0.25 for 25%%.")
+    argparser.add_argument("--save", action="store_true", help="Save the results as the baseline.")
+    argparser.add_argument("--keep", metavar="directory", help="Generate repositories there, and keep them.")
+    # Internal: what child processes run.
+    argparser.add_argument("--generate", nargs=2, help=argparse.SUPPRESS)
+    argparser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = argparser.parse_args(argv)
+
+    if args.generate:
+        scale, path = args.generate
+        bench_generate(path, **BENCH_SCALES[scale])
+        return 0
+
+    if args.child:
+        op, path, repeat = args.child
+        times = bench_op(op, path, int(repeat))
+        # ru_maxrss is in kilobytes on Linux.
+        who = resource.RUSAGE_CHILDREN if op == "startup" else resource.RUSAGE_SELF
+        print(json.dumps([ times, resource.getrusage(who).ru_maxrss ]))
+        return 0
+
+    scales = args.scale or [ "small", "medium" ]
+    workdir = args.keep or tempfile.mkdtemp(prefix="my_git_bench_")
+    try:
+        results = { scale: bench_run(scale, args.repeat, workdir) for scale in scales }
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = bench_compare(results, baseline, args.tolerance)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s): " + ", ".join(f"{s}/{o}" for (s, o) in regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import heapq
+
+from git_object_helper import object_read
+from git_diff_helper import diff_split_lines, diff_blocks, diff_renames
+from git_tree_helper import tree_diff
+from git_trace_helper import trace_region, trace_counters
+
+# Attributing each line of a file to the commit that last changed it.
+# We go back through history, newest commit first, carrying the lines
+# not yet attributed: a commit whose parent has the same blob at the
+# path hands them all to that parent, without reading anything;
+# otherwise the two versions are diffed, the lines they have in common
+# go on to the parent, and the others are that commit's.  We stop when
+# no line is left.
+#
+# Finding the blob of a commit goes down the path one tree at a time,
+# and stops as soon as a tree is the one the child has there: most
+# commits touch none of the directories above the file, and cost one
+# commit and one tree read.  Blobs are only read and split into lines
+# for the commits that changed them, once each, so the diffs, which
+# are where the time goes, are as many as the commits that changed the
+# file.
+
+def blame(repo, path, commit):
+    """Blame path as of commit.  Return (lines, commits): lines is a list
+of (commit, path, line number, line) for each line of the file, the
+commit that brought it and the path and number (from 1) it had there;
+commits a dict SHA -> GitCommit of these commits."""
+    commits = dict()  # SHA -> GitCommit
+    trees = dict()    # Tree SHA -> its entries, as a dict name -> SHA
+    blobs = dict()    # Blob SHA -> its lines
+
+    def commit_read(sha):
+        if sha not in commits:
+            commits[sha] = object_read(repo, sha)
+            if trace_counters is not None:
+                trace_counters["blame_commits"] += 1
+        return commits[sha]
+
+    def lines_read(sha):
+        if sha not in blobs:
+            blobs[sha] = diff_split_lines(object_read(repo, sha).blobdata)
+        return blobs[sha]
+
+    chain = blame_chain(repo, trees, commit_read(commit), path.split("/"))
+    if chain is None:
+        raise Exception(f"No such path {path} in {commit}")
+    lines = lines_read(chain[-1])
+    result = [ None ] * len(lines)
+
+    # What's left to attribute: (commit, path) -> (chain, entries), an
+    # entry (final line, line there, count) being a run of lines.
+    pending = { (commit, path): (chain, [ (0, 0, len(lines)) ]) }
+    queue = [ (-blame_time(commit_read(commit)), commit, path) ]
+    with trace_region("blame/walk"):
+        while queue:
+            (_, sha, spath) = heapq.heappop(queue)
+            (chain, entries) = pending.pop((sha, spath))
+            entries = blame_merge(entries)
+            c = commit_read(sha)
+
+            # The parents that have the file, and where.
+            parents = list() # (parent, path, chain)
+            for parent in blame_parents(c):
+                p = commit_read(parent)
+                pchain = blame_chain(repo, trees, p, spath.split("/"), chain)
+                if pchain is not None:
+                    parents.append((parent, spath, pchain))
+                    continue
+                ppath = blame_rename(repo, p, c, spath)
+                if ppath is not None:
+                    parents.append((parent, ppath, blame_chain(repo, trees, p, ppath.split("/"))))
+
+            passed = list() # (parent, path, chain, entries)
+            same = [ x for x in parents if x[2][-1] == chain[-1] ]
+            if same:
+                # Same blob: everything goes to that parent.
+                passed.append(same[0] + (entries,))
+                entries = []
+            for (parent, ppath, pchain) in parents:
+                if not entries:
+                    break
+                if trace_counters is not None:
+                    trace_counters["blame_diffs"] += 1
+                (moved, entries) = blame_pass(entries, lines_read(pchain[-1]), lines_read(chain[-1]))
+                if moved:
+                    passed.append((parent, ppath, pchain, moved))
+
+            # What no parent had is this commit's.
+            for (final, orig, count) in entries:
+                for k in range(count):
+                    result[final + k] = (sha, spath, orig + k + 1)
+
+            for (parent, ppath, pchain, moved) in passed:
+                key = (parent, ppath)
+                if key in pending:
+                    pending[key][1].extend(moved)
+                else:
+                    pending[key] = (pchain, moved)
+                    heapq.heappush(queue, (-blame_time(commits[parent]), parent, ppath))
+
+    return ([ r + (line,) for (r, line) in zip(result, lines) ],
+            { sha: commits[sha] for (sha, _, _) in result })
+
+def blame_parents(commit):
+    parents = commit.kvlm.get(b'parent', [])
+    if type(parents) != list:
+        parents = [ parents ]
+    return [ p.decode("ascii") for p in parents ]
+
+def blame_time(commit):
+    # The committer line ends with "<timestamp> <tz>".
+    return int(commit.kvlm[b'committer'].split()[-2])
+
+def blame_chain(repo, trees, commit, parts, child=None):
+    """Return the SHAs of the trees down path parts in commit, then of
+the blob at the end, or None if there's no blob there.  When one of
+these is the one child, the chain of a child commit, has at the same
+place, what's below is too: the rest of child is used as is."""
+    sha = commit.kvlm[b'tree'].decode("ascii")
+    chain = [ sha ]
+    for (i, part) in enumerate(parts):
+        if child is not None and child[i] == sha:
+            return chain + child[i+1:]
+        if sha not in trees:
+            obj = object_read(repo, sha)
+            if obj.fmt != b'tree':
+                return None
+            trees[sha] = { leaf.path: (leaf.mode, leaf.sha) for leaf in obj.items }
+            if trace_counters is not None:
+                trace_counters["blame_trees"] += 1
+        (mode, sha) = trees[sha].get(part, (None, None))
+        if sha is None:
+            return None
+        chain.append(sha)
+    if not (mode.startswith(b"10") or mode.startswith(b"12")):
+        return None # A directory, or a submodule.
+    return chain
+
+def blame_rename(repo, parent, commit, path):
+    """Return the path parent had path at, if commit renamed it, else
+None."""
+    changes = tree_diff(repo, parent.kvlm[b'tree'].decode("ascii"), commit.kvlm[b'tree'].decode("ascii"))
+    for change in diff_renames(repo, changes):
+        if change[0] == "R" and change[1] == path:
+            return change[6]
+    return None
+
+def blame_merge(entries):
+    """Sort entries, and join those that follow each other on both
+sides."""
+    entries.sort(key=lambda e: e[1])
+    ret = list()
+    for e in entries:
+        if ret and ret[-1][1] + ret[-1][2] == e[1] and ret[-1][0] + ret[-1][2] == e[0]:
+            ret[-1] = (ret[-1][0], ret[-1][1], ret[-1][2] + e[2])
+        else:
+            ret.append(e)
+    return ret
+
+def blame_pass(entries, old, new):
+    """Split entries, runs of lines of new, into those old has too,
+moved to their line numbers in old, and the others.  Return (moved,
+kept)."""
+    # The runs of lines common to both, as (start in new, end in new,
+    # start in old).
+    same = list()
+    (a_pos, b_pos) = (0, 0)
+    for (a_lo, a_hi, b_lo, b_hi) in diff_blocks(old, new, "myers"):
+        if b_lo > b_pos:
+            same.append((b_pos, b_lo, a_pos))
+        (a_pos, b_pos) = (a_hi, b_hi)
+    if len(new) > b_pos:
+        same.append((b_pos, len(new), a_pos))
+
+    # Both are in order: walk them side by side.
+    moved = list()
+    kept = list()
+    i = 0
+    for (final, lo, count) in entries:
+        hi = lo + count
+        while i < len(same) and same[i][1] <= lo:
+            i += 1
+        j = i
+        while lo < hi:
+            if j == len(same) or same[j][0] >= hi:
+                kept.append((final, lo, hi - lo))
+                break
+            (s_lo, s_hi, a_lo) = same[j]
+            if s_lo > lo:
+                kept.append((final, lo, s_lo - lo))
+                (final, lo) = (final + s_lo - lo, s_lo)
+            end = min(hi, s_hi)
+            moved.append((final, a_lo + lo - s_lo, end - lo))
+            (final, lo) = (final + end - lo, end)
+            j += 1
+    return (moved, kept)
@@ -0,0 +1,359 @@
+import zlib
+
+from git_object_helper import object_read, object_read_raw, object_exists
+from git_pack_helper import (PACK_TYPES, PACK_TYPE_IDS, PACK_OFS_DELTA, PACK_REF_DELTA,
+                             pack_entry_header, pack_entry_header_encode, pack_inflate_end, pack_delta_apply,
+                             pack_compression_level, pack_bulk_begin, pack_bulk_write,
+                             pack_bulk_end, pack_bulk_abort)
+from git_trace_helper import trace_region, trace_counters
+
+# Bundles: history in a single file, for moving it where there's no
+# other way.  The format is git's: a header listing the prerequisites
+# (commits the receiving side must have, with everything below them)
+# and the refs, then a pack of the objects reachable from the refs and
+# not from the prerequisites.  A bundle is read and written front to
+# back, and only the objects it adds cross over.
+#
+# Blobs are stored as deltas against the version at the same path in
+# the next newer commit, computed from their lines with our line diff:
+# histories mostly change a few lines at a time, so a bundle weighs
+# little more than the changes it carries.
+
+BUNDLE_SIGNATURE = b"# v2 git bundle\n"
+
+# How long delta chains get.  Each step costs reading the object, so,
+# as in git, they're kept short enough.
+BUNDLE_DELTA_DEPTH = 50
+
+def bundle_create(repo, path, include, exclude):
+    """Write a bundle of the commits reachable from include and not
+from exclude, to file path.  include is a list of (name, commit), and
+names that are refs go in the header.  Return (refs, prerequisites,
+number of objects)."""
+    from git_revlist_helper import rev_list, commit_info
+
+    refs = bundle_refs(repo, include)
+    if not refs:
+        raise Exception("Refusing to create a bundle without refs.")
+    commits = rev_list(repo, [ sha for (_, sha) in include ], exclude)
+    if not commits:
+        raise Exception("Refusing to create an empty bundle.")
+
+    # The prerequisites: the commits just below those we send.
+    listed = set(commits)
+    prerequisites = list(dict.fromkeys(parent for sha in commits
+                                       for parent in commit_info(repo, sha)[2] if parent not in listed))
+
+    with trace_region("bundle/objects"):
+        objects = bundle_objects(repo, commits, prerequisites, [ sha for (_, sha) in refs ])
+
+    with open(path, "wb") as f:
+        f.write(BUNDLE_SIGNATURE)
+        for sha in prerequisites:
+            message = object_read(repo, sha).kvlm[None]
+            f.write(b"-" + sha.encode("ascii") + b" " + message.split(b"\n", 1)[0] + b"\n")
+        for (ref, sha) in refs:
+            f.write(sha.encode("ascii") + b" " + ref.encode("utf8") + b"\n")
+        f.write(b"\n")
+        with trace_region("bundle/pack"):
+            bundle_pack_write(repo, f, objects)
+    return (refs, prerequisites, len(objects))
+
+def bundle_refs(repo, include):
+    """Return the refs include names, as (full name, SHA), a tag's SHA
+being that of the tag object."""
+    from git_ref_helper import ref_resolve
+    ret = dict()
+    for (name, _) in include:
+        if name == "HEAD":
+            candidates = [ "HEAD" ]
+        else:
+            candidates = [ name ] if name.startswith("refs/") else []
+            candidates += [ f"refs/{kind}/{name}" for kind in ("heads", "tags", "remotes") ]
+        for ref in candidates:
+            sha = ref_resolve(repo, ref)
+            if sha:
+                ret[ref] = sha
+                break
+    return list(ret.items())
+
+def bundle_objects(repo, commits, prerequisites, tips):
+    """Return the objects to bundle, in the order to write them, as
+(sha, path): path is where a blob is, for delta bases, else None."""
+    # What the other side has: the trees of the prerequisites, and what
+    # they hold.  Only trees are read: blob SHAs are in them.
+    have = set()
+    for sha in prerequisites:
+        bundle_tree_walk(repo, object_read(repo, sha).kvlm[b'tree'].decode("ascii"), "", have, None)
+
+    ret = list()
+    # Annotated tags of the refs, down to their commits.
+    for sha in tips:
+        while sha not in have:
+            obj = object_read(repo, sha)
+            if obj.fmt != b'tag':
+                break
+            have.add(sha)
+            ret.append((sha, None))
+            sha = obj.kvlm[b'object'].decode("ascii")
+
+    # Newest first, each commit then the trees and blobs it brings: a
+    # blob's next newer version at the same path is written before it,
+    # and is its delta base.
+    for sha in commits:
+        have.add(sha)
+        ret.append((sha, None))
+        tree = object_read(repo, sha).kvlm[b'tree'].decode("ascii")
+        bundle_tree_walk(repo, tree, "", have, ret)
+    if trace_counters is not None:
+        trace_counters["bundle_objects"] += len(ret)
+    return ret
+
+def bundle_tree_walk(repo, tree, prefix, have, ret):
+    """Add tree and everything below it that's not in have to have, and
+to ret if not None.  Subtrees in have are skipped whole."""
+    if tree in have:
+        return
+    have.add(tree)
+    if ret is not None:
+        ret.append((tree, None))
+    for leaf in object_read(repo, tree).items:
+        if leaf.mode.startswith(b"04"):
+            bundle_tree_walk(repo, leaf.sha, prefix + leaf.path + "/", have, ret)
+        elif leaf.mode.startswith(b"16"):
+            continue # Submodules are in another repository.
+        elif leaf.sha not in have:
+            have.add(leaf.sha)
+            if ret is not None:
+                ret.append((leaf.sha, prefix + leaf.path))
+
+def bundle_pack_write(repo, f, objects):
+    """Write a pack of objects to the binary stream f."""
+    import hashlib
+    checksum = hashlib.sha1()
+    def write(data):
+        checksum.update(data)
+        f.write(data)
+
+    level = pack_compression_level(repo)
+    write(b"PACK" + (2).to_bytes(4, "big") + len(objects).to_bytes(4, "big"))
+    # The last blob written at each path, and the length of the delta
+    # chain of each blob: sha -> depth.
+    last = dict()
+    depths = dict()
+    for (sha, path) in objects:
+        (fmt, data) = object_read_raw(repo, sha)
+        entry = None
+        base = last.get(path) if path is not None else None
+        if base is not None and depths[base] < BUNDLE_DELTA_DEPTH:
+            delta = bundle_delta(object_read_raw(repo, base)[1], data)
+            if delta is not None and len(delta) < len(data) // 2:
+                entry = (pack_entry_header_encode(PACK_REF_DELTA, len(delta)) + bytes.fromhex(base)
+                         + zlib.compress(delta, level))
+                depths[sha] = depths[base] + 1
+        if entry is None:
+            entry = pack_entry_header_encode(PACK_TYPE_IDS[fmt], len(data)) + zlib.compress(data, level)
+            depths[sha] = 0
+        if path is not None:
+            last[path] = sha
+        write(entry)
+        if trace_counters is not None:
+            trace_counters["bytes_deflated"] += len(entry)
+    f.write(checksum.digest())
+
+def bundle_delta(base, data):
+    """Return a pack delta that turns base into data, from the lines
+they share, or None if they share none."""
+    from git_diff_helper import diff_split_lines, diff_blocks
+    a = diff_split_lines(base)
+    b = diff_split_lines(data)
+    # Where each line of base starts.
+    starts = [ 0 ]
+    for line in a:
+        starts.append(starts[-1] + len(line))
+
+    ret = bytearray(bundle_varint(len(base)) + bundle_varint(len(data)))
+    copied = False
+    (a_pos, pos) = (0, 0)
+    for (a_lo, a_hi, b_lo, b_hi) in list(diff_blocks(a, b)) + [ (len(a), len(a), len(b), len(b)) ]:
+        # Lines up to the change are the same on both sides: copied.
+        if a_lo > a_pos:
+            bundle_delta_copy(ret, starts[a_pos], starts[a_lo] - starts[a_pos])
+            pos += starts[a_lo] - starts[a_pos]
+            copied = True
+        # The new lines are inserted, at most 127 bytes at a time.
+        end = pos + sum(len(line) for line in b[b_lo:b_hi])
+        while pos < end:
+            n = min(end - pos, 0x7f)
+            ret.append(n)
+            ret += data[pos:pos+n]
+            pos += n
+        a_pos = a_hi
+    return bytes(ret) if copied else None
+
+def bundle_delta_copy(ret, offset, size):
+    # A copy has the offset and size bytes that aren't zero, flagged in
+    # its opcode; the size is at most 0x10000, written as 0.
+    while size:
+        n = min(size, 0x10000)
+        op = 0x80
+        args = bytearray()
+        for i in range(4):
+            byte = (offset >> (8 * i)) & 0xff
+            if byte:
+                op |= 1 << i
+                args.append(byte)
+        for i in range(2 if n == 0x10000 else 3):
+            byte = (n >> (8 * i)) & 0xff
+            if byte:
+                op |= 0x10 << i
+                args.append(byte)
+        ret.append(op)
+        ret += args
+        (offset, size) = (offset + n, size - n)
+
+def bundle_varint(n):
+    ret = bytearray()
+    while n >= 0x80:
+        ret.append(0x80 | (n & 0x7f))
+        n >>= 7
+    ret.append(n)
+    return bytes(ret)
+
+def bundle_is(path):
+    """Whether path is a bundle file."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(BUNDLE_SIGNATURE)) == BUNDLE_SIGNATURE
+    except OSError:
+        return False
+
+def bundle_header_read(path):
+    """Read the header of bundle path.  Return (prerequisites, refs,
+offset): prerequisites a list of commit SHAs, refs of (ref, sha), and
+offset where the pack starts."""
+    prerequisites = list()
+    refs = list()
+    with open(path, "rb") as f:
+        if f.readline() != BUNDLE_SIGNATURE:
+            raise Exception(f"{path} is not a bundle (or not a version 2 one).")
+        while True:
+            line = f.readline()
+            if not line:
+                raise Exception(f"Malformed bundle {path}: truncated header")
+            line = line.rstrip(b"\n")
+            if not line:
+                break
+            if line.startswith(b"-"):
+                prerequisites.append(line[1:41].decode("ascii"))
+            else:
+                (sha, ref) = line.split(b" ", 1)
+                refs.append((ref.decode("utf8"), sha.decode("ascii")))
+        return (prerequisites, refs, f.tell())
+
+def bundle_verify(repo, prerequisites):
+    """Fail unless repo has all the prerequisites."""
+    missing = [ sha for sha in prerequisites if not object_exists(repo, sha) ]
+    if missing:
+        raise Exception("The repository lacks these prerequisite commits:\n"
+                        + "".join(f" - {sha}\n" for sha in missing))
+
+def bundle_unbundle(repo, path):
+    """Add the objects of bundle path to repo, as a new pack, once its
+prerequisites are checked.  Return (refs, count): the refs of the
+bundle, as (ref, sha), and the number of objects added."""
+    import mmap
+    (prerequisites, refs, offset) = bundle_header_read(path)
+    bundle_verify(repo, prerequisites)
+
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        with trace_region("bundle/unbundle"):
+            count = bundle_pack_read(repo, data, offset)
+    finally:
+        data.close()
+
+    # Like fetch, never leave refs to objects we don't have.
+    missing = [ ref for (ref, sha) in refs if not object_exists(repo, sha) ]
+    if missing:
+        raise Exception(f"Malformed bundle {path}: no objects for {', '.join(missing)}")
+    return (refs, count)
+
+def bundle_pack_read(repo, data, start):
+    """Copy the objects of the pack at start in data into a new pack of
+repo, but those it has already.  Return how many were copied."""
+    import hashlib
+    if data[start:start+4] != b"PACK" or int.from_bytes(data[start+4:start+8], "big") not in (2, 3):
+        raise Exception("Malformed bundle: no pack")
+    checksum = hashlib.sha1()
+    for pos in range(start, len(data) - 20, 1 << 20):
+        checksum.update(data[pos:min(pos + (1 << 20), len(data) - 20)])
+    if checksum.digest() != data[len(data)-20:]:
+        raise Exception("Malformed bundle: bad pack checksum")
+    total = int.from_bytes(data[start+8:start+12], "big")
+
+    # As git's index-pack: full objects first, then the deltas based
+    # on each, once its base is known, down their chains.  Deltas are
+    # found by base, offset for some, SHA for others.
+    by_offset = dict() # base offset -> [ (offset, data position, size) ]
+    by_sha = dict()    # base sha -> [ (offset, data position, size) ]
+    full = list()      # (fmt, data position, size)
+    pos = start + 12
+    for _ in range(total):
+        (t, size, p) = pack_entry_header(data, pos)
+        if t == PACK_OFS_DELTA:
+            c = data[p]
+            p += 1
+            distance = c & 0x7f
+            while c & 0x80:
+                c = data[p]
+                p += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+            by_offset.setdefault(pos - distance, []).append((pos, p, size))
+        elif t == PACK_REF_DELTA:
+            by_sha.setdefault(data[p:p+20].hex(), []).append((pos, p + 20, size))
+            p += 20
+        elif t in PACK_TYPES:
+            full.append((pos, PACK_TYPES[t], p, size))
+        else:
+            raise Exception(f"Malformed bundle: unknown pack entry type {t}")
+        pos = pack_inflate_end(data, p, size)[1]
+
+    count = 0
+    done = 0
+    pack_bulk_begin(repo)
+    try:
+        def add(fmt, obj):
+            nonlocal count, done
+            sha = hashlib.sha1(fmt + b" " + str(len(obj)).encode() + b"\x00" + obj).hexdigest()
+            done += 1
+            if not object_exists(repo, sha):
+                pack_bulk_write(repo, fmt, obj, sha)
+                count += 1
+            return sha
+
+        def resolve(offset, sha, fmt, obj):
+            # Apply the deltas based on this object, then theirs.
+            stack = [ (offset, sha, fmt, obj) ]
+            while stack:
+                (offset, sha, fmt, base) = stack.pop()
+                for (o, p, size) in by_offset.pop(offset, []) + by_sha.pop(sha, []):
+                    obj = pack_delta_apply(base, pack_inflate_end(data, p, size)[0])
+                    stack.append((o, add(fmt, obj), fmt, obj))
+
+        for (offset, fmt, p, size) in full:
+            obj = pack_inflate_end(data, p, size)[0]
+            resolve(offset, add(fmt, obj), fmt, obj)
+        # A thin pack's deltas can be based on objects we already have.
+        for sha in list(by_sha):
+            raw = object_read_raw(repo, sha)
+            if raw is not None:
+                resolve(None, sha, raw[0], raw[1])
+        if done != total:
+            raise Exception(f"Malformed bundle: {total - done} deltas without a base")
+    except BaseException:
+        pack_bulk_abort(repo)
+        raise
+    pack_bulk_end(repo)
+    return count
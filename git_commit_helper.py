@@ -4,6 +4,7 @@ import configparser
 
 from git_object_helper import object_write
 from git_objects import GitCommit, GitTree, GitTreeLeaf, GitIndexEntry
+from git_trace_helper import trace_function
 
 def gitconfig_read():
     xdg_config_home = os.environ["XDG_CONFIG_HOME"] if "XDG_CONFIG_HOME" in os.environ else "~/.config"
@@ -22,6 +23,7 @@ def gitconfig_user_get(config):
             return f"{config['user']['name']} <{config['user']['email']}>"
     return None
 
+@trace_function("tree/from-index")
 def tree_from_index(repo, index):
     contents = dict()
     contents[""] = list()
@@ -29,7 +31,13 @@ def tree_from_index(repo, index):
     # Enumerate entries, and turn them into a dictionary where keys
     # are directories, and values are lists of directory contents.
     for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
+        # A sparse directory (its name ends with a slash) stands for a
+        # whole tree, which goes in its parent like those we write.
+        sparse = entry.mode_type == 0b0100
+        if sparse:
+            dirname = os.path.dirname(entry.name[:-1])
+        else:
+            dirname = os.path.dirname(entry.name)
 
         # We create all dictonary entries up to root ("").  We need
         # them *all*, because even if a directory holds no files it
@@ -41,7 +49,10 @@ def tree_from_index(repo, index):
             key = os.path.dirname(key)
 
         # For now, simply store the entry in the list.
-        contents[dirname].append(entry)
+        if sparse:
+            contents[dirname].append((os.path.basename(entry.name[:-1]), entry.sha))
+        else:
+            contents[dirname].append(entry)
 
     # Get keys (= directories) and sort them by length, descending.
     # This means that we'll always encounter a given path before its
@@ -56,6 +67,14 @@ def tree_from_index(repo, index):
 
     # We ge through the sorted list of paths (dict keys)
     for path in sorted_paths:
+        # If the cache-tree still knows this directory's tree, nothing
+        # below it changed since it was written: reuse it.
+        if path in index.cache_tree:
+            sha = index.cache_tree[path]
+            if path != "":
+                contents[os.path.dirname(path)].append((os.path.basename(path), sha))
+            continue
+
         # Prepare a new, empty tree object
         tree = GitTree()
 
@@ -74,8 +93,10 @@ def tree_from_index(repo, index):
 
             tree.items.append(leaf)
 
-        # Write the new tree object to the store.
+        # Write the new tree object to the store, and remember it in
+        # the cache-tree for the next commit.
         sha = object_write(tree, repo)
+        index.cache_tree[path] = sha
 
         # Add the new tree hash to the current dictionary's parent, as
         # a pair (basename, SHA)
@@ -88,7 +109,9 @@ def tree_from_index(repo, index):
 def commit_create(repo, tree, parent, author, timestamp, message):
     commit = GitCommit() # Create the new commit object.
     commit.kvlm[b"tree"] = tree.encode("ascii")
-    if parent:
+    if type(parent) == list: # A merge: several parents.
+        commit.kvlm[b"parent"] = [ p.encode("ascii") for p in parent ]
+    elif parent:
         commit.kvlm[b"parent"] = parent.encode("ascii")
 
     # Trim message and add a trailing \n
@@ -0,0 +1,237 @@
+import os
+import sys
+
+# The daemon keeps a repository loaded, with its parsed index, ignore
+# rules, pack indexes and delta base cache, and runs read-only commands
+# for other my_git processes: they connect to .git/my_git-daemon.sock,
+# send their arguments, and print what they get back.  Everything it
+# keeps is checked against the stat data of the files it came from
+# before it's used (see repo_cached), so answers are always current.
+#
+# Requests are one JSON line:  {"argv": [...], "cwd": ..., "env": {...}}
+# Answers are one JSON line:   {"status": 0, "stdout": 123, "stderr": 0}
+# followed by that many bytes of output, then of errors.
+#
+# The daemon also runs the filesystem monitor (see git_fsmonitor.py),
+# which status queries with {"fsmonitor": token}, when it runs on its
+# own; the answer header then has "token" and "paths".
+
+DAEMON_SOCKET = "my_git-daemon.sock"
+
+# Commands the daemon runs.  They only read the repository, so the
+# daemon can run them in any order, one at a time.
+DAEMON_COMMANDS = [ "cat-file", "check-ignore", "ls-files", "merge-base", "rev-list", "rev-parse", "status" ]
+
+# Environment variables passed from the client, since commands depend on
+# them (eg XDG_CONFIG_HOME for the global ignore file).
+DAEMON_ENV = [ "HOME", "XDG_CONFIG_HOME" ]
+
+def daemon_socket_find(path="."):
+    """Return the path of the daemon socket of the repository containing
+path, or None if there's no daemon, or no repository."""
+    path = os.path.realpath(path)
+    while True:
+        gitdir = os.path.join(path, ".git")
+        if os.path.isdir(gitdir):
+            sock = os.path.join(gitdir, DAEMON_SOCKET)
+            return sock if os.path.exists(sock) else None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def daemon_forward(argv, command):
+    """If a daemon serves the current repository, have it run the command
+in argv, print its output, and return its exit status.  Otherwise, or
+if the command can't go through the daemon, return None."""
+    if command not in DAEMON_COMMANDS or os.environ.get("MY_GIT_NO_DAEMON"):
+        return None
+    # Profiles and traces are about this process: don't hand over.
+    if os.environ.get("MY_GIT_TRACE_PERF") or any(a.startswith("--profile") for a in argv):
+        return None
+    # Batch cat-file is long-running already, and reads stdin.
+    if command == "cat-file" and any(a.startswith("--batch") for a in argv):
+        return None
+
+    sock = daemon_socket_find()
+    if sock is None:
+        return None
+    return daemon_request(sock, { "argv": argv,
+                                  "cwd": os.getcwd(),
+                                  "env": { k: os.environ.get(k) for k in DAEMON_ENV } })
+
+def daemon_request(sock, request):
+    """Send request to the daemon listening on sock, print the output it
+sends back, and return the exit status; or None if the daemon can't be
+reached, eg because it died and left its socket behind."""
+    answer = daemon_call(sock, request)
+    if answer is None:
+        return None
+    (header, out, err) = answer
+
+    sys.stdout.buffer.write(out)
+    sys.stdout.buffer.flush()
+    sys.stderr.buffer.write(err)
+    sys.stderr.buffer.flush()
+    return header.get("status", 0)
+
+def daemon_call(sock, request):
+    """Send request to the daemon listening on sock.  Return the answer
+as (header, output, errors), or None if the daemon can't be reached."""
+    import json
+    import socket
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(sock)
+        conn.sendall(json.dumps(request).encode("utf8") + b"\n")
+        f = conn.makefile("rb")
+        header = f.readline()
+        if not header:
+            return None
+        header = json.loads(header)
+        out = f.read(header.get("stdout", 0))
+        err = f.read(header.get("stderr", 0))
+    except (ConnectionError, FileNotFoundError):
+        return None
+    finally:
+        conn.close()
+    return (header, out, err)
+
+def daemon_run(detach=False):
+    """Serve the repository of the current directory until stopped."""
+    import socket
+    import git_utilities
+
+    repo = git_utilities.repo_find()
+    path = os.path.join(repo.gitdir, DAEMON_SOCKET)
+
+    if os.path.exists(path):
+        if daemon_request(path, { "ping": True }) is not None:
+            raise Exception(f"A daemon is already running on {path}.")
+        os.unlink(path) # Left by a daemon that died.
+
+    # From now on, repo_find keeps repositories and their caches.
+    git_utilities.repo_keep = dict()
+
+    # Watch the worktree, so status knows where to look.
+    import git_fsmonitor
+    mon = git_fsmonitor.fsmonitor_start(repo.worktree)
+    git_fsmonitor.fsmonitor_local = { repo.worktree: mon } if mon else dict()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+
+    # The socket is ready before we detach, so clients can use it as soon
+    # as the command returns.
+    if detach:
+        if os.fork():
+            return
+        os.setsid()
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+
+    import select
+    try:
+        while True:
+            # Read the monitor's events as they come, or the kernel
+            # queue may overflow while we wait for clients.
+            if mon:
+                ready, _, _ = select.select([ server, mon.fd ], [], [])
+                git_fsmonitor.fsmonitor_process(mon)
+                if server not in ready:
+                    continue
+            conn, _ = server.accept()
+            with conn:
+                if not daemon_serve(conn):
+                    break
+    finally:
+        server.close()
+        os.unlink(path)
+        if mon:
+            os.close(mon.fd)
+
+def daemon_stop():
+    sock = daemon_socket_find()
+    if sock is None or daemon_request(sock, { "stop": True }) is None:
+        raise Exception("No daemon is running for this repository.")
+
+def daemon_serve(conn):
+    """Answer the request on connection conn.  Return False if it asks
+the daemon to stop."""
+    import io
+    import json
+
+    request = json.loads(conn.makefile("rb").readline())
+    out = io.BytesIO()
+    err = io.BytesIO()
+    header = { "status": 0 }
+
+    if request.get("stop"):
+        ret = False
+    elif request.get("ping"):
+        ret = True
+    elif "fsmonitor" in request:
+        header.update(daemon_fsmonitor(request["fsmonitor"]))
+        ret = True
+    else:
+        header["status"] = daemon_execute(request, out, err)
+        ret = True
+
+    header["stdout"] = len(out.getvalue())
+    header["stderr"] = len(err.getvalue())
+    try:
+        conn.sendall(json.dumps(header).encode("utf8") + b"\n" + out.getvalue() + err.getvalue())
+    except ConnectionError:
+        pass # The client went away: nothing to do.
+    return ret
+
+def daemon_fsmonitor(token):
+    """Answer a filesystem monitor query, from a status that didn't go
+through the daemon."""
+    import git_fsmonitor
+    for mon in git_fsmonitor.fsmonitor_local.values():
+        answer = git_fsmonitor.fsmonitor_changes(mon, token)
+        if answer is not None:
+            return { "token": answer[0], "paths": answer[1] }
+    return { "token": None }
+
+def daemon_execute(request, out, err):
+    """Run the command of request as my_git would, writing its output to
+out and its errors to err, two binary files.  Return its exit status."""
+    import io
+    import traceback
+    import git_main
+
+    saved = sys.stdout, sys.stderr
+    sys.stdout = io.TextIOWrapper(out, encoding="utf8", write_through=True)
+    sys.stderr = io.TextIOWrapper(err, encoding="utf8", write_through=True)
+    try:
+        os.chdir(request["cwd"])
+        for (k, v) in request["env"].items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+        argv = request["argv"]
+        args = git_main.argparser_build(git_main.argv_command(argv)).parse_args(argv)
+        git_main.cmd_run(args)
+        status = 0
+    except SystemExit as e:
+        # From argparse, on errors or --help.
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Detach, or the wrappers would close out and err once collected.
+        sys.stdout.detach()
+        sys.stderr.detach()
+        sys.stdout, sys.stderr = saved
+    return status
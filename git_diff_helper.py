@@ -0,0 +1,752 @@
+import os
+from math import isqrt
+
+from git_object_helper import object_read
+from git_trace_helper import trace_region
+
+# Git considers a file binary if it has a NUL byte in its first 8000
+# bytes.  That's crude, but cheap, and it's what everybody expects.
+DIFF_BINARY_PROBE = 8000
+
+# Like xdiff, histogram diff ignores lines that appear more than this
+# many times when looking for a region to split on...
+DIFF_HISTOGRAM_MAX_CHAIN = 64
+# ...and Myers stops looking for an optimal path after this many
+# steps, or the square root of the input size if that's more.
+DIFF_MYERS_MIN_COST = 256
+# That still costs up to the square of it for each split, which, in
+# Python, is seconds on long inputs with changes everywhere (a few
+# distinct lines in random orders).  So a whole diff also gets this
+# many diagonals to look at, per line of input: once they're used up,
+# splits stop after this many steps instead.
+DIFF_MYERS_WORK_PER_LINE = 16
+DIFF_MYERS_SPENT_COST = 16
+
+def diff_split_lines(data):
+    """Split data (bytes) into lines, keeping their line endings."""
+    lines = data.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop() # The file ends with a newline
+        return [ l + b'\n' for l in lines ]
+    # The last line has no newline: keep it as is.
+    return [ l + b'\n' for l in lines[:-1] ] + [ lines[-1] ]
+
+def diff_is_binary(data):
+    return b'\x00' in data[:DIFF_BINARY_PROBE]
+
+def diff_blocks(a, b, algorithm="histogram"):
+    """Compare the line lists a and b, and yield a tuple (a_lo, a_hi,
+b_lo, b_hi) for each block of differing lines, in order: the lines
+a[a_lo:a_hi] have been replaced by b[b_lo:b_hi]."""
+
+    # Intern lines as small integers: comparing ints is much cheaper
+    # than comparing (possibly long) byte strings, and equal lines get
+    # the same number on both sides.
+    ids = dict()
+    ha = [ ids.setdefault(l, len(ids)) for l in a ]
+    hb = [ ids.setdefault(l, len(ids)) for l in b ]
+
+    # Myers trims the common prefix and suffix (where most of the
+    # lines of most files go) as it goes; histogram, as in xdiff, looks
+    # at all of them, since they can hold its best anchors.
+    match algorithm:
+        case "histogram" : runs = diff_histogram(ha, hb, 0, len(ha), 0, len(hb))
+        case "myers"     : runs = diff_myers_common(ha, hb, 0, len(ha), 0, len(hb))
+        case _: raise Exception(f"Unknown diff algorithm {algorithm}!")
+
+    # Everything between two matched lines is a change.
+    blocks = list()
+    a_pos = 0
+    b_pos = 0
+    for (i, j, length) in runs:
+        if i != a_pos or j != b_pos:
+            blocks.append((a_pos, i, b_pos, j))
+        a_pos = i + length
+        b_pos = j + length
+
+    if a_pos != len(ha) or b_pos != len(hb):
+        blocks.append((a_pos, len(ha), b_pos, len(hb)))
+
+    if not blocks:
+        return
+    yield from diff_compact(ha, hb, blocks)
+
+def diff_compact(ha, hb, blocks):
+    """Slide the changes of blocks where git's xdiff puts them, and
+yield the resulting blocks.  A change whose lines repeat around it (an
+inserted "}" before another "}") can be shown at several places: like
+xdiff, we take the last one, unless one of them lines up with a change
+on the other side.  Diffs, blames and merges then agree with git's."""
+    changed_a = [ False ] * (len(ha) + 1)
+    changed_b = [ False ] * (len(hb) + 1)
+    for (a_lo, a_hi, b_lo, b_hi) in blocks:
+        changed_a[a_lo:a_hi] = [ True ] * (a_hi - a_lo)
+        changed_b[b_lo:b_hi] = [ True ] * (b_hi - b_lo)
+    diff_compact_side(ha, changed_a, changed_b)
+    diff_compact_side(hb, changed_b, changed_a)
+
+    # Unchanged lines pair up in order: what's between is a block.
+    (i, j) = (0, 0)
+    while i < len(ha) or j < len(hb):
+        if not changed_a[i] and not changed_b[j]:
+            (i, j) = (i + 1, j + 1)
+            continue
+        (a_lo, b_lo) = (i, j)
+        while changed_a[i]:
+            i += 1
+        while changed_b[j]:
+            j += 1
+        yield (a_lo, i, b_lo, j)
+
+def diff_compact_side(h, changed, other):
+    """xdiff's xdl_change_compact: move the groups of changed lines of
+one side, h, as far down as they go, or to where they line up with a
+group of the other side.  changed and other have one extra False item,
+which ends the last group."""
+    n = len(h)
+
+    # A group is the changed lines [start, end) before the k-th
+    # unchanged line: the k-th groups of both sides go together, and
+    # o_start, o_end is the one of other.
+    def group_end(changed, start):
+        while changed[start]:
+            start += 1
+        return start
+
+    (start, end) = (0, group_end(changed, 0))
+    (o_start, o_end) = (0, group_end(other, 0))
+    while True:
+        if end != start:
+            while True:
+                size = end - start
+                matching = -1
+                # Up as far as it goes, joining the groups it meets...
+                while start > 0 and h[start-1] == h[end-1]:
+                    start -= 1
+                    end -= 1
+                    changed[start] = True
+                    changed[end] = False
+                    while start > 0 and changed[start-1]:
+                        start -= 1
+                    o_end = o_start - 1
+                    o_start = o_end
+                    while o_start > 0 and other[o_start-1]:
+                        o_start -= 1
+                earliest_end = end
+                if o_end > o_start:
+                    matching = end
+                # ...then down as far as it goes.
+                while end < n and h[start] == h[end]:
+                    changed[start] = False
+                    changed[end] = True
+                    start += 1
+                    end = group_end(changed, end + 1)
+                    o_start = o_end + 1
+                    o_end = group_end(other, o_start)
+                    if o_end > o_start:
+                        matching = end
+                if size == end - start:
+                    break
+
+            # Back up to the place matching a change on the other
+            # side, if there's one.
+            if end != earliest_end and matching != -1:
+                while o_end == o_start:
+                    start -= 1
+                    end -= 1
+                    changed[start] = True
+                    changed[end] = False
+                    while start > 0 and changed[start-1]:
+                        start -= 1
+                    o_end = o_start - 1
+                    o_start = o_end
+                    while o_start > 0 and other[o_start-1]:
+                        o_start -= 1
+
+        if end == n:
+            break
+        start = end + 1
+        end = group_end(changed, start)
+        o_start = o_end + 1
+        o_end = group_end(other, o_start)
+
+def diff_histogram(a, b, a_lo, a_hi, b_lo, b_hi):
+    """Yield the runs of matching lines (a_start, b_start, length)
+between a[a_lo:a_hi] and b[b_lo:b_hi], in order, using git's histogram
+algorithm.
+
+We look for the longest common region built around the lines that are
+the least frequent in a, split on it, and recurse on both sides.  This
+lines up unique lines first, which is both fast and gives readable
+diffs when blocks of code move around.  When every line of a range is
+too common for this to be meaningful, we fall back to Myers."""
+
+    # Same trick as diff_myers: a 4-tuple is a range to diff, a
+    # 3-tuple is a run to yield once everything before it is done.
+    # Unlike Myers, histogram sees every line: dropping those only one
+    # side has would make lines that aren't neighbours look like they
+    # are, and matches would grow across them.
+    stack = [ (a_lo, a_hi, b_lo, b_hi) ]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3:
+            yield item
+            continue
+
+        a_lo, a_hi, b_lo, b_hi = item
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+
+        # The histogram: where each line of a occurs.
+        occurrences = dict()
+        for i in range(a_lo, a_hi):
+            occurrences.setdefault(a[i], []).append(i)
+
+        best = None
+        best_count = DIFF_HISTOGRAM_MAX_CHAIN + 1
+        common = False
+        j = b_lo
+        while j < b_hi:
+            positions = occurrences.get(b[j])
+            if positions is None:
+                j += 1
+                continue
+            common = True
+            if len(positions) > best_count:
+                j += 1
+                continue
+
+            j_next = j + 1
+            skip = a_lo
+            for i in positions:
+                if i < skip:
+                    continue # Inside the last match: it'd be the same.
+                # Extend the match around (i, j) as far as it goes,
+                # keeping track of its rarest line.
+                x0, y0, x1, y1 = i, j, i + 1, j + 1
+                count = len(positions)
+                while x0 > a_lo and y0 > b_lo and a[x0-1] == b[y0-1]:
+                    x0 -= 1
+                    y0 -= 1
+                    count = min(count, len(occurrences[a[x0]]))
+                while x1 < a_hi and y1 < b_hi and a[x1] == b[y1]:
+                    x1 += 1
+                    y1 += 1
+                    count = min(count, len(occurrences[a[x1-1]]))
+                j_next = max(j_next, y1)
+                skip = x1
+
+                if best is None or best[1] - best[0] < x1 - x0 or count < best_count:
+                    best = (x0, x1, y0, y1)
+                    best_count = count
+            j = j_next
+
+        if best:
+            x0, x1, y0, y1 = best
+            stack.append((x1, a_hi, y1, b_hi))
+            stack.append((x0, y0, x1 - x0))
+            stack.append((a_lo, x0, b_lo, y0))
+        elif common:
+            # Every common line is too frequent: histogram would be
+            # quadratic here, Myers is the better tool.
+            yield from diff_myers_common(a, b, a_lo, a_hi, b_lo, b_hi)
+
+def diff_myers_common(a, b, a_lo, a_hi, b_lo, b_hi):
+    """diff_myers, on the lines of each side the other side has too.
+A line that appears nowhere on the other side can't be part of a match,
+so, as xdiff does, we drop those before diffing.  This is what keeps big
+rewrites and files full of unique lines fast."""
+    # Only once the common prefix and suffix are set aside, as in
+    # xdiff: lines there don't count.
+    start = a_lo
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        a_lo += 1
+        b_lo += 1
+    if a_lo != start:
+        yield (start, b_lo - (a_lo - start), a_lo - start)
+    end = a_hi
+    while a_hi > a_lo and b_hi > b_lo and a[a_hi-1] == b[b_hi-1]:
+        a_hi -= 1
+        b_hi -= 1
+
+    in_a = set(a[a_lo:a_hi])
+    in_b = set(b[b_lo:b_hi])
+    keep_a = [ i for i in range(a_lo, a_hi) if a[i] in in_b ]
+    keep_b = [ j for j in range(b_lo, b_hi) if b[j] in in_a ]
+    ra = [ a[i] for i in keep_a ]
+    rb = [ b[j] for j in keep_b ]
+
+    # Map the runs back to the real line numbers: a run of kept lines
+    # may be several runs there.
+    for (x, y, length) in diff_myers(ra, rb, 0, len(ra), 0, len(rb)):
+        start = 0
+        for k in range(1, length + 1):
+            if k == length or keep_a[x+k] != keep_a[x+k-1] + 1 or keep_b[y+k] != keep_b[y+k-1] + 1:
+                yield (keep_a[x+start], keep_b[y+start], k - start)
+                start = k
+    if a_hi != end:
+        yield (a_hi, b_hi, end - a_hi)
+
+def diff_myers(a, b, a_lo, a_hi, b_lo, b_hi):
+    """Yield the runs of matching lines (a_start, b_start, length) of a
+shortest edit script between a[a_lo:a_hi] and b[b_lo:b_hi], in order.
+
+This is the linear space variant of Myers' algorithm: we look for the
+middle snake of the edit path, from both ends at once, and recurse on
+each side of it.  Like xdiff, we give up looking for the optimal path
+after a while and split on the furthest point reached instead, which
+bounds the cost on large, very different inputs."""
+
+    # Furthest reaching points for each diagonal k = x - y, forward
+    # and backward.  Diagonals go from a_lo-b_hi-1 to a_hi-b_lo+1,
+    # hence the offset.
+    size = (a_hi - a_lo) + (b_hi - b_lo) + 3
+    vf = [ 0 ] * size
+    vb = [ 0 ] * size
+    offset = b_hi - a_lo + 1
+    max_cost = max(DIFF_MYERS_MIN_COST, isqrt(size))
+    budget = [ DIFF_MYERS_WORK_PER_LINE * size ]
+
+    # We recurse with an explicit stack, so the runs come out in
+    # order: a range is a 4-tuple, and a run waiting to be yielded
+    # after the range before it is a 3-tuple.
+    stack = [ (a_lo, a_hi, b_lo, b_hi) ]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3:
+            yield item
+            continue
+
+        a_lo, a_hi, b_lo, b_hi = item
+
+        start = a_lo
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        if a_lo != start:
+            yield (start, b_lo - (a_lo - start), a_lo - start)
+
+        end = a_hi
+        while a_hi > a_lo and b_hi > b_lo and a[a_hi-1] == b[b_hi-1]:
+            a_hi -= 1
+            b_hi -= 1
+        if a_hi != end:
+            stack.append((a_hi, b_hi, end - a_hi))
+
+        if a_lo == a_hi or b_lo == b_hi:
+            continue # Only insertions or deletions left.
+
+        x, y = diff_myers_split(a, a_lo, a_hi, b, b_lo, b_hi, vf, vb, offset, max_cost, budget)
+        stack.append((x, a_hi, y, b_hi))
+        stack.append((a_lo, x, b_lo, y))
+
+def diff_myers_split(a, a_lo, a_hi, b, b_lo, b_hi, vf, vb, offset, max_cost, budget):
+    """Find the middle snake of a[a_lo:a_hi] and b[b_lo:b_hi], whose
+first and last lines must differ, and return the point (x, y) where it
+starts.  budget is a list holding the number of diagonals the diff may
+still look at, which this decreases."""
+    d_min = a_lo - b_hi
+    d_max = a_hi - b_lo
+    f_mid = a_lo - b_lo
+    b_mid = a_hi - b_hi
+    # If the two searches start on diagonals of different parity,
+    # they can only meet during a forward pass.
+    odd = (f_mid - b_mid) & 1
+    inf = a_hi + 1
+
+    f_min = f_max = f_mid
+    b_min = b_max = b_mid
+    vf[f_mid + offset] = a_lo
+    vb[b_mid + offset] = a_hi
+
+    cost = 0
+    while True:
+        cost += 1
+
+        # Forward: extend the range of diagonals by one on each side,
+        # unless we've hit a corner.
+        if f_min > d_min:
+            f_min -= 1
+            vf[f_min - 1 + offset] = -1
+        else:
+            f_min += 1
+        if f_max < d_max:
+            f_max += 1
+            vf[f_max + 1 + offset] = -1
+        else:
+            f_max -= 1
+
+        for k in range(f_max, f_min - 1, -2):
+            if vf[k - 1 + offset] >= vf[k + 1 + offset]:
+                x = vf[k - 1 + offset] + 1
+            else:
+                x = vf[k + 1 + offset]
+            y = x - k
+            while x < a_hi and y < b_hi and a[x] == b[y]:
+                x += 1
+                y += 1
+            vf[k + offset] = x
+            if odd and b_min <= k <= b_max and vb[k + offset] <= x:
+                return x, y
+
+        # Backward, same thing.
+        if b_min > d_min:
+            b_min -= 1
+            vb[b_min - 1 + offset] = inf
+        else:
+            b_min += 1
+        if b_max < d_max:
+            b_max += 1
+            vb[b_max + 1 + offset] = inf
+        else:
+            b_max -= 1
+
+        for k in range(b_max, b_min - 1, -2):
+            if vb[k - 1 + offset] < vb[k + 1 + offset]:
+                x = vb[k - 1 + offset]
+            else:
+                x = vb[k + 1 + offset] - 1
+            y = x - k
+            while x > a_lo and y > b_lo and a[x-1] == b[y-1]:
+                x -= 1
+                y -= 1
+            vb[k + offset] = x
+            if not odd and f_min <= k <= f_max and x <= vf[k + offset]:
+                return x, y
+
+        budget[0] -= (f_max - f_min) + (b_max - b_min) + 2
+        if cost < (max_cost if budget[0] > 0 else DIFF_MYERS_SPENT_COST):
+            continue
+
+        # Too expensive: settle for the point that went the furthest,
+        # forward or backward.  The result may not be minimal, but it
+        # is still a correct diff.
+        f_best = -1
+        for k in range(f_max, f_min - 1, -2):
+            x = min(vf[k + offset], a_hi)
+            y = x - k
+            if y > b_hi:
+                x = b_hi + k
+                y = b_hi
+            if x + y > f_best:
+                f_best = x + y
+                f_x = x
+
+        b_best = a_hi + b_hi + 1
+        for k in range(b_max, b_min - 1, -2):
+            x = max(a_lo, vb[k + offset])
+            y = x - k
+            if y < b_lo:
+                x = b_lo + k
+                y = b_lo
+            if x + y < b_best:
+                b_best = x + y
+                b_x = x
+
+        if (a_hi + b_hi) - b_best < f_best - (a_lo + b_lo):
+            return f_x, f_best - f_x
+        return b_x, b_best - b_x
+
+def diff_hunks(blocks, context=3):
+    """Group change blocks whose context lines would overlap, yielding
+one list of blocks per hunk."""
+    hunk = list()
+    for block in blocks:
+        if hunk and block[0] - hunk[-1][1] > 2 * context:
+            yield hunk
+            hunk = list()
+        hunk.append(block)
+    if hunk:
+        yield hunk
+
+def diff_hunk_range(start, count):
+    if count == 1:
+        return f"{start + 1}"
+    if count == 0:
+        return f"{start},0"
+    return f"{start + 1},{count}"
+
+def diff_is_funcname(line):
+    # Git's default: anything starting with a letter, "_" or "$".
+    return line[:1].isalpha() or line[:1] in (b'_', b'$')
+
+def diff_unified(a, b, context=3, algorithm="histogram"):
+    """Yield the hunks of a unified diff between the line lists a and b,
+as bytes, as soon as each one is known."""
+    # Like git, we show the closest line before each hunk that looks
+    # like the start of a function.  We remember how far back we've
+    # looked, so each line is examined at most once.
+    func = b''
+    func_pos = 0
+
+    for hunk in diff_hunks(diff_blocks(a, b, algorithm), context):
+        a_lo = max(0, hunk[0][0] - context)
+        a_hi = min(len(a), hunk[-1][1] + context)
+        # Context lines are the same on both sides.
+        b_lo = hunk[0][2] - (hunk[0][0] - a_lo)
+        b_hi = hunk[-1][3] + (a_hi - hunk[-1][1])
+
+        for i in range(a_lo - 1, func_pos - 1, -1):
+            if diff_is_funcname(a[i]):
+                func = b' ' + a[i][:80].rstrip()
+                break
+        func_pos = a_lo
+
+        ret = [ f"@@ -{diff_hunk_range(a_lo, a_hi - a_lo)} +{diff_hunk_range(b_lo, b_hi - b_lo)} @@".encode("ascii") + func + b'\n' ]
+        pos = a_lo
+        for (a_start, a_end, b_start, b_end) in hunk:
+            ret.extend(b' ' + l for l in a[pos:a_start])
+            ret.extend(b'-' + l for l in a[a_start:a_end])
+            ret.extend(b'+' + l for l in b[b_start:b_end])
+            pos = a_end
+        ret.extend(b' ' + l for l in a[pos:a_hi])
+
+        for line in ret:
+            yield line
+            if not line.endswith(b'\n'):
+                yield b"\n\\ No newline at end of file\n"
+
+def diff_patch(repo, change, worktree=False, context=3, algorithm="histogram"):
+    """Yield the git-style patch for change, a tuple as produced by
+tree_diff, as bytes.  If worktree is True, the new side of the change
+is read from the worktree instead of the object store."""
+    (status, path, old_mode, old_sha, new_mode, new_sha) = change[:6]
+    # Renames and copies have the old path too.
+    old_path = change[6] if status in ("R", "C") else path
+
+    header = [ f"diff --git a/{old_path} b/{path}" ]
+    if status == "A":
+        header.append(f"new file mode {new_mode.decode('ascii')}")
+    elif status == "D":
+        header.append(f"deleted file mode {old_mode.decode('ascii')}")
+    elif old_mode != new_mode:
+        header.append(f"old mode {old_mode.decode('ascii')}")
+        header.append(f"new mode {new_mode.decode('ascii')}")
+    if status in ("R", "C"):
+        verb = "rename" if status == "R" else "copy"
+        header.append(f"similarity index {change[7]}%")
+        header.append(f"{verb} from {old_path}")
+        header.append(f"{verb} to {path}")
+
+    if old_sha != new_sha or status not in ("R", "C"):
+        index_line = f"index {(old_sha or '0' * 40)[0:7]}..{(new_sha or '0' * 40)[0:7]}"
+        if status in ("M", "R", "C") and old_mode == new_mode:
+            index_line += f" {old_mode.decode('ascii')}"
+        header.append(index_line)
+    yield ("\n".join(header) + "\n").encode("utf8")
+
+    if old_sha == new_sha:
+        return # Mode change, or pure rename, only.
+
+    old_data = object_read(repo, old_sha).blobdata if old_sha else b''
+    if not new_sha:
+        new_data = b''
+    elif worktree:
+        with open(os.path.join(repo.worktree, path), "rb") as f:
+            new_data = f.read()
+    else:
+        new_data = object_read(repo, new_sha).blobdata
+
+    old_name = f"a/{old_path}" if old_sha else "/dev/null"
+    new_name = f"b/{path}" if new_sha else "/dev/null"
+
+    if diff_is_binary(old_data) or diff_is_binary(new_data):
+        yield f"Binary files {old_name} and {new_name} differ\n".encode("utf8")
+        return
+
+    yield f"--- {old_name}\n+++ {new_name}\n".encode("utf8")
+    yield from diff_unified(diff_split_lines(old_data), diff_split_lines(new_data), context, algorithm)
+
+# Rename and copy detection.  Changes come in as additions and
+# deletions; we pair them when the contents are similar enough.  Exact
+# renames are found first by joining on the blob SHA, which is linear
+# and reads nothing: moving a whole directory costs that much.  For the
+# rest, like git, each blob is cut into chunks (lines, at most 64
+# bytes), and the similarity of two blobs is the share of bytes in
+# chunks they have in common.  Rather than comparing every deleted
+# file with every added one, we index the sources by chunk, skipping
+# chunks common to many of them (blank lines, closing braces): the
+# sources sharing rare chunks with an added file are its candidates,
+# and only the best few are scored in full.
+
+# Sources scored in full for each added file.
+DIFF_RENAME_CANDIDATES = 10
+# Chunks found in more sources than this are ignored when looking for
+# candidates.
+DIFF_RENAME_MAX_CHAIN = 64
+# Like git's diff.renameLimit, but per added file: the most sources it
+# is compared with.  0 is no limit.
+DIFF_RENAME_LIMIT = 1000
+
+# The empty blob: empty files aren't paired, that would be arbitrary.
+DIFF_EMPTY_BLOB = "e69de29bb2d1d6434b8b29ae775a52c2afe3b7e4"
+
+def diff_renames_enabled(repo, section="diff"):
+    """Whether rename detection is on for section (diff or status) of
+repo's configuration: it is by default, as in git."""
+    for s in (section, "diff"):
+        if repo.conf.has_option(s, "renames"):
+            return repo.conf.get(s, "renames").lower() not in ("false", "no", "off", "0")
+    return True
+
+def diff_threshold(value):
+    """Parse a similarity threshold into a percentage.  As git does, a
+number without % is a fraction: 60%, 60, 6 and 0.6 are all 60%."""
+    percent = value.endswith("%")
+    value = value.removesuffix("%")
+    if not value.replace(".", "", 1).isdigit():
+        raise Exception(f"Bad similarity threshold: {value}")
+    if percent:
+        return min(int(float(value)), 100)
+    if "." in value:
+        return min(int(float(value) * 100), 100)
+    return int(value) * 100 // 10 ** len(value)
+
+def diff_renames(repo, changes, threshold=50, copies=False, limit=None):
+    """Return changes (tuples as produced by tree_diff) with additions
+paired to similar deletions as renames, and with copies, to similar
+modified files as copies.  Renames and copies are tuples (status, path,
+old_mode, old_sha, new_mode, new_sha, old_path, score), status being
+"R" or "C", path the new path and score the similarity, in percent.
+They take the place of the additions, and the order of changes is kept."""
+    changes = list(changes)
+    if limit is None:
+        limit = repo.conf.getint("diff", "renamelimit", fallback=DIFF_RENAME_LIMIT)
+
+    added = [ c for c in changes if c[0] == "A" and diff_rename_kind(c[4]) and c[5] != DIFF_EMPTY_BLOB ]
+    sources = [ c for c in changes if (c[0] == "D" or (copies and c[0] == "M"))
+                and diff_rename_kind(c[2]) and c[3] != DIFF_EMPTY_BLOB ]
+    if not added or not sources:
+        return changes
+
+    pairs = dict() # Added path -> (status, source change, score)
+    used = set()   # Paths of the sources renamed
+
+    # Exact renames: same blob.  When several deleted files have it,
+    # prefer the one with the same name.
+    by_sha = dict()
+    for s in sources:
+        by_sha.setdefault((s[3], s[2][:2]), list()).append(s)
+    for a in added:
+        candidates = by_sha.get((a[5], a[4][:2]))
+        if not candidates:
+            continue
+        if len(candidates) > 1:
+            name = os.path.basename(a[1])
+            candidates = sorted(candidates, key=lambda s: os.path.basename(s[1]) != name)
+        diff_rename_pair(pairs, used, a, [ (s, 100) for s in candidates ], copies)
+
+    # Inexact ones, for what's left.
+    added = [ a for a in added if a[1] not in pairs ]
+    if not copies:
+        sources = [ s for s in sources if s[1] not in used ]
+    if added and sources:
+        with trace_region("diff/renames"):
+            diff_renames_inexact(repo, added, sources, threshold, copies, pairs, used, limit)
+
+    ret = list()
+    for c in changes:
+        if c[0] == "A" and c[1] in pairs:
+            (status, s, score) = pairs[c[1]]
+            ret.append((status, c[1], s[2], s[3], c[4], c[5], s[1], score))
+        elif c[0] == "D" and c[1] in used:
+            continue # Renamed.
+        else:
+            ret.append(c)
+
+    # A deleted file paired several times (copies) is renamed to the
+    # last of its new paths and copied to the others, as git reports it.
+    renamed = set()
+    for (i, c) in reversed(list(enumerate(ret))):
+        if c[0] in ("R", "C") and c[6] in used:
+            ret[i] = ("C" if c[6] in renamed else "R",) + c[1:]
+            renamed.add(c[6])
+    return ret
+
+def diff_rename_kind(mode):
+    """Files are only paired with files, and symlinks with symlinks."""
+    if mode is None:
+        return None
+    if mode.startswith(b"10"):
+        return "file"
+    if mode.startswith(b"12"):
+        return "symlink"
+    return None
+
+def diff_rename_pair(pairs, used, added, candidates, copies):
+    """Pair added with the first of candidates, (source, score) pairs,
+that can be: a deletion not yet renamed, or with copies, anything."""
+    for (s, score) in candidates:
+        if s[0] == "D" and s[1] not in used:
+            pairs[added[1]] = ("R", s, score)
+            used.add(s[1])
+            return True
+        if copies:
+            pairs[added[1]] = ("C", s, score)
+            return True
+    return False
+
+def diff_renames_inexact(repo, added, sources, threshold, copies, pairs, used, limit):
+    blobs = dict() # SHA -> (size, fingerprints)
+    def fingerprints(sha):
+        if sha not in blobs:
+            data = object_read(repo, sha).blobdata
+            blobs[sha] = (len(data), diff_fingerprints(data))
+        return blobs[sha]
+
+    # Sources by chunk, for the chunks that are rare enough.
+    index = dict()
+    for (i, s) in enumerate(sources):
+        for h in fingerprints(s[3])[1]:
+            index.setdefault(h, list()).append(i)
+    index = { h: l for (h, l) in index.items() if len(l) <= DIFF_RENAME_MAX_CHAIN }
+
+    scored = list()
+    for a in added:
+        (a_size, a_prints) = fingerprints(a[5])
+        kind = diff_rename_kind(a[4])
+
+        # Candidates: the sources with the most rare chunks in common,
+        # among the first limit found.
+        shared = dict()
+        for h in a_prints:
+            for i in index.get(h, ()):
+                if i in shared:
+                    shared[i] += a_prints[h]
+                elif not limit or len(shared) < limit:
+                    shared[i] = a_prints[h]
+        best = sorted(shared, key=lambda i: -shared[i])[:DIFF_RENAME_CANDIDATES]
+
+        for i in best:
+            s = sources[i]
+            if diff_rename_kind(s[2]) != kind:
+                continue
+            (s_size, s_prints) = fingerprints(s[3])
+            # Too different in size to reach the threshold anyway.
+            if min(a_size, s_size) * 100 < max(a_size, s_size) * threshold:
+                continue
+            common = sum(min(n, a_prints.get(h, 0)) for (h, n) in s_prints.items())
+            score = common * 100 // max(a_size, s_size)
+            if score >= threshold:
+                same_name = os.path.basename(s[1]) == os.path.basename(a[1])
+                scored.append((score, same_name, a, s))
+
+    # Best pairs first, as git does.
+    scored.sort(key=lambda p: (-p[0], not p[1], p[2][1], p[3][1]))
+    for (score, _, a, s) in scored:
+        if a[1] not in pairs:
+            diff_rename_pair(pairs, used, a, [ (s, score) ], copies)
+
+def diff_fingerprints(data):
+    """Return the chunks of data (lines, cut at 64 bytes) as a dict:
+chunk hash -> number of bytes in such chunks."""
+    counts = dict()
+    pos = 0
+    size = len(data)
+    while pos < size:
+        end = data.find(b'\n', pos, pos + 64)
+        end = min(pos + 64, size) if end == -1 else end + 1
+        h = hash(data[pos:end])
+        counts[h] = counts.get(h, 0) + end - pos
+        pos = end
+    return counts
@@ -0,0 +1,162 @@
+import os
+
+from git_objects import GitRepository
+from git_utilities import repo_create, repo_find, repo_file, repo_config_set
+from git_object_helper import object_read_raw, object_exists
+from git_pack_helper import pack_bulk_begin, pack_bulk_write, pack_bulk_end, pack_bulk_abort
+from git_ref_helper import ref_list, ref_flatten, ref_resolve, ref_symbolic, ref_write
+from git_fsck_helper import fsck_links
+from git_trace_helper import trace_region, trace_counters
+
+# Fetching from another repository on the same machine.  There's no
+# protocol: we read the other repository directly.  Negotiation is
+# then just asking our own object store: the walk from the refs we want
+# stops at every object we already have.  Objects only get here with
+# everything they point to (commits and trees are written after their
+# contents, packs are moved in place whole), so whatever is below one
+# we have, we have too, and an incremental fetch costs as much as the
+# new history.
+#
+# The missing objects are copied into a single new pack, which appears
+# at once when its index is moved in place: an interrupted fetch leaves
+# nothing half done behind.
+
+def remote_find(repo, name):
+    """Return (remote name, path) for name, a configured remote or the
+path of a repository.  A path no remote points to is named after its
+last component."""
+    section = f'remote "{name}"'
+    if repo.conf.has_section(section):
+        return (name, repo.conf.get(section, "url"))
+
+    path = os.path.realpath(name)
+    for section in repo.conf.sections():
+        if section.startswith('remote "') and repo.conf.has_option(section, "url"):
+            if os.path.realpath(repo.conf.get(section, "url")) == path:
+                return (section[8:-1], path)
+    return (os.path.basename(path).removesuffix(".git").removesuffix(".bundle"), path)
+
+def fetch(repo, remote, path):
+    """Fetch the branches and tags of the repository, or the bundle, at
+path into repo: branches as refs/remotes/<remote>/<branch>, tags as
+themselves unless repo has them already.  Return (updates, count):
+updates is a list of (source ref, our ref, old sha, new sha) for refs
+that changed, count the number of objects copied."""
+    from git_bundle_helper import bundle_is
+    if bundle_is(path):
+        # No walk: the bundle has its objects already, and we take
+        # them all.
+        from git_bundle_helper import bundle_unbundle
+        with trace_region("fetch/objects"):
+            (refs, count) = bundle_unbundle(repo, path)
+        src = None
+    else:
+        src = GitRepository(os.path.realpath(path))
+        refs = ref_flatten(ref_list(src))
+
+    updates = list()
+    for (ref, sha) in refs:
+        if ref.startswith("refs/heads/"):
+            ours = f"refs/remotes/{remote}/{ref[11:]}"
+        elif ref.startswith("refs/tags/"):
+            ours = ref
+            if ref_resolve(repo, ours):
+                continue # Tags don't move.
+        else:
+            continue
+        old = ref_resolve(repo, ours)
+        if old != sha:
+            updates.append((ref, ours, old, sha))
+
+    if src is not None:
+        with trace_region("fetch/objects"):
+            count = fetch_objects(src, repo, [ u[3] for u in updates ])
+
+    # References last: they never point to objects we don't have.
+    for (_, ours, _, sha) in updates:
+        ref_write(repo, ours, sha)
+    return (updates, count)
+
+def fetch_objects(src, repo, wants):
+    """Copy the objects of src reachable from wants and missing from
+repo into a new pack of repo.  Return how many were copied."""
+    seen = set()
+    stack = [ (None, sha) for sha in wants ]
+    count = 0
+    pack_bulk_begin(repo)
+    try:
+        while stack:
+            (_, sha) = stack.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+            if object_exists(repo, sha):
+                continue # And everything below it.
+
+            raw = object_read_raw(src, sha)
+            if raw is None:
+                raise Exception(f"The source repository is missing object {sha}")
+            pack_bulk_write(repo, raw[0], raw[1], sha)
+            count += 1
+            stack.extend(link for link in fsck_links(*raw) if link[1] not in seen)
+    except BaseException:
+        # Objects are written before what they point to: a partial pack
+        # would break the rule above.
+        pack_bulk_abort(repo)
+        raise
+    pack_bulk_end(repo)
+    if trace_counters is not None:
+        trace_counters["fetch_objects"] += count
+    return count
+
+def clone(path, directory, shared=False, references=()):
+    """Clone the repository at path into directory, which is created,
+and check out its current branch.  With shared, objects are borrowed
+from the repository at path instead of being copied, as they are from
+the repositories at references: only what these lack is copied."""
+    from git_switch_helper import switch
+    path = os.path.realpath(path)
+    src = GitRepository(path)
+
+    repo_create(directory)
+    repo = repo_find(directory)
+    borrowed = [ src ] if shared else []
+    borrowed += [ GitRepository(os.path.realpath(r)) for r in references ]
+    if borrowed:
+        clone_alternates(repo, [ os.path.join(r.gitdir, "objects") for r in borrowed ])
+    repo_config_set(repo, 'remote "origin"', "url", path)
+    repo_config_set(repo, 'remote "origin"', "fetch", "+refs/heads/*:refs/remotes/origin/*")
+    result = fetch(repo, "origin", path)
+
+    # Check out what HEAD points to there: a branch, or a commit.
+    branch = ref_symbolic(src, "HEAD")
+    head = ref_resolve(src, "HEAD")
+    if branch is None:
+        if head:
+            fetch_objects(src, repo, [ head ]) # It may be on no branch.
+            switch(repo, head, head)
+        return result
+
+    branch = branch.removeprefix("refs/heads/")
+    if head is None:
+        # An empty repository: HEAD points to a branch to be.
+        ref_write(repo, "HEAD", "ref: refs/heads/" + branch)
+        return result
+
+    ref_write(repo, "refs/remotes/origin/HEAD", "ref: refs/remotes/origin/" + branch)
+    repo_config_set(repo, f'branch "{branch}"', "remote", "origin")
+    repo_config_set(repo, f'branch "{branch}"', "merge", "refs/heads/" + branch)
+    # The branch after: switch goes from what HEAD points to.
+    switch(repo, head, "ref: refs/heads/" + branch)
+    ref_write(repo, "refs/heads/" + branch, head)
+    return result
+
+def clone_alternates(repo, paths):
+    """List the object directories paths in repo's objects/info/alternates.
+Their objects are then repo's: fetch finds them present, and copies
+nothing.  They must outlive repo, and keep their objects."""
+    with open(repo_file(repo, "objects", "info", "alternates", mkdir=True), "w") as f:
+        for path in paths:
+            f.write(os.path.realpath(path) + "\n")
+    repo.object_dirs = None
+    repo.packs = None
@@ -0,0 +1,214 @@
+import os
+import hashlib
+
+from git_utilities import repo_find, repo_object_dirs
+from git_objects import GitCommit, GitTree, GitTag
+from git_pack_helper import pack_list, pack_read_at, pack_index_sha, pack_index_offset
+from git_trace_helper import trace_region
+
+# Checking the object store.  Every object is read, hashed and parsed
+# on a pool of processes: it's all CPU (inflating, applying deltas,
+# SHA-1) and independent, so it scales with the cores.  Workers send
+# back the links of each object (the tree and parents of a commit, the
+# entries of a tree, the object of a tag), and connectivity is checked
+# on those, from the refs, HEAD and the index, without reading anything
+# again.
+
+# Objects per task: large enough to amortize sending results back, small
+# enough to spread a single big pack over all workers.
+FSCK_CHUNK = 2000
+
+# The repository of a worker process, opened by fsck_worker_init.
+fsck_repo = None
+
+def fsck(repo, jobs=None):
+    """Check the objects of repo.  Return (corrupt, missing, dangling):
+corrupt is a list of (sha, reason), the others lists of (type, sha)."""
+    tasks = fsck_tasks(repo)
+    jobs = jobs or os.cpu_count() or 1
+
+    objects = dict() # sha -> (fmt, links)
+    corrupt = list()
+    with trace_region("fsck/objects"):
+        if jobs == 1:
+            fsck_worker_init(repo.worktree)
+            results = list(map(fsck_check, tasks))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(jobs, initializer=fsck_worker_init, initargs=(repo.worktree,)) as pool:
+                results = list(pool.map(fsck_check, tasks))
+
+        for result in results:
+            for (sha, fmt, links, error) in result:
+                if error:
+                    corrupt.append((sha, error))
+                else:
+                    objects[sha] = (fmt, links)
+
+    with trace_region("fsck/connectivity"):
+        (missing, reachable) = fsck_connectivity(repo, objects)
+    # Corrupt objects are absent from objects: don't report them twice.
+    bad = set(sha for (sha, _) in corrupt)
+    missing = [ m for m in missing if m[1] not in bad ]
+
+    # Dangling objects are the unreachable ones nothing points to: the
+    # tips of what was lost.
+    referenced = set(sha for (_, links) in objects.values() for (_, sha) in links)
+    dangling = [ (fmt, sha) for (sha, (fmt, _)) in objects.items()
+                 if sha not in reachable and sha not in referenced ]
+
+    return (sorted(corrupt), sorted(missing, key=lambda m: m[1]), sorted(dangling, key=lambda d: d[1]))
+
+def fsck_tasks(repo):
+    """Split the objects of repo, and of the object directories it
+borrows from, into tasks: lists of (pack path, offset, sha), or of
+(None, None, sha) for loose objects."""
+    tasks = list()
+
+    loose = list()
+    for path in repo_object_dirs(repo):
+        for d in sorted(os.listdir(path)):
+            if len(d) == 2 and os.path.isdir(os.path.join(path, d)):
+                for f in os.listdir(os.path.join(path, d)):
+                    if len(f) == 38:
+                        loose.append((None, None, d + f))
+    for i in range(0, len(loose), FSCK_CHUNK):
+        tasks.append(loose[i:i+FSCK_CHUNK])
+
+    # Pack entries in offset order, so a worker reads a delta shortly
+    # after its base, which is then in the delta base cache.
+    for pack in pack_list(repo):
+        entries = sorted((pack_index_offset(pack, pos), pack_index_sha(pack, pos).hex())
+                         for pos in range(pack.count))
+        entries = [ (pack.path, offset, sha) for (offset, sha) in entries ]
+        for i in range(0, len(entries), FSCK_CHUNK):
+            tasks.append(entries[i:i+FSCK_CHUNK])
+        # The pack's own checksum, as one more task.
+        tasks.append([ (pack.path, None, None) ])
+    return tasks
+
+def fsck_worker_init(worktree):
+    global fsck_repo
+    fsck_repo = repo_find(worktree)
+
+def fsck_check(task):
+    """Check the objects of task.  Return a list of (sha, fmt, links,
+error), error being None if the object is fine."""
+    from git_object_helper import object_read_raw
+    ret = list()
+    for (path, offset, sha) in task:
+        if sha is None:
+            error = fsck_pack_checksum(path)
+            if error:
+                ret.append((os.path.basename(path) + ".pack", None, None, error))
+            continue
+
+        try:
+            if path is None:
+                raw = object_read_raw(fsck_repo, sha)
+            else:
+                pack = [ p for p in pack_list(fsck_repo) if p.path == path ][0]
+                raw = pack_read_at(fsck_repo, pack, offset)
+            (fmt, data) = raw
+            actual = hashlib.sha1(fmt + b' ' + str(len(data)).encode() + b'\x00' + data).hexdigest()
+            if actual != sha:
+                ret.append((sha, None, None, f"hash mismatch: contents hash to {actual}"))
+                continue
+            ret.append((sha, fmt.decode("ascii"), fsck_links(fmt, data), None))
+        except Exception as e:
+            ret.append((sha, None, None, f"unreadable: {e}"))
+    return ret
+
+def fsck_links(fmt, data):
+    """Return the objects object data of type fmt points to, as a list of
+(type, sha)."""
+    match fmt:
+        case b'blob':
+            return []
+        case b'commit':
+            kvlm = GitCommit(data).kvlm
+            parents = kvlm.get(b'parent', [])
+            if type(parents) != list:
+                parents = [ parents ]
+            return ([ ("tree", kvlm[b'tree'].decode("ascii")) ]
+                    + [ ("commit", p.decode("ascii")) for p in parents ])
+        case b'tree':
+            ret = list()
+            for leaf in GitTree(data).items:
+                if leaf.mode.startswith(b"04"):
+                    ret.append(("tree", leaf.sha))
+                elif not leaf.mode.startswith(b"16"): # Submodules live elsewhere.
+                    ret.append(("blob", leaf.sha))
+            return ret
+        case b'tag':
+            kvlm = GitTag(data).kvlm
+            return [ (kvlm[b'type'].decode("ascii"), kvlm[b'object'].decode("ascii")) ]
+        case _:
+            raise Exception(f"unknown type {fmt}")
+
+def fsck_pack_checksum(path):
+    """Check the trailing SHA-1 of pack path.  Return an error, or None."""
+    with open(path + ".pack", "rb") as f:
+        h = hashlib.sha1()
+        size = os.fstat(f.fileno()).st_size - 20
+        while size > 0:
+            chunk = f.read(min(size, 1 << 20))
+            h.update(chunk)
+            size -= len(chunk)
+        if h.digest() != f.read(20):
+            return "pack checksum mismatch"
+    return None
+
+def fsck_connectivity(repo, objects):
+    """Walk objects (see fsck) from the roots of repo.  Return (missing,
+reachable): the objects linked to but absent, and the set of the SHAs
+reached."""
+    missing = dict() # sha -> type
+    reachable = set()
+    stack = fsck_roots(repo)
+    while stack:
+        (fmt, sha) = stack.pop()
+        if sha in reachable:
+            continue
+        if sha not in objects:
+            # A ref to a missing object doesn't tell its type: a link
+            # from another object may.
+            if missing.get(sha, "object") == "object":
+                missing[sha] = fmt
+            continue
+        reachable.add(sha)
+        stack.extend(objects[sha][1])
+    return ([ (fmt, sha) for (sha, fmt) in missing.items() ], reachable)
+
+def fsck_roots(repo):
+    """Return what's reachable by definition, as (type, sha): the targets
+of the refs, HEAD, and the index entries and cache-tree."""
+    from git_ref_helper import ref_list, ref_resolve
+    from git_index_helper import index_read
+    from git_object_helper import object_read_header
+
+    # Refs mostly point to commits, but not only: tags point to tag
+    # objects, and any ref can point to anything.  Only the header is
+    # read, to tell.
+    def tip(sha):
+        header = object_read_header(repo, sha)
+        return (header[0].decode("ascii") if header else "object", sha)
+
+    ret = list()
+    def walk(refs):
+        for v in refs.values():
+            if type(v) == dict:
+                walk(v)
+            elif v:
+                ret.append(tip(v))
+    walk(ref_list(repo))
+
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        ret.append(tip(head))
+    index = index_read(repo)
+    for e in index.entries:
+        if e.mode_type != 0b1110: # Submodules live elsewhere.
+            ret.append(("tree" if e.mode_type == 0b0100 else "blob", e.sha))
+    ret.extend(("tree", sha) for sha in index.cache_tree.values())
+    return ret
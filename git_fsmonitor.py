@@ -0,0 +1,176 @@
+import os
+
+# A filesystem monitor, on Linux's inotify.  The daemon watches every
+# directory of the worktree, and numbers the changes it's told about.
+# Status asks it what changed since a token (which it keeps in the
+# index), gets a new token with the answer, and only looks at those
+# paths instead of stat()ing every file of the worktree.
+#
+# When the monitor can't answer for sure (it wasn't running when the
+# token was given, the kernel dropped events, or we ran out of
+# watches), it says so, and status looks everywhere.
+
+# From <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = os.O_CLOEXEC
+
+FSMONITOR_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+                  | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+# The monitors of this process, by worktree.  Only the daemon has any.
+fsmonitor_local = None
+
+fsmonitor_libc_handle = None
+
+def fsmonitor_libc():
+    global fsmonitor_libc_handle
+    if fsmonitor_libc_handle is None:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1.argtypes = [ ctypes.c_int ]
+        libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+        libc.inotify_rm_watch.argtypes = [ ctypes.c_int, ctypes.c_int ]
+        fsmonitor_libc_handle = libc
+    return fsmonitor_libc_handle
+
+def fsmonitor_start(worktree):
+    """Start watching worktree.  Return the GitFsMonitor, or None if
+inotify isn't available."""
+    from git_objects import GitFsMonitor
+    try:
+        libc = fsmonitor_libc()
+    except (OSError, AttributeError):
+        return None # Not Linux, or no libc.
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        return None
+
+    mon = GitFsMonitor(fd, worktree)
+    fsmonitor_reset(mon)
+    # Whatever happens from here on is queued: nothing is missed
+    # between this walk and the first token.
+    fsmonitor_watch(mon, "")
+    return mon
+
+def fsmonitor_reset(mon):
+    """Start a new instance: previous tokens are no longer valid."""
+    import time
+    mon.instance = f"{os.getpid()}.{time.time_ns()}"
+    mon.seq = 0
+    mon.changed.clear()
+
+def fsmonitor_watch(mon, path):
+    """Watch directory path (relative to the worktree) and everything
+below it, except .git."""
+    libc = fsmonitor_libc()
+    top = os.path.join(mon.worktree, path) if path else mon.worktree
+    for (root, dirs, _) in os.walk(top):
+        if root == mon.worktree and ".git" in dirs:
+            dirs.remove(".git")
+        wd = libc.inotify_add_watch(mon.fd, os.fsencode(root), FSMONITOR_MASK)
+        if wd < 0:
+            import errno
+            import ctypes
+            if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                continue # Gone already: its parent will tell.
+            # Most likely out of watches (fs.inotify.max_user_watches):
+            # we can't see everything, so we won't pretend we do.
+            mon.instance = None
+            return
+        rel = os.path.relpath(root, mon.worktree)
+        mon.watches[wd] = "" if rel == "." else rel
+
+def fsmonitor_unwatch(mon, path):
+    """Stop watching directory path and everything below it."""
+    libc = fsmonitor_libc()
+    for (wd, p) in list(mon.watches.items()):
+        if p == path or p.startswith(path + "/"):
+            libc.inotify_rm_watch(mon.fd, wd)
+            del mon.watches[wd]
+
+def fsmonitor_process(mon):
+    """Read and record all the events queued for mon."""
+    import struct
+    while True:
+        try:
+            buf = os.read(mon.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        # Events are struct inotify_event: int wd; uint32_t mask,
+        # cookie, len; then len bytes of NUL-padded name.
+        pos = 0
+        while pos < len(buf):
+            (wd, mask, _, size) = struct.unpack_from("iIII", buf, pos)
+            name = os.fsdecode(buf[pos+16:pos+16+size].rstrip(b"\x00"))
+            pos += 16 + size
+            fsmonitor_event(mon, wd, mask, name)
+
+def fsmonitor_event(mon, wd, mask, name):
+    if mask & IN_Q_OVERFLOW:
+        # The kernel dropped events: we don't know what changed.
+        if mon.instance is not None:
+            fsmonitor_reset(mon)
+        return
+    if mask & IN_IGNORED:
+        mon.watches.pop(wd, None) # Directory removed, or unwatched.
+        return
+
+    parent = mon.watches.get(wd)
+    if parent is None or not name:
+        return # Stale watch, or an event on a directory itself.
+    path = parent + "/" + name if parent else name
+    if path == ".git":
+        return
+
+    if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            # Files may have been created before the watch was: the
+            # directory is reported as a whole, and status walks it.
+            fsmonitor_watch(mon, path)
+        elif mask & IN_MOVED_FROM:
+            fsmonitor_unwatch(mon, path)
+
+    mon.seq += 1
+    mon.changed[path] = mon.seq
+
+def fsmonitor_changes(mon, token):
+    """Return (new token, paths changed since token), with None instead
+of the paths if we can't tell.  Return None if mon gave up."""
+    fsmonitor_process(mon)
+    if mon.instance is None:
+        return None
+
+    current = f"{mon.instance}:{mon.seq}"
+    if token is None or token.rpartition(":")[0] != mon.instance:
+        return (current, None)
+    since = int(token.rpartition(":")[2])
+    return (current, [ p for (p, seq) in mon.changed.items() if seq > since ])
+
+def fsmonitor_query(repo, token):
+    """Ask the monitor of repo's worktree what changed since token: see
+fsmonitor_changes.  Return None if there's no monitor."""
+    if fsmonitor_local is not None and repo.worktree in fsmonitor_local:
+        return fsmonitor_changes(fsmonitor_local[repo.worktree], token)
+
+    if os.environ.get("MY_GIT_NO_DAEMON"):
+        return None
+    from git_daemon import DAEMON_SOCKET, daemon_call
+    sock = os.path.join(repo.gitdir, DAEMON_SOCKET)
+    if not os.path.exists(sock):
+        return None
+    answer = daemon_call(sock, { "fsmonitor": token })
+    if answer is None or answer[0].get("token") is None:
+        return None
+    return (answer[0]["token"], answer[0]["paths"])
@@ -3,8 +3,10 @@ import os
 from fnmatch import fnmatch
 
 from git_objects import GitIgnore
+from git_utilities import repo_cached
 from git_index_helper import index_read
 from git_object_helper import object_read
+from git_trace_helper import trace_counters, trace_function
 
 def gitignore_parse1(raw):
     raw = raw.strip() # Remove leading/trailing spaces
@@ -29,7 +31,23 @@ def gitignore_parse(lines):
     return ret
 
 
+@trace_function("gitignore/read")
 def gitignore_read(repo):
+    # The rules only change with these files, and the index, which
+    # tells which .gitignore blobs are current.
+    paths = [ os.path.join(repo.gitdir, "info/exclude"),
+              gitignore_global_file(),
+              os.path.join(repo.gitdir, "index") ]
+    return repo_cached(repo, "gitignore", paths, lambda: gitignore_load(repo))
+
+def gitignore_global_file():
+    if "XDG_CONFIG_HOME" in os.environ:
+        config_home = os.environ["XDG_CONFIG_HOME"]
+    else:
+        config_home = os.path.expanduser("~/.config")
+    return os.path.join(config_home, "git/ignore")
+
+def gitignore_load(repo):
     ret = GitIgnore(absolute=list(), scoped=dict())
 
     # Read local configuration in .git/info/exclude
@@ -39,11 +57,7 @@ def gitignore_read(repo):
             ret.absolute.append(gitignore_parse(f.readlines()))
 
     # Global configuration
-    if "XDG_CONFIG_HOME" in os.environ:
-        config_home = os.environ["XDG_CONFIG_HOME"]
-    else:
-        config_home = os.path.expanduser("~/.config")
-    global_file = os.path.join(config_home, "git/ignore")
+    global_file = gitignore_global_file()
 
     if os.path.exists(global_file):
         with open(global_file, "r") as f:
@@ -90,6 +104,8 @@ def check_ignore_absolute(rules, path):
 def check_ignore(rules, path):
     if os.path.isabs(path):
         raise Exception("This function requires path to be relative to the repository's root")
+    if trace_counters is not None:
+        trace_counters["ignore_checks"] += 1
 
     result = check_ignore_scoped(rules.scoped, path)
     if result != None:
@@ -0,0 +1,151 @@
+import os
+import re
+
+from git_utilities import repo_find
+from git_trace_helper import trace_region, trace_counters
+
+# Searching file contents.  The files to search come from the index (for
+# the worktree, or the index itself) or from a tree; each is either a
+# blob of the store or a file of the worktree.  Identical blobs are
+# searched once, whatever the number of paths they're at, and the
+# searches run on a pool of processes: inflating and matching are all
+# CPU.  Results are printed in path order, as soon as every path before
+# them is done.
+
+# Files per task.
+GREP_CHUNK = 64
+
+# How much of a file we look at for a NUL, to tell it's binary, as git
+# does.
+GREP_BINARY_PEEK = 8000
+
+# The state of a worker process, set by grep_worker_init: the
+# repository and the compiled pattern.
+grep_repo = None
+grep_regex = None
+
+def grep_files(repo, tree=None, cached=False, paths=None):
+    """Return the files to search, in path order, as (path, source):
+source is ("blob", sha) or ("file", full path).  From tree if given,
+else from the index: the worktree files, or with cached the blobs of
+the index (their worktree file, if the stat data says it's the same)."""
+    def wanted(path):
+        return not paths or any(path == p or path.startswith(p + "/") for p in paths)
+
+    ret = list()
+    if tree is not None:
+        from git_tree_helper import tree_diff
+        for (_, path, _, _, mode, sha) in tree_diff(repo, None, tree):
+            if not mode.startswith(b"16") and wanted(path):
+                ret.append((path, ("blob", sha)))
+        return ret
+
+    from git_index_helper import index_read
+    for e in index_read(repo).entries:
+        # Submodules and sparse directories have no contents here.
+        if e.mode_type in (0b1110, 0b0100) or not wanted(e.name):
+            continue
+        full_path = os.path.join(repo.worktree, e.name)
+        if e.mode_type == 0b1010 or e.flag_skip_worktree:
+            ret.append((e.name, ("blob", e.sha)))
+        elif not cached:
+            if os.path.isfile(full_path):
+                ret.append((e.name, ("file", full_path)))
+        else:
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                st = None
+            same = (st is not None and st.st_size == e.fsize
+                    and st.st_mtime_ns == e.mtime[0] * 10**9 + e.mtime[1]
+                    and st.st_ctime_ns == e.ctime[0] * 10**9 + e.ctime[1])
+            ret.append((e.name, ("file", full_path) if same else ("blob", e.sha)))
+    return ret
+
+def grep(repo, pattern, files, ignore_case=False, jobs=None):
+    """Search files (see grep_files) for regular expression pattern.
+Yield (path, matches) in path order, for files that match: matches is a
+list of (line number, line), lines being bytes without their newline.
+Binary files are skipped."""
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    re.compile(pattern.encode("utf8"), flags) # Fail here, not in a worker.
+
+    # Each source is searched once, at the first path it's at.
+    sources = list(dict.fromkeys(source for (_, source) in files))
+    tasks = [ sources[i:i+GREP_CHUNK] for i in range(0, len(sources), GREP_CHUNK) ]
+    jobs = jobs or os.cpu_count() or 1
+    if trace_counters is not None:
+        trace_counters["grep_files"] += len(files)
+        trace_counters["grep_sources"] += len(sources)
+
+    with trace_region("grep/search"):
+        if jobs == 1 or len(tasks) == 1:
+            grep_worker_init(repo.worktree, pattern, flags)
+            results = map(grep_search, tasks)
+            yield from grep_collect(files, results)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(jobs, initializer=grep_worker_init,
+                                     initargs=(repo.worktree, pattern, flags)) as pool:
+                # map hands results back in order, while later tasks
+                # still run.
+                yield from grep_collect(files, pool.map(grep_search, tasks))
+
+def grep_collect(files, results):
+    done = dict()
+    for (path, source) in files:
+        # Sources are in the order of their first path: this one is
+        # done, or in the next results.
+        while source not in done:
+            done.update(next(results))
+        if done[source]:
+            yield (path, done[source])
+
+def grep_worker_init(worktree, pattern, flags):
+    global grep_repo, grep_regex
+    grep_repo = repo_find(worktree)
+    grep_regex = re.compile(pattern.encode("utf8"), flags)
+
+def grep_search(task):
+    """Search the sources of task.  Return a dict source -> matches."""
+    from git_object_helper import object_read_raw
+    ret = dict()
+    for source in task:
+        (kind, where) = source
+        if kind == "blob":
+            data = object_read_raw(grep_repo, where)[1]
+        else:
+            try:
+                with open(where, "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = b"" # Gone meanwhile.
+
+        if b"\x00" in data[:GREP_BINARY_PEEK]:
+            ret[source] = None
+            continue
+        ret[source] = grep_lines(grep_regex, data)
+    return ret
+
+def grep_lines(regex, data):
+    """Return the lines of data regex matches, as (line number, line)."""
+    # Searching the whole of data finds the first line that can match
+    # quickly, but a match there may run over the end of the line: each
+    # line is matched on its own, as git does.
+    matches = list()
+    pos = 0
+    lineno = 1
+    counted = 0
+    while pos <= len(data) and (m := regex.search(data, pos)):
+        if m.start() == len(data) and (not data or data.endswith(b"\n")):
+            break # After the last line: not a line.
+        start = data.rfind(b"\n", 0, m.start()) + 1
+        end = data.find(b"\n", m.start())
+        if end == -1:
+            end = len(data)
+        if m.end() <= end or regex.search(data, start, end):
+            lineno += data.count(b"\n", counted, start)
+            counted = start
+            matches.append((lineno, data[start:end]))
+        pos = end + 1
+    return matches
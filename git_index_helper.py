@@ -3,13 +3,38 @@ from git_utilities import *
 from git_objects import *
 
 import os
+import io
+import hashlib
 from math import ceil
+from bisect import bisect_left
+from contextlib import contextmanager
 
+from git_trace_helper import trace_function
 
 
+
+@trace_function("index/read")
 def index_read(repo):
     index_file = repo_file(repo, "index")
+    return repo_cached(repo, "index", [ index_file ], lambda: index_read_file(index_file))
+
+@contextmanager
+def index_locked(repo):
+    """Hold .git/index.lock for the block, as git's hold_locked_index:
+commands that change the index read it, and write it back with
+index_write, inside the block, so another process can't change it in
+between, and lose the changes of one of them.  The lock is dropped if
+the block doesn't write the index."""
+    path = repo_file(repo, "index")
+    repo.index_lock = file_lock(path)
+    try:
+        yield
+    finally:
+        if repo.index_lock is not None:
+            file_lock_rollback(repo.index_lock, path)
+            repo.index_lock = None
 
+def index_read_file(index_file):
     # New repositories have no index!
     if not os.path.exists(index_file):
         return GitIndex()
@@ -21,7 +46,7 @@ def index_read(repo):
     signature = header[:4]
     assert signature == b"DIRC" # Stands for "DirCache"
     version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "wyag only supports index file version 2"
+    assert version in [2, 3], "wyag only supports index file versions 2 and 3"
     count = int.from_bytes(header[8:12], "big")
 
     entries = list()
@@ -48,7 +73,7 @@ def index_read(repo):
         assert 0 == unused
         mode = int.from_bytes(content[idx+26: idx+28], "big")
         mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
+        assert mode_type in [0b1000, 0b1010, 0b1110, 0b0100]
         mode_perms = mode & 0b0000000111111111
         # User ID
         uid = int.from_bytes(content[idx+28: idx+32], "big")
@@ -64,7 +89,6 @@ def index_read(repo):
         # Parse flags
         flag_assume_valid = (flags & 0b1000000000000000) != 0
         flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
         flag_stage =  flags & 0b0011000000000000
         # Length of the name.  This is stored on 12 bits, some max
         # value is 0xFFF, 4095.  Since names can occasionally go
@@ -77,6 +101,15 @@ def index_read(repo):
         # We've read 62 bytes so far.
         idx += 62
 
+        # Version 3 entries may have two more bytes of flags, of which
+        # we only know skip-worktree.
+        flag_skip_worktree = False
+        if flag_extended:
+            assert version == 3
+            extended = int.from_bytes(content[idx: idx+2], "big")
+            flag_skip_worktree = (extended & 0b0100000000000000) != 0
+            idx += 2
+
         if name_length < 0xFFF:
             assert content[idx + name_length] == 0x00
             raw_name = content[idx:idx+name_length]
@@ -112,18 +145,216 @@ def index_read(repo):
                                      sha=sha,
                                      flag_assume_valid=flag_assume_valid,
                                      flag_stage=flag_stage,
+                                     flag_skip_worktree=flag_skip_worktree,
                                      name=name))
 
-    return GitIndex(version=version, entries=entries)
+    # Entries may be followed by extensions, each made of a four bytes
+    # signature and a four bytes size, and the file ends with the SHA-1
+    # of everything before it.  We only know about the cache-tree
+    # (TREE) and filesystem monitor (FSMN) extensions; the others are
+    # optional, so we skip them.
+    cache_tree = dict()
+    fsmonitor = None
+    while idx + 8 <= len(content) - 20:
+        signature = content[idx:idx+4]
+        size = int.from_bytes(content[idx+4:idx+8], "big")
+        if signature == b"TREE":
+            index_cache_tree_parse(content[idx+8:idx+8+size], 0, "", cache_tree)
+        elif signature == b"FSMN":
+            fsmonitor = index_fsmonitor_parse(content[idx+8:idx+8+size], entries)
+        idx += 8 + size
+
+    return GitIndex(version=version, entries=entries, cache_tree=cache_tree, fsmonitor=fsmonitor)
+
+def index_cache_tree_parse(raw, start, prefix, ret):
+    """Parse one cache-tree node starting at start, and its children,
+into the ret dict.  Return the position after the last byte read."""
+    # Each node is "<name>\x00<entry count> <subtree count>\n", then
+    # the 20 bytes SHA unless the entry count is -1 (invalidated).
+    x = raw.find(b'\x00', start)
+    name = raw[start:x].decode("utf8")
+    y = raw.find(b'\n', x)
+    count, subtrees = raw[x+1:y].split(b' ')
+    pos = y + 1
+
+    path = os.path.join(prefix, name) if name else prefix
+    if int(count) >= 0:
+        ret[path] = format(int.from_bytes(raw[pos:pos+20], "big"), "040x")
+        pos += 20
+
+    for i in range(0, int(subtrees)):
+        pos = index_cache_tree_parse(raw, pos, path, ret)
+    return pos
+
+def index_cache_tree_serialize(index):
+    # Count how many entries each directory holds (recursively), and
+    # remember its direct subdirectories.
+    counts = { "": 0 }
+    children = { "": set() }
+    for e in index.entries:
+        key = os.path.dirname(e.name)
+        while True:
+            counts[key] = counts.get(key, 0) + 1
+            if key == "":
+                break
+            parent = os.path.dirname(key)
+            children.setdefault(parent, set()).add(os.path.basename(key))
+            children.setdefault(key, set())
+            key = parent
+
+    ret = b''
+    # Nodes are written depth-first, children in index order, which
+    # sorts directories as if their name ended with a slash.
+    stack = [ "" ]
+    while stack:
+        path = stack.pop()
+        subdirs = sorted(children[path], key=lambda name: name + "/")
+        if path in index.cache_tree:
+            count = counts[path]
+        else:
+            count = -1
+        ret += os.path.basename(path).encode("utf8") + b'\x00'
+        ret += f"{count} {len(subdirs)}\n".encode("ascii")
+        if count >= 0:
+            ret += int(index.cache_tree[path], 16).to_bytes(20, "big")
+        stack.extend(os.path.join(path, d) for d in reversed(subdirs))
+    return ret
+
+def index_cache_tree_invalidate(index, path):
+    """Forget the cache-tree SHA of every directory containing path."""
+    key = os.path.dirname(path)
+    while True:
+        index.cache_tree.pop(key, None)
+        if key == "":
+            break
+        key = os.path.dirname(key)
+
+def index_entry_refresh(entry, stat):
+    """Update the stat data of entry from stat, the os.stat() of the
+file it was just checked out to."""
+    entry.ctime = (int(stat.st_ctime), stat.st_ctime_ns % 10**9)
+    entry.mtime = (int(stat.st_mtime), stat.st_mtime_ns % 10**9)
+    entry.dev = stat.st_dev & 0xFFFFFFFF
+    entry.ino = stat.st_ino & 0xFFFFFFFF
+    entry.uid = stat.st_uid
+    entry.gid = stat.st_gid
+    entry.fsize = stat.st_size & 0xFFFFFFFF
+
+def index_fsmonitor_invalidate(index, path):
+    """Have the next status look at path, whose entry changed: the
+filesystem monitor only reports changes to the worktree."""
+    if index.fsmonitor is not None:
+        index.fsmonitor[2].add(path)
+
+# The FSMN extension is git's layout (version 2): a four bytes version,
+# the token, NUL terminated, then the size of an EWAH bitmap and the
+# bitmap, whose bit i is set if entry i is dirty.  The token is opaque
+# to git, so ours also holds the ignore rules key and the dirty paths
+# that aren't in the index, one per line.  Git drops the extension
+# unless it runs its own monitor, which won't know our token anyway.
+
+def index_fsmonitor_parse(raw, entries):
+    if int.from_bytes(raw[0:4], "big") != 2:
+        return None
+    x = raw.find(b'\x00', 4)
+    fields = raw[4:x].decode("utf8").split("\n")
+    if len(fields) < 2:
+        return None # Not one of ours.
+    dirty = set(fields[2:])
+    for i in ewah_parse(raw[x+5:]):
+        if i < len(entries):
+            dirty.add(entries[i].name)
+    return (fields[0], fields[1], dirty)
 
+def index_fsmonitor_serialize(index):
+    (token, ignore_key, dirty) = index.fsmonitor
+    bits = list()
+    others = set(dirty)
+    for (i, e) in enumerate(index.entries):
+        if e.name in dirty:
+            bits.append(i)
+            others.discard(e.name)
+
+    token = "\n".join([ token, ignore_key ] + sorted(others)).encode("utf8")
+    bitmap = ewah_serialize(bits, len(index.entries))
+    return (2).to_bytes(4, "big") + token + b'\x00' + len(bitmap).to_bytes(4, "big") + bitmap
+
+def ewah_parse(raw):
+    """Return the positions of the set bits of the EWAH bitmap raw: the
+bit count, the word count, 64 bits words, and the position of the
+last marker word.  Each marker word says how many words of all zeros
+or all ones (bit 0) follow (bits 1-32), then how many literal words
+(bits 33-63)."""
+    count = int.from_bytes(raw[4:8], "big")
+    words = [ int.from_bytes(raw[8+8*i:16+8*i], "big") for i in range(count) ]
+    ret = list()
+    pos = 0
+    i = 0
+    while i < count:
+        marker = words[i]
+        run = (marker >> 1) & 0xFFFFFFFF
+        if marker & 1:
+            ret.extend(range(pos, pos + 64 * run))
+        pos += 64 * run
+        i += 1
+        for w in words[i:i + (marker >> 33)]:
+            ret.extend(pos + b for b in range(64) if w >> b & 1)
+            pos += 64
+        i += marker >> 33
+    return ret
+
+def ewah_serialize(bits, size):
+    """Return the EWAH bitmap of size bits where bits are set.  We only
+write literal words, which is all git needs to read it."""
+    literals = [ 0 ] * ((size + 63) // 64)
+    for b in bits:
+        literals[b // 64] |= 1 << (b % 64)
+
+    words = list()
+    last = 0
+    for i in range(0, max(len(literals), 1), 0x7FFFFFFF):
+        chunk = literals[i:i + 0x7FFFFFFF]
+        last = len(words)
+        words.append(len(chunk) << 33)
+        words.extend(chunk)
+
+    return (size.to_bytes(4, "big") + len(words).to_bytes(4, "big")
+            + b"".join(w.to_bytes(8, "big") for w in words)
+            + last.to_bytes(4, "big"))
+
+def index_entries_under(index, paths):
+    """Return the entries of index named by one of paths, or below
+one of them, in index order."""
+    found = set()
+    key = lambda e: e.name
+    for p in paths:
+        i = bisect_left(index.entries, p, key=key)
+        if i < len(index.entries) and index.entries[i].name == p:
+            found.add(i)
+        # Entries below p aren't necessarily right after p: "p-1"
+        # sorts between "p" and "p/1".
+        i = bisect_left(index.entries, p + "/", key=key)
+        while i < len(index.entries) and index.entries[i].name.startswith(p + "/"):
+            found.add(i)
+            i += 1
+    return [ index.entries[i] for i in sorted(found) ]
+
+@trace_function("index/write")
 def index_write(repo, index):
-    with open(repo_file(repo, "index"), "wb") as f:
+    # Git requires entries sorted by name: both tree_from_index and
+    # the tree/index diff rely on it.
+    index.entries.sort(key=lambda e: e.name)
+
+    with io.BytesIO() as f:
 
         # HEADER
 
         # Write the magic bytes.
         f.write(b"DIRC")
-        # Write version number.
+        # Write version number: like git, we only use version 3 when
+        # some entry needs extended flags.
+        extended = any(e.flag_skip_worktree for e in index.entries)
+        index.version = 3 if extended else 2
         f.write(index.version.to_bytes(4, "big"))
         # Write the number of entries.
         f.write(len(index.entries).to_bytes(4, "big"))
@@ -159,18 +390,60 @@ def index_write(repo, index):
             else:
                 name_length = bytes_len
 
-            # We merge back three pieces of data (two flags and the
+            flag_extended = 0x1 << 14 if e.flag_skip_worktree else 0
+
+            # We merge back four pieces of data (three flags and the
             # length of the name) on the same two bytes.
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
+            f.write((flag_assume_valid | flag_extended | e.flag_stage | name_length).to_bytes(2, "big"))
+            idx += 62
+            if flag_extended:
+                f.write((0x1 << 14).to_bytes(2, "big"))
+                idx += 2
 
             # Write back the name, and a final 0x00.
             f.write(name_bytes)
             f.write((0).to_bytes(1, "big"))
 
-            idx += 62 + len(name_bytes) + 1
+            idx += len(name_bytes) + 1
 
             # Add padding if necessary.
             if idx % 8 != 0:
                 pad = 8 - (idx % 8)
                 f.write((0).to_bytes(pad, "big"))
-                idx += pad
\ No newline at end of file
+                idx += pad
+
+        # EXTENSIONS
+
+        if index.cache_tree:
+            tree = index_cache_tree_serialize(index)
+            f.write(b"TREE")
+            f.write(len(tree).to_bytes(4, "big"))
+            f.write(tree)
+
+        # The sparse directory extension is empty: it only tells git
+        # that entries may be directories.
+        if any(e.mode_type == 0b0100 for e in index.entries):
+            f.write(b"sdir")
+            f.write((0).to_bytes(4, "big"))
+
+        if index.fsmonitor is not None:
+            fsmn = index_fsmonitor_serialize(index)
+            f.write(b"FSMN")
+            f.write(len(fsmn).to_bytes(4, "big"))
+            f.write(fsmn)
+
+        # Finally, the checksum of everything above.  The new index
+        # is written to index.lock, and renamed over the old one.
+        data = f.getvalue()
+        path = repo_file(repo, "index")
+        fsync = repo_fsync_method(repo) is not None
+        if repo.index_lock is not None:
+            # Taken by index_locked: we're done with it.
+            (lock, repo.index_lock) = (repo.index_lock, None)
+            lock.write(data)
+            lock.write(hashlib.sha1(data).digest())
+            file_lock_commit(lock, path, fsync)
+            return
+        with file_write_locked(path, fsync=fsync) as out:
+            out.write(data)
+            out.write(hashlib.sha1(data).digest())
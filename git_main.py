@@ -1,198 +1,767 @@
 
 import os
 import sys
-import argparse
-from datetime import datetime
-import grp, pwd
-
-from git_utilities import repo_file
-from git_commit_helper import *
-from git_tree_helper import *
-from git_ref_helper import *
-from git_status_helper import *
-from git_index_helper import *
-from git_gitignore_helper import *
-from git_add_rm import *
+
+# Scripts run my_git a lot, often for tiny commands like rev-parse, so
+# startup matters: nothing but the command being run is set up.  Its
+# subparser is the only one built, and each cmd_* function imports the
+# helpers it needs itself.
 
 def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
+    command = argv_command(argv)
+
+    # If a daemon serves this repository, it has everything loaded
+    # already: let it run the command.
+    from git_daemon import daemon_forward
+    status = daemon_forward(argv, command)
+    if status is not None:
+        sys.exit(status)
+
+    # Unknown command, or none (eg for --help): build them all, so
+    # argparse can list them.
+    args = argparser_build(command if command in COMMANDS else None).parse_args(argv)
+
+    if args.profile:
+        # Run the command under cProfile.
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(cmd_run, args)
+        finally:
+            if args.profile_output:
+                profiler.dump_stats(args.profile_output)
+            else:
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+    else:
+        cmd_run(args)
+
+def argv_command(argv):
+    """Return the command name in argv, the first argument that isn't
+an option (or an option's value), or None."""
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--profile-output":
+            skip = True
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+def cmd_run(args):
+    from git_trace_helper import trace_region
+    with trace_region("cmd/" + args.command):
+        cmd_dispatch(args)
+
+def cmd_dispatch(args):
     match args.command:
         case "add"          : cmd_add(args)
+        case "archive"      : cmd_archive(args)
+        case "blame"        : cmd_blame(args)
+        case "bundle"       : cmd_bundle(args)
         case "cat-file"     : cmd_cat_file(args)
         case "check-ignore" : cmd_check_ignore(args)
         case "checkout"     : cmd_checkout(args)
+        case "clone"        : cmd_clone(args)
         case "commit"       : cmd_commit(args)
+        case "daemon"       : cmd_daemon(args)
+        case "diff"         : cmd_diff(args)
+        case "diff-tree"    : cmd_diff_tree(args)
+        case "fetch"        : cmd_fetch(args)
+        case "fsck"         : cmd_fsck(args)
+        case "grep"         : cmd_grep(args)
         case "hash-object"  : cmd_hash_object(args)
         case "init"         : cmd_init(args)
         case "log"          : cmd_log(args)
+        case "merge"        : cmd_merge(args)
+        case "merge-base"   : cmd_merge_base(args)
+        case "merge-tree"   : cmd_merge_tree(args)
+        case "pack-refs"    : cmd_pack_refs(args)
+        case "prune"        : cmd_prune(args)
         case "ls-files"     : cmd_ls_files(args)
         case "ls-tree"      : cmd_ls_tree(args)
+        case "rev-list"     : cmd_rev_list(args)
         case "rev-parse"    : cmd_rev_parse(args)
         case "rm"           : cmd_rm(args)
         case "show-ref"     : cmd_show_ref(args)
+        case "sparse-checkout" : cmd_sparse_checkout(args)
         case "status"       : cmd_status(args)
+        case "switch"       : cmd_switch(args)
         case "tag"          : cmd_tag(args)
+        case "update-ref"   : cmd_update_ref(args)
         case _              : print("Bad command.")
 
 
-argparser = argparse.ArgumentParser(description="The stupidest content tracker")
+def argparser_build(command=None):
+    """Build the argument parser.  If command is given, only its
+subparser is added."""
+    import argparse
+
+    argparser = argparse.ArgumentParser(description="The stupidest content tracker")
+
+    argparser.add_argument("--profile",
+                           action="store_true",
+                           help="Profile the command, and print the top functions to stderr.")
+
+    argparser.add_argument("--profile-output",
+                           metavar="file",
+                           dest="profile_output",
+                           help="With --profile, save the full stats to file instead, for pstats.")
+
+    argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+    argsubparsers.required = True
+
+    for (name, (help, add_arguments)) in COMMANDS.items():
+        if command is None or command == name:
+            add_arguments(argsubparsers.add_parser(name, help=help))
+    return argparser
+
+def argparser_init(argsp):
+    argsp.add_argument("path",
+                       metavar="directory",
+                       nargs="?",
+                       default=".",
+                       help="Where to create the repository.")
+
+def argparser_cat_file(argsp):
+    argsp.add_argument("--batch",
+                       action="store_true",
+                       help="Print the type, size and content of each object named on the standard input.")
+
+    argsp.add_argument("--batch-check",
+                       dest="batch_check",
+                       action="store_true",
+                       help="Print the type and size of each object named on the standard input.")
+
+    argsp.add_argument("type",
+                       metavar="type",
+                       nargs="?",
+                       choices=["blob", "commit", "tag", "tree"],
+                       help="Specify the type")
+
+    argsp.add_argument("object",
+                       metavar="object",
+                       nargs="?",
+                       help="The object to display")
+
+def argparser_hash_object(argsp):
+    argsp.add_argument("-t",
+                       metavar="type",
+                       dest="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       default="blob",
+                       help="Specify the type")
+
+    argsp.add_argument("-w",
+                       dest="write",
+                       action="store_true",
+                       help="Actually write the object into the database")
+
+    argsp.add_argument("--stdin-paths",
+                       dest="stdin_paths",
+                       action="store_true",
+                       help="Read file names from the standard input, one per line")
+
+    argsp.add_argument("path",
+                       nargs="?",
+                       help="Read object from <file>")
+
+def argparser_log(argsp):
+    argsp.add_argument("commit",
+                       default="HEAD",
+                       nargs="?",
+                       help="Commit to start at.")
+
+def argparser_ls_tree(argsp):
+    argsp.add_argument("-r",
+                       dest="recursive",
+                       action="store_true",
+                       help="Recurse into sub-trees")
+
+    argsp.add_argument("tree",
+                       help="A tree-ish object.")
+
+def argparser_checkout(argsp):
+    argsp.add_argument("commit",
+                       help="The commit or tree to checkout.")
+
+    argsp.add_argument("path",
+                       nargs="?",
+                       help="The EMPTY directory to checkout on.  Without it, switch the worktree to commit.")
+
+def argparser_show_ref(argsp):
+    argsp.add_argument("-d", "--dereference",
+                       action="store_true",
+                       help="Also show what annotated tags point to, as <tag>^{}.")
+
+def argparser_tag(argsp):
+    argsp.add_argument("-a",
+                       action="store_true",
+                       dest="create_tag_object",
+                       help="Whether to create a tag object")
+
+    argsp.add_argument("name",
+                       nargs="?",
+                       help="The new tag's name")
+
+    argsp.add_argument("object",
+                       default="HEAD",
+                       nargs="?",
+                       help="The object the new tag will point to")
+
+def argparser_rev_parse(argsp):
+    argsp.add_argument("--wyag-type",
+                       metavar="type",
+                       dest="type",
+                       choices=["blob", "commit", "tag", "tree"],
+                       default=None,
+                       help="Specify the expected type")
+
+    argsp.add_argument("name",
+                       help="The name to parse")
+
+def argparser_ls_files(argsp):
+    argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+
+def argparser_check_ignore(argsp):
+    argsp.add_argument("path", nargs="+", help="Paths to check")
+
+def argparser_status(argsp):
+    pass
+
+def argparser_rm(argsp):
+    argsp.add_argument("path", nargs="+", help="Files to remove")
+
+def argparser_add(argsp):
+    argsp.add_argument("path", nargs="+", help="Files to add")
+
+def argparser_commit(argsp):
+    argsp.add_argument("-m",
+                       metavar="message",
+                       dest="message",
+                       help="Message to associate with this commit.")
+
+def argparser_diff_tree(argsp):
+    argsp.add_argument("-r",
+                       dest="recursive",
+                       action="store_true",
+                       help="Recurse into sub-trees")
+
+    argsp.add_argument("-M",
+                       dest="renames",
+                       action="store_const",
+                       const="50",
+                       help="Detect renames.")
+
+    argsp.add_argument("--find-renames",
+                       metavar="n",
+                       dest="renames",
+                       nargs="?",
+                       const="50",
+                       help="Detect renames, of files at least n%% similar (default 50).")
+
+    argsp.add_argument("-C",
+                       dest="copies",
+                       action="store_const",
+                       const="50",
+                       help="Detect copies of modified files as well as renames.")
+
+    argsp.add_argument("--find-copies",
+                       metavar="n",
+                       dest="copies",
+                       nargs="?",
+                       const="50",
+                       help="Detect copies, of files at least n%% similar (default 50).")
+
+    argsp.add_argument("old",
+                       help="The first tree-ish.")
+
+    argsp.add_argument("new",
+                       help="The second tree-ish.")
 
-argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
-argsubparsers.required = True
+def argparser_diff(argsp):
+    argsp.add_argument("--cached",
+                       action="store_true",
+                       help="Compare the index with a commit, HEAD by default.")
 
-argsp = argsubparsers.add_parser("init", help="Initialize a new, empty repository.")
+    argsp.add_argument("--name-status",
+                       dest="name_status",
+                       action="store_true",
+                       help="Show only the name and status of changed files.")
 
-argsp.add_argument("path",
-                   metavar="directory",
-                   nargs="?",
-                   default=".",
-                   help="Where to create the repository.")
+    argsp.add_argument("-U",
+                       metavar="lines",
+                       dest="context",
+                       type=int,
+                       default=3,
+                       help="Number of context lines around each change.")
 
-argsp = argsubparsers.add_parser("cat-file",
-                                 help="Provide content of repository objects")
+    argsp.add_argument("-M",
+                       dest="renames",
+                       action="store_const",
+                       const="50",
+                       help="Detect renames.")
 
-argsp.add_argument("type",
-                   metavar="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   help="Specify the type")
+    argsp.add_argument("--find-renames",
+                       metavar="n",
+                       dest="renames",
+                       nargs="?",
+                       const="50",
+                       help="Detect renames, of files at least n%% similar (default 50).")
 
-argsp.add_argument("object",
-                   metavar="object",
-                   help="The object to display")
+    argsp.add_argument("-C",
+                       dest="copies",
+                       action="store_const",
+                       const="50",
+                       help="Detect copies of modified files as well as renames.")
 
-argsp = argsubparsers.add_parser(
-    "hash-object",
-    help="Compute object ID and optionally creates a blob from a file")
+    argsp.add_argument("--find-copies",
+                       metavar="n",
+                       dest="copies",
+                       nargs="?",
+                       const="50",
+                       help="Detect copies, of files at least n%% similar (default 50).")
 
-argsp.add_argument("-t",
-                   metavar="type",
-                   dest="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   default="blob",
-                   help="Specify the type")
+    argsp.add_argument("--no-renames",
+                       dest="renames",
+                       action="store_const",
+                       const=False,
+                       help="Don't detect renames, whatever the configuration says.")
 
-argsp.add_argument("-w",
-                   dest="write",
-                   action="store_true",
-                   help="Actually write the object into the database")
+    argsp.add_argument("--diff-algorithm",
+                       metavar="algorithm",
+                       dest="algorithm",
+                       choices=["histogram", "myers"],
+                       default="histogram",
+                       help="The line diff algorithm to use.")
 
-argsp.add_argument("path",
-                   help="Read object from <file>")
+    argsp.add_argument("commits",
+                       nargs="*",
+                       help="A commit to compare the index with (with --cached), or two commits to compare.")
 
-argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
-argsp.add_argument("commit",
-                   default="HEAD",
-                   nargs="?",
-                   help="Commit to start at.")
+def argparser_daemon(argsp):
+    argsp.add_argument("--detach",
+                       action="store_true",
+                       help="Run in the background.")
 
-argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
-argsp.add_argument("-r",
-                   dest="recursive",
-                   action="store_true",
-                   help="Recurse into sub-trees")
+    argsp.add_argument("--stop",
+                       action="store_true",
+                       help="Stop the daemon serving this repository.")
 
-argsp.add_argument("tree",
-                   help="A tree-ish object.")
+def argparser_switch(argsp):
+    argsp.add_argument("-c",
+                       action="store_true",
+                       dest="create",
+                       help="Create the branch first, at start (or HEAD).")
 
-argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
+    argsp.add_argument("--detach",
+                       action="store_true",
+                       help="Switch to a commit, not to a branch.")
 
-argsp.add_argument("commit",
-                   help="The commit or tree to checkout.")
+    argsp.add_argument("branch",
+                       help="The branch (or, with --detach, commit) to switch to.")
 
-argsp.add_argument("path",
-                   help="The EMPTY directory to checkout on.")
+    argsp.add_argument("start",
+                       nargs="?",
+                       help="With -c, the commit the new branch starts from.")
 
-argsp = argsubparsers.add_parser("show-ref", help="List references.")
+def argparser_fsck(argsp):
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       help="Number of processes (default: one per core).")
 
-argsp = argsubparsers.add_parser(
-    "tag",
-    help="List and create tags")
+    argsp.add_argument("--no-dangling",
+                       action="store_false",
+                       dest="dangling",
+                       help="Don't list dangling objects.")
 
-argsp.add_argument("-a",
-                   action="store_true",
-                   dest="create_tag_object",
-                   help="Whether to create a tag object")
+def argparser_prune(argsp):
+    argsp.add_argument("-n", "--dry-run",
+                       action="store_true",
+                       help="Only list what would be removed.")
 
-argsp.add_argument("name",
-                   nargs="?",
-                   help="The new tag's name")
+    argsp.add_argument("--expire",
+                       default="2.weeks.ago",
+                       help="Only remove objects older than this (\"now\", or like \"2.weeks.ago\").")
 
-argsp.add_argument("object",
-                   default="HEAD",
-                   nargs="?",
-                   help="The object the new tag will point to")
+def argparser_clone(argsp):
+    argsp.add_argument("-s", "--shared",
+                       action="store_true",
+                       help="Borrow the objects of the repository instead of copying them.")
 
-argsp = argsubparsers.add_parser(
-    "rev-parse",
-    help="Parse revision (or other objects) identifiers")
+    argsp.add_argument("--reference",
+                       metavar="repository",
+                       action="append",
+                       default=[],
+                       help="Borrow the objects of this other repository, and only copy what it lacks.")
 
-argsp.add_argument("--wyag-type",
-                   metavar="type",
-                   dest="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   default=None,
-                   help="Specify the expected type")
+    argsp.add_argument("path",
+                       help="The repository to clone.")
 
-argsp.add_argument("name",
-                   help="The name to parse")
+    argsp.add_argument("directory",
+                       nargs="?",
+                       help="Where to clone it (default: named after the repository).")
 
-argsp = argsubparsers.add_parser("ls-files", help = "List all the stage files")
-argsp.add_argument("--verbose", action="store_true", help="Show everything.")
+def argparser_fetch(argsp):
+    argsp.add_argument("remote",
+                       nargs="?",
+                       default="origin",
+                       help="A remote, or the path of a repository.")
 
-argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
-argsp.add_argument("path", nargs="+", help="Paths to check")
+def argparser_pack_refs(argsp):
+    argsp.add_argument("--all",
+                       action="store_true",
+                       help="Pack all refs, not only tags and refs already packed.")
 
-argsp = argsubparsers.add_parser("status", help = "Show the working tree status.")
+    argsp.add_argument("--no-prune",
+                       action="store_false",
+                       dest="prune",
+                       help="Keep the loose refs.")
 
-argsp = argsubparsers.add_parser("rm", help="Remove files from the working tree and the index.")
-argsp.add_argument("path", nargs="+", help="Files to remove")
+def argparser_update_ref(argsp):
+    argsp.add_argument("--stdin",
+                       action="store_true",
+                       help="Read create/update/delete/verify commands from stdin, and apply them all or none.")
 
-argsp = argsubparsers.add_parser("add", help = "Add files contents to the index.")
-argsp.add_argument("path", nargs="+", help="Files to add")
+    argsp.add_argument("-d",
+                       action="store_true",
+                       dest="delete",
+                       help="Delete the ref.")
 
-argsp = argsubparsers.add_parser("commit", help="Record changes to the repository.")
+    argsp.add_argument("ref",
+                       nargs="?",
+                       help="The ref to update.")
 
-argsp.add_argument("-m",
-                   metavar="message",
-                   dest="message",
-                   help="Message to associate with this commit.")
+    argsp.add_argument("values",
+                       nargs="*",
+                       help="The new value, then the value the ref must have now (only the latter with -d).")
+
+def argparser_archive(argsp):
+    argsp.add_argument("--format",
+                       choices=["tar", "tar.gz", "zip"],
+                       help="Archive format (default: from the -o file name, else tar).")
+
+    argsp.add_argument("--prefix",
+                       default="",
+                       help="Prepend this to every path (eg, \"project/\").")
+
+    argsp.add_argument("-o", "--output",
+                       help="Write the archive to this file instead of stdout.")
+
+    argsp.add_argument("tree",
+                       help="The commit or tree to archive.")
+
+def argparser_grep(argsp):
+    argsp.add_argument("-i", "--ignore-case",
+                       action="store_true",
+                       help="Match regardless of case.")
+
+    argsp.add_argument("-n", "--line-number",
+                       action="store_true",
+                       help="Show line numbers.")
+
+    argsp.add_argument("-l", "--files-with-matches",
+                       action="store_true",
+                       help="Only show the names of files that match.")
+
+    argsp.add_argument("-c", "--count",
+                       action="store_true",
+                       help="Show the number of matching lines of each file.")
+
+    argsp.add_argument("--cached",
+                       action="store_true",
+                       help="Search the index instead of the worktree.")
+
+    argsp.add_argument("-j", "--jobs",
+                       type=int,
+                       help="Number of processes (default: one per core).")
+
+    argsp.add_argument("pattern",
+                       help="A (Python) regular expression.")
+
+    argsp.add_argument("args",
+                       nargs="*",
+                       metavar="[tree-ish] [--] path",
+                       help="A commit or tree to search instead of the worktree, then paths to search under.")
+
+def argparser_blame(argsp):
+    argsp.add_argument("-l",
+                       dest="long",
+                       action="store_true",
+                       help="Show full commit SHAs.")
+
+    argsp.add_argument("-s",
+                       dest="suppress",
+                       action="store_true",
+                       help="Don't show the author and date.")
+
+    argsp.add_argument("path",
+                       help="The file to blame.")
+
+    argsp.add_argument("commit",
+                       default="HEAD",
+                       nargs="?",
+                       help="The commit to blame the file as of.")
+
+def argparser_merge_base(argsp):
+    argsp.add_argument("-a", "--all",
+                       action="store_true",
+                       help="Print all the best common ancestors, not just one.")
+
+    argsp.add_argument("--is-ancestor",
+                       dest="is_ancestor",
+                       action="store_true",
+                       help="Exit with 0 if the first commit is an ancestor of the second, 1 otherwise.")
+
+    argsp.add_argument("commits",
+                       nargs="+",
+                       metavar="commit",
+                       help="Two commits or more: the common ancestors of the first and any of the others.")
+
+def argparser_bundle(argsp):
+    argsp.add_argument("action",
+                       choices=["create", "unbundle"],
+                       help="Write a bundle, or add the objects of one to the repository.")
+
+    argsp.add_argument("file",
+                       help="The bundle file.")
+
+    argsp.add_argument("revs",
+                       nargs="*",
+                       metavar="rev",
+                       help="With create, what to bundle, as for rev-list: <branch>, ^<commit>, <a>..<b>.")
+
+def argparser_merge_tree(argsp):
+    argsp.add_argument("commits",
+                       nargs="+",
+                       metavar="commit",
+                       help="[<base>] <ours> <theirs>: the commits (or trees) to merge, and their common ancestor, by default their merge base.")
+
+def argparser_merge(argsp):
+    argsp.add_argument("-m",
+                       metavar="message",
+                       dest="message",
+                       help="Message of the merge commit.")
+
+    argsp.add_argument("--ff-only",
+                       dest="ff_only",
+                       action="store_true",
+                       help="Only fast-forward; fail if a merge commit is needed.")
+
+    argsp.add_argument("--no-ff",
+                       dest="no_ff",
+                       action="store_true",
+                       help="Always create a merge commit, even if HEAD could fast-forward.")
+
+    argsp.add_argument("commit",
+                       help="The commit to merge into HEAD.")
+
+def argparser_rev_list(argsp):
+    argsp.add_argument("--count",
+                       action="store_true",
+                       help="Only print the number of commits.")
+
+    argsp.add_argument("revs",
+                       nargs="+",
+                       metavar="rev",
+                       help="Commits to list the history of; ^<commit> or <commit>..<commit> to leave out what's reachable from one.")
+
+def argparser_sparse_checkout(argsp):
+    argsp.add_argument("action",
+                       choices=["set", "list", "disable"],
+                       help="Set the directories to check out, list them, or check out everything again.")
+
+    argsp.add_argument("dirs",
+                       nargs="*",
+                       help="With set, the directories to check out.")
+
+# Each command, with its help line and the function declaring its
+# arguments, in the order --help lists them.
+COMMANDS = {
+    "init"         : ("Initialize a new, empty repository.", argparser_init),
+    "cat-file"     : ("Provide content of repository objects", argparser_cat_file),
+    "hash-object"  : ("Compute object ID and optionally creates a blob from a file", argparser_hash_object),
+    "log"          : ("Display history of a given commit.", argparser_log),
+    "ls-tree"      : ("Pretty-print a tree object.", argparser_ls_tree),
+    "checkout"     : ("Checkout a commit inside of a directory, or switch the worktree to it.", argparser_checkout),
+    "show-ref"     : ("List references.", argparser_show_ref),
+    "tag"          : ("List and create tags", argparser_tag),
+    "rev-parse"    : ("Parse revision (or other objects) identifiers", argparser_rev_parse),
+    "ls-files"     : ("List all the stage files", argparser_ls_files),
+    "check-ignore" : ("Check path(s) against ignore rules.", argparser_check_ignore),
+    "status"       : ("Show the working tree status.", argparser_status),
+    "rm"           : ("Remove files from the working tree and the index.", argparser_rm),
+    "add"          : ("Add files contents to the index.", argparser_add),
+    "commit"       : ("Record changes to the repository.", argparser_commit),
+    "diff-tree"    : ("Compare the content and mode of blobs found via two tree objects.", argparser_diff_tree),
+    "diff"         : ("Show changes between the worktree, the index and commits.", argparser_diff),
+    "daemon"       : ("Serve read-only commands for this repository, keeping it loaded.", argparser_daemon),
+    "switch"       : ("Switch the worktree to a branch.", argparser_switch),
+    "fsck"         : ("Verify the objects of the repository, and their connectivity.", argparser_fsck),
+    "prune"        : ("Remove unreachable loose objects.", argparser_prune),
+    "clone"        : ("Clone a repository from a local path.", argparser_clone),
+    "fetch"        : ("Fetch branches and tags from another local repository.", argparser_fetch),
+    "pack-refs"    : ("Pack references into .git/packed-refs.", argparser_pack_refs),
+    "update-ref"   : ("Update references safely, one or many at once.", argparser_update_ref),
+    "archive"      : ("Export a tree as a tar or zip archive.", argparser_archive),
+    "grep"         : ("Search the worktree, the index or a tree.", argparser_grep),
+    "blame"        : ("Show what commit last changed each line of a file.", argparser_blame),
+    "merge-base"   : ("Find the best common ancestors of commits.", argparser_merge_base),
+    "rev-list"     : ("List commits reachable from some commits and not others.", argparser_rev_list),
+    "merge-tree"   : ("Merge trees in the object store, without touching the worktree.", argparser_merge_tree),
+    "merge"        : ("Merge a commit into HEAD.", argparser_merge),
+    "bundle"       : ("Move history through a single file.", argparser_bundle),
+    "sparse-checkout" : ("Only check out some directories of the worktree.", argparser_sparse_checkout),
+}
 
 def cmd_init(args):
+    from git_utilities import repo_create
     repo_create(args.path)
-    
+
 def cmd_cat_file(args):
+    from git_utilities import repo_find
     repo = repo_find()
+
+    if args.batch or args.batch_check:
+        if args.type or args.object:
+            raise Exception("cat-file --batch and --batch-check take no arguments.")
+        cat_file_batch(repo, sys.stdin.fileno(), sys.stdout.buffer, contents=args.batch)
+        return
+
+    if not args.object:
+        raise Exception("cat-file requires a type and an object.")
     cat_file(repo, args.object, fmt=args.type.encode())
 
 def cat_file(repo, obj, fmt=None):
+    from git_object_helper import object_read, object_find
     obj = object_read(repo, object_find(repo, obj, fmt=fmt))
     sys.stdout.buffer.write(obj.serialize(repo))
 
+def cat_file_batch(repo, fd, out, contents=True):
+    """Read object names from file descriptor fd, one per line, and
+write "<sha> <type> <size>" for each to out, followed by the object's
+contents and a newline if contents is true; or "<name> missing".
+
+One process serves any number of requests, with the repository, its
+pack indexes and delta base cache loaded once.  Output is buffered, and
+flushed whenever we've answered every request received so far: a
+caller feeding names one at a time still gets each answer right away."""
+    import re
+    from git_object_helper import object_resolve, object_read_raw, object_read_header
+
+    sha_re = re.compile(rb"^[0-9a-f]{40}$")
+    pending = b''
+    pos = 0
+    while True:
+        end = pending.find(b'\n', pos)
+        if end == -1:
+            out.flush()
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                if pos >= len(pending):
+                    break
+                # Last name, without a newline.
+                end = len(pending)
+            else:
+                pending = pending[pos:] + chunk
+                pos = 0
+                continue
+
+        name = pending[pos:end]
+        pos = end + 1
+
+        # Full SHAs, what batch callers mostly send, skip resolving.
+        if sha_re.match(name):
+            sha = name.decode("ascii")
+        else:
+            candidates = object_resolve(repo, name.decode("utf8"))
+            if candidates and len(candidates) > 1:
+                out.write(name + b" ambiguous\n")
+                continue
+            sha = candidates[0] if candidates else None
+
+        if contents:
+            raw = object_read_raw(repo, sha) if sha else None
+            header = (raw[0], len(raw[1])) if raw else None
+        else:
+            header = object_read_header(repo, sha) if sha else None
+
+        if header is None:
+            out.write(name + b" missing\n")
+            continue
+        out.write(f"{sha} {header[0].decode("ascii")} {header[1]}\n".encode("ascii"))
+        if contents:
+            out.write(raw[1])
+            out.write(b"\n")
+    out.flush()
+
 def cmd_hash_object(args):
+    from git_utilities import repo_find
+    from git_object_helper import object_hash
+    from git_pack_helper import pack_bulk_begin, pack_bulk_end
+
+    if args.stdin_paths and args.path is not None:
+        raise Exception("Can't hash a file with --stdin-paths: list it on the standard input.")
+    if not args.stdin_paths and args.path is None:
+        raise Exception("Which file? (or use --stdin-paths)")
+
     if args.write:
         repo = repo_find()
     else:
         repo = None
 
-    with open(args.path, "rb") as fd:
-        sha = object_hash(fd, args.type.encode(), repo)
-        print(sha)
-        
+    if not args.stdin_paths:
+        with open(args.path, "rb") as fd:
+            sha = object_hash(fd, args.type.encode(), repo)
+            print(sha)
+        return
+
+    # Many files at once: write them all in a single pack.
+    if repo:
+        pack_bulk_begin(repo)
+    try:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            with open(line.rstrip("\n"), "rb") as fd:
+                print(object_hash(fd, args.type.encode(), repo))
+    finally:
+        if repo:
+            pack_bulk_end(repo)
+
 def cmd_log(args):
+    from git_utilities import repo_find, log_graphviz
+    from git_object_helper import object_find
     repo = repo_find()
 
     print("digraph wyaglog{")
     print("  node[shape=rect]")
     log_graphviz(repo, object_find(repo, args.commit), set())
     print("}")
-    
+
 def cmd_ls_tree(args):
+    from git_utilities import repo_find
+    from git_tree_helper import ls_tree
     repo = repo_find()
     ls_tree(repo, args.tree, args.recursive)
-            
+
 def cmd_checkout(args):
+    from git_utilities import repo_find
+    from git_object_helper import object_read, object_find
+    from git_tree_helper import tree_checkout
     repo = repo_find()
 
+    if args.path is None:
+        from git_ref_helper import ref_resolve
+        from git_switch_helper import switch
+        # A branch is checked out as such, anything else detached.
+        if ref_resolve(repo, "refs/heads/" + args.commit):
+            switch(repo, args.commit, "ref: refs/heads/" + args.commit)
+        else:
+            switch(repo, args.commit, object_find(repo, args.commit, fmt=b"commit"))
+        return
+
     obj = object_read(repo, object_find(repo, args.commit))
 
     # If the object is a commit, we grab its tree
@@ -208,15 +777,386 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
+    # Directories outside of the sparse checkout are skipped.
+    from git_sparse_helper import sparse_cone
+    tree_checkout(repo, obj, os.path.realpath(args.path), sparse_cone(repo))
+
+
+def cmd_fsck(args):
+    from git_utilities import repo_find
+    from git_fsck_helper import fsck
+    repo = repo_find()
+
+    (corrupt, missing, dangling) = fsck(repo, args.jobs)
+    for (sha, reason) in corrupt:
+        print(f"error: {sha}: {reason}")
+    for (fmt, sha) in missing:
+        print(f"missing {fmt} {sha}")
+    if args.dangling:
+        for (fmt, sha) in dangling:
+            print(f"dangling {fmt} {sha}")
+    if corrupt or missing:
+        sys.exit(1)
+
+def cmd_prune(args):
+    from git_utilities import repo_find
+    from git_prune_helper import prune
+    repo = repo_find()
+
+    (pruned, stats) = prune(repo, args.expire, args.dry_run)
+    if args.dry_run:
+        for (sha, fmt) in pruned:
+            print(f"{sha} {fmt}")
+    print(f"{'Would prune' if args.dry_run else 'Pruned'} {stats['pruned']} of {stats['loose']} loose objects"
+          f" ({stats['bytes'] / 1024:.1f} KiB), {stats['reachable']} reachable,"
+          f" {stats['recent']} unreachable but recent, {stats['temporary']} temporary files.")
+
+def cmd_clone(args):
+    from git_fetch_helper import clone
+    directory = args.directory or os.path.basename(os.path.realpath(args.path)).removesuffix(".git")
+    print(f"Cloning into '{directory}'...")
+    (_, count) = clone(args.path, directory, args.shared, args.reference)
+    print(f"Received {count} objects.")
+
+def cmd_fetch(args):
+    from git_utilities import repo_find
+    from git_fetch_helper import remote_find, fetch
+    repo = repo_find()
+
+    (remote, path) = remote_find(repo, args.remote)
+    (updates, count) = fetch(repo, remote, path)
+    if not updates:
+        return
+    print(f"From {path}")
+    for (theirs, ours, old, new) in updates:
+        theirs = theirs.split("/", 2)[2]
+        short = ours.split("/", 2)[2]
+        if old:
+            print(f"   {old[:7]}..{new[:7]}  {theirs} -> {short}")
+        elif ours.startswith("refs/tags/"):
+            print(f" * [new tag]         {theirs} -> {short}")
+        else:
+            print(f" * [new branch]      {theirs} -> {short}")
+    print(f"Received {count} objects.")
+
+def cmd_pack_refs(args):
+    from git_utilities import repo_find
+    from git_ref_helper import ref_pack
+    repo = repo_find()
+    ref_pack(repo, everything=args.all, prune=args.prune)
+
+def cmd_update_ref(args):
+    from git_utilities import repo_find
+    from git_ref_helper import ref_updates_parse, ref_transaction
+    repo = repo_find()
+
+    if args.stdin:
+        if args.ref or args.delete:
+            raise Exception("--stdin takes its commands from stdin only.")
+        text = sys.stdin.read()
+    elif not args.ref:
+        raise Exception("Which ref?")
+    elif args.delete:
+        if len(args.values) > 1:
+            raise Exception("-d takes at most the old value.")
+        text = " ".join([ "delete", args.ref ] + args.values)
+    else:
+        if not 1 <= len(args.values) <= 2:
+            raise Exception("Give the new value, and maybe the old one.")
+        text = " ".join([ "update", args.ref ] + args.values)
+    ref_transaction(repo, ref_updates_parse(repo, text))
+
+def cmd_archive(args):
+    from git_utilities import repo_find
+    from git_archive_helper import archive
+    repo = repo_find()
+
+    fmt = args.format
+    if fmt is None:
+        fmt = "tar"
+        if args.output:
+            for (suffix, f) in ((".tar.gz", "tar.gz"), (".tgz", "tar.gz"), (".zip", "zip")):
+                if args.output.endswith(suffix):
+                    fmt = f
+
+    if args.output:
+        with open(args.output, "wb") as out:
+            archive(repo, args.tree, out, fmt, args.prefix)
+    else:
+        archive(repo, args.tree, sys.stdout.buffer, fmt, args.prefix)
+        sys.stdout.buffer.flush()
+
+def cmd_grep(args):
+    from git_utilities import repo_find
+    from git_object_helper import object_find
+    from git_grep_helper import grep_files, grep
+    repo = repo_find()
+
+    # Like git, the first argument is a tree-ish, unless it's a path.
+    rest = args.args
+    tree = None
+    name = None
+    if rest and not os.path.exists(rest[0]):
+        try:
+            tree = object_find(repo, rest[0], fmt=b"tree")
+            (name, rest) = (rest[0], rest[1:])
+        except Exception:
+            pass
+    if tree is not None and args.cached:
+        raise Exception("--cached and a tree-ish can't go together.")
+    paths = [ os.path.relpath(os.path.realpath(p), repo.worktree).replace(os.sep, "/") for p in rest ]
+    paths = [ "" if p == "." else p for p in paths ]
+    if "" in paths:
+        paths = None # The whole worktree.
+
+    files = grep_files(repo, tree, args.cached, paths)
+    out = sys.stdout.buffer
+    for (path, matches) in grep(repo, args.pattern, files, args.ignore_case, args.jobs):
+        path = (f"{name}:{path}" if name else path).encode("utf8")
+        if args.files_with_matches:
+            out.write(path + b"\n")
+        elif args.count:
+            out.write(path + b":" + str(len(matches)).encode() + b"\n")
+        else:
+            for (lineno, line) in matches:
+                if args.line_number:
+                    out.write(path + b":" + str(lineno).encode() + b":" + line + b"\n")
+                else:
+                    out.write(path + b":" + line + b"\n")
+    out.flush()
+
+def cmd_bundle(args):
+    from git_utilities import repo_find
+    repo = repo_find()
+
+    match args.action:
+        case "create":
+            from git_revlist_helper import rev_range_parse
+            from git_bundle_helper import bundle_create
+            if not args.revs:
+                raise Exception("What to bundle?")
+            (include, exclude) = rev_range_parse(repo, args.revs)
+            (refs, prerequisites, count) = bundle_create(repo, args.file, include, exclude)
+            print(f"Wrote {count} objects, {len(refs)} refs and {len(prerequisites)} prerequisites to {args.file}.")
+        case "unbundle":
+            from git_bundle_helper import bundle_unbundle
+            (refs, _) = bundle_unbundle(repo, args.file)
+            for (ref, sha) in refs:
+                print(f"{sha} {ref}")
+
+def cmd_blame(args):
+    from datetime import datetime, timezone
+    from git_utilities import repo_find
+    from git_object_helper import object_find
+    from git_blame_helper import blame
+    repo = repo_find()
+
+    path = os.path.relpath(os.path.realpath(args.path), repo.worktree).replace(os.sep, "/")
+    (lines, commits) = blame(repo, path, object_find(repo, args.commit, fmt=b"commit"))
+    if not lines:
+        return # An empty file: nothing to blame.
+
+    # Author lines are "<name> <<email>> <timestamp> <tz>".
+    authors = dict()
+    for (sha, c) in commits.items():
+        ident = c.kvlm[b'author'].decode("utf8")
+        (name, rest) = ident.rsplit(" <", 1)
+        (timestamp, tz) = rest.split("> ")[1].split()
+        offset = (-1 if tz[0] == "-" else 1) * (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60)
+        date = datetime.fromtimestamp(int(timestamp) + offset, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        authors[sha] = (name, f"{date} {tz}")
+
+    # As git does: root commits are marked with a ^, and the path is
+    # shown if the file had another one.
+    name_width = max(len(name) for (name, _) in authors.values())
+    show_path = any(p != path for (_, p, _, _) in lines)
+    path_width = max(len(p) for (_, p, _, _) in lines)
+    digits = len(str(len(lines)))
+    out = sys.stdout.buffer
+    for (n, (sha, spath, _, line)) in enumerate(lines):
+        if b'parent' in commits[sha].kvlm:
+            head = sha if args.long else sha[:8]
+        else:
+            head = "^" + (sha[:39] if args.long else sha[:7])
+        if show_path:
+            head += f" {spath:<{path_width}}"
+        if not args.suppress:
+            (name, date) = authors[sha]
+            head += f" ({name:<{name_width}} {date}"
+        out.write(f"{head} {n + 1:>{digits}}) ".encode("utf8") + line.rstrip(b"\n") + b"\n")
+    out.flush()
+
+def cmd_merge_base(args):
+    from git_utilities import repo_find
+    from git_object_helper import object_find
+    from git_revlist_helper import merge_bases, is_ancestor
+    repo = repo_find()
+
+    commits = [ object_find(repo, c, fmt=b"commit") for c in args.commits ]
+    if args.is_ancestor:
+        if len(commits) != 2:
+            raise Exception("--is-ancestor takes two commits.")
+        sys.exit(0 if is_ancestor(repo, commits[0], commits[1]) else 1)
+    if len(commits) < 2:
+        raise Exception("merge-base takes two commits or more.")
+
+    bases = merge_bases(repo, commits[0], commits[1:])
+    if not bases:
+        sys.exit(1)
+    for sha in bases if args.all else bases[:1]:
+        print(sha)
+
+def cmd_merge_tree(args):
+    from git_utilities import repo_find
+    from git_objects import GitTree
+    from git_object_helper import object_find, object_write
+    from git_merge_helper import merge_trees
+    repo = repo_find()
+
+    names = args.commits
+    if len(names) == 2:
+        from git_revlist_helper import merge_bases
+        (ours, theirs) = (object_find(repo, n, fmt=b"commit") for n in names)
+        bases = merge_bases(repo, ours, [ theirs ])
+        base = bases[0] if bases else None
+    elif len(names) == 3:
+        (base, ours, theirs) = names
+        names = names[1:]
+    else:
+        raise Exception("merge-tree takes [<base>] <ours> <theirs>.")
+
+    trees = [ object_find(repo, x, fmt=b"tree") if x else None for x in (base, ours, theirs) ]
+    (tree, conflicts) = merge_trees(repo, *trees, labels=names)
+    print(tree or object_write(GitTree(), repo))
+    for (kind, path) in conflicts:
+        print(f"CONFLICT ({kind}): {path}")
+    if conflicts:
+        sys.exit(1)
+
+def cmd_merge(args):
+    from datetime import datetime
+    from git_utilities import repo_find
+    from git_objects import GitTree
+    from git_object_helper import object_find, object_write
+    from git_ref_helper import ref_read, ref_symbolic, ref_transaction
+    from git_revlist_helper import merge_bases
+    from git_switch_helper import switch
+    repo = repo_find()
 
+    head = object_find(repo, "HEAD", fmt=b"commit")
+    other = object_find(repo, args.commit, fmt=b"commit")
+    bases = merge_bases(repo, head, [ other ])
+    if other in bases:
+        print("Already up to date.")
+        return
+
+    # The worktree follows, from HEAD's tree to the new one: switch
+    # checks that no local change is in the way first.
+    if head in bases and not args.no_ff:
+        print(f"Updating {head[:7]}..{other[:7]}")
+        print("Fast-forward")
+        switch(repo, other, ref_read(repo, "HEAD"))
+        ref_transaction(repo, [ ("HEAD", other, head) ])
+        return
+    if args.ff_only:
+        raise Exception("Not possible to fast-forward, aborting.")
+
+    from git_merge_helper import merge_trees
+    from git_commit_helper import commit_create, gitconfig_read, gitconfig_user_get
+    if len(bases) > 1:
+        print(f"Several merge bases, using {bases[0][:7]}.")
+    base = object_find(repo, bases[0], fmt=b"tree") if bases else None
+    (tree, conflicts) = merge_trees(repo, base, object_find(repo, head, fmt=b"tree"),
+                                    object_find(repo, other, fmt=b"tree"), ("HEAD", args.commit))
+    if conflicts:
+        # There's no half-merged state to resolve them in: nothing
+        # changes.
+        for (kind, path) in conflicts:
+            print(f"CONFLICT ({kind}): {path}")
+        print("Automatic merge failed; nothing was changed.")
+        sys.exit(1)
+
+    branch = ref_symbolic(repo, "HEAD")
+    message = args.message or f"Merge {'branch' if branch else 'commit'} '{args.commit}'"
+    commit = commit_create(repo, tree or object_write(GitTree(), repo), [ head, other ],
+                           gitconfig_user_get(gitconfig_read()), datetime.now(), message)
+    switch(repo, commit, ref_read(repo, "HEAD"))
+    ref_transaction(repo, [ ("HEAD", commit, head) ])
+    print(f"Merge made, {commit[:7]}.")
+
+def cmd_rev_list(args):
+    from git_utilities import repo_find
+    from git_revlist_helper import rev_list, rev_range_parse
+    repo = repo_find()
+
+    (include, exclude) = rev_range_parse(repo, args.revs)
+    commits = rev_list(repo, [ sha for (_, sha) in include ], exclude)
+    if args.count:
+        print(len(commits))
+    else:
+        sys.stdout.write("".join(sha + "\n" for sha in commits))
+
+def cmd_switch(args):
+    from git_utilities import repo_find
+    from git_object_helper import object_find
+    from git_ref_helper import ref_resolve, ref_transaction, REF_ZERO
+    from git_switch_helper import switch
+    repo = repo_find()
+
+    if args.detach:
+        switch(repo, args.branch, object_find(repo, args.branch, fmt=b"commit"))
+        return
+
+    if args.create:
+        if ref_resolve(repo, "refs/heads/" + args.branch):
+            raise Exception(f"A branch named {args.branch} already exists.")
+        start = object_find(repo, args.start or "HEAD", fmt=b"commit")
+        # The branch first: HEAD must never point to a branch that
+        # doesn't exist.  If the switch fails, it goes away again.
+        ref = "refs/heads/" + args.branch
+        ref_transaction(repo, [ (ref, start, REF_ZERO) ])
+        try:
+            switch(repo, start, "ref: " + ref)
+        except BaseException:
+            ref_transaction(repo, [ (ref, None, start) ])
+            raise
+        return
+
+    if args.start:
+        raise Exception("A start commit only makes sense with -c.")
+    if not ref_resolve(repo, "refs/heads/" + args.branch):
+        raise Exception(f"No such branch {args.branch} (use --detach for a commit).")
+    switch(repo, args.branch, "ref: refs/heads/" + args.branch)
+
+def cmd_sparse_checkout(args):
+    from git_utilities import repo_find
+    from git_sparse_helper import sparse_cone, sparse_set, sparse_disable
+    repo = repo_find()
+
+    match args.action:
+        case "set":
+            if not args.dirs:
+                raise Exception("Which directories?")
+            sparse_set(repo, args.dirs)
+        case "list":
+            cone = sparse_cone(repo)
+            if cone is None:
+                raise Exception("This worktree is not sparse.")
+            for d in sorted(cone):
+                print(d)
+        case "disable":
+            sparse_disable(repo)
 
 def cmd_show_ref(args):
+    from git_utilities import repo_find
+    from git_ref_helper import ref_list, show_ref
     repo = repo_find()
     refs = ref_list(repo)
-    show_ref(repo, refs, prefix="refs")
-    
+    show_ref(repo, refs, prefix="refs", dereference=args.dereference)
+
 def cmd_tag(args):
+    from git_utilities import repo_find
+    from git_ref_helper import ref_list, show_ref, tag_create
     repo = repo_find()
 
     if args.name:
@@ -226,9 +1166,12 @@ def cmd_tag(args):
                    create_tag_object = args.create_tag_object)
     else:
         refs = ref_list(repo)
-        show_ref(repo, refs["tags"], with_hash=False)
+        show_ref(repo, refs.get("tags", {}), with_hash=False)
 
 def cmd_rev_parse(args):
+    from git_utilities import repo_find
+    from git_object_helper import object_find
+
     if args.type:
         fmt = args.type.encode()
     else:
@@ -240,9 +1183,13 @@ def cmd_rev_parse(args):
 
 
 def cmd_ls_files(args):
+    from git_utilities import repo_find
+    from git_index_helper import index_read
     repo = repo_find()
     index = index_read(repo)
     if args.verbose:
+        from datetime import datetime
+        import grp, pwd
         print(f"Index file format v{index.version}, containing {len(index.entries)} entries.")
 
     for e in index.entries:
@@ -250,23 +1197,29 @@ def cmd_ls_files(args):
         if args.verbose:
             entry_type = { 0b1000: "regular file",
                            0b1010: "symlink",
-                           0b1110: "git link" }[e.mode_type]
+                           0b1110: "git link",
+                           0b0100: "sparse directory" }[e.mode_type]
             print(f"  {entry_type} with perms: {e.mode_perms:o}")
             print(f"  on blob: {e.sha}")
             print(f"  created: {datetime.fromtimestamp(e.ctime[0])}.{e.ctime[1]}, modified: {datetime.fromtimestamp(e.mtime[0])}.{e.mtime[1]}")
             print(f"  device: {e.dev}, inode: {e.ino}")
             print(f"  user: {pwd.getpwuid(e.uid).pw_name} ({e.uid})  group: {grp.getgrgid(e.gid).gr_name} ({e.gid})")
-            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid}")
-            
+            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid} skip_worktree={e.flag_skip_worktree}")
+
 
 def cmd_check_ignore(args):
+    from git_utilities import repo_find
+    from git_gitignore_helper import gitignore_read, check_ignore
     repo = repo_find()
     rules = gitignore_read(repo)
     for path in args.path:
         if check_ignore(rules, path):
             print(path)
-            
+
 def cmd_status(_):
+    from git_utilities import repo_find
+    from git_index_helper import index_read
+    from git_status_helper import cmd_status_branch, cmd_status_head_index, cmd_status_index_worktree
     repo = repo_find()
     index = index_read(repo)
 
@@ -274,34 +1227,131 @@ def cmd_status(_):
     cmd_status_head_index(repo, index)
     print()
     cmd_status_index_worktree(repo, index)
-    
+
 def cmd_rm(args):
+    from git_utilities import repo_find
+    from git_add_rm import rm
     repo = repo_find()
     rm(repo, args.path)
-    
+
 def cmd_add(args):
+    from git_utilities import repo_find
+    from git_add_rm import add
     repo = repo_find()
     add(repo, args.path)
 
 def cmd_commit(args):
+    from datetime import datetime
+    from git_utilities import repo_find
+    from git_index_helper import index_read, index_write, index_locked
+    from git_object_helper import object_find, object_batch_begin, object_batch_end
+    from git_commit_helper import tree_from_index, commit_create, gitconfig_read, gitconfig_user_get
+    from git_ref_helper import ref_transaction, REF_ZERO
     repo = repo_find()
-    index = index_read(repo)
-    # Create trees, grab back SHA for the root tree.
-    tree = tree_from_index(repo, index)
-
-    # Create the commit object itself
-    commit = commit_create(repo,
-                           tree,
-                           object_find(repo, "HEAD"),
-                           gitconfig_user_get(gitconfig_read()),
-                           datetime.now(),
-                           args.message)
-
-    # Update HEAD so our commit is now the tip of the active branch.
-    active_branch = branch_get_active(repo)
-    if active_branch: # If we're on a branch, we update refs/heads/BRANCH
-        with open(repo_file(repo, os.path.join("refs/heads", active_branch)), "w") as fd:
-            fd.write(commit + "\n")
-    else: # Otherwise, we update HEAD itself.
-        with open(repo_file(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
\ No newline at end of file
+    with index_locked(repo):
+        index = index_read(repo)
+        parent = object_find(repo, "HEAD")
+
+        # All new objects are written as a single batch, so with batch
+        # fsync they're made durable together, before the index and the
+        # branch point to them.
+        object_batch_begin(repo)
+        try:
+            # Create trees, grab back SHA for the root tree.
+            tree = tree_from_index(repo, index)
+
+            # Create the commit object itself
+            commit = commit_create(repo,
+                                   tree,
+                                   parent,
+                                   gitconfig_user_get(gitconfig_read()),
+                                   datetime.now(),
+                                   args.message)
+        finally:
+            object_batch_end(repo)
+
+        # Save the cache-tree tree_from_index just filled.
+        index_write(repo, index)
+
+    # Update HEAD so our commit is now the tip of the active branch (or
+    # HEAD itself, if detached), unless another commit got there since
+    # we read it: ours would then drop it from history.
+    ref_transaction(repo, [ ("HEAD", commit, parent or REF_ZERO) ])
+
+def cmd_diff_tree(args):
+    from git_utilities import repo_find
+    from git_object_helper import object_find
+    from git_tree_helper import tree_diff
+    repo = repo_find()
+    old = object_find(repo, args.old, fmt=b"tree")
+    new = object_find(repo, args.new, fmt=b"tree")
+
+    changes = tree_diff(repo, old, new, args.recursive)
+    if args.renames or args.copies:
+        from git_diff_helper import diff_renames, diff_threshold
+        changes = diff_renames(repo, changes, diff_threshold(args.renames or args.copies), args.copies is not None)
+
+    for change in changes:
+        (status, path, old_mode, old_sha, new_mode, new_sha) = change[:6]
+        old_mode = (old_mode or b"000000").decode("ascii")
+        new_mode = (new_mode or b"000000").decode("ascii")
+        if status in ("R", "C"):
+            # The score, and both paths.
+            (status, path) = (f"{status}{change[7]:03}", f"{change[6]}\t{path}")
+        print(f":{old_mode} {new_mode} {old_sha or '0' * 40} {new_sha or '0' * 40} {status}\t{path}")
+
+def cmd_diff(args):
+    from git_utilities import repo_find
+    from git_index_helper import index_read
+    from git_object_helper import object_find
+    from git_ref_helper import ref_resolve
+    from git_tree_helper import tree_diff, tree_index_diff
+    from git_status_helper import index_worktree_diff
+    from git_diff_helper import diff_patch, diff_renames, diff_renames_enabled, diff_threshold
+    repo = repo_find()
+    worktree = False
+
+    if args.cached:
+        if len(args.commits) > 1:
+            raise Exception("diff --cached takes at most one commit.")
+        commit = args.commits[0] if args.commits else "HEAD"
+        if commit == "HEAD" and not ref_resolve(repo, "HEAD"):
+            tree = None # No commits yet: everything is added.
+        else:
+            tree = object_find(repo, commit, fmt=b"tree")
+        changes = tree_index_diff(repo, tree, index_read(repo))
+    elif len(args.commits) == 2:
+        changes = tree_diff(repo,
+                            object_find(repo, args.commits[0], fmt=b"tree"),
+                            object_find(repo, args.commits[1], fmt=b"tree"))
+    elif not args.commits:
+        changes = index_worktree_diff(repo, index_read(repo))
+        worktree = True
+    else:
+        raise Exception("Comparing the worktree with a commit is not supported.")
+
+    # The worktree has no additions to pair.
+    if not worktree and (args.renames or args.copies or (args.renames is None and diff_renames_enabled(repo))):
+        changes = diff_renames(repo, changes, diff_threshold(args.renames or args.copies or "50"), args.copies is not None)
+
+    if args.name_status:
+        for change in changes:
+            if change[0] in ("R", "C"):
+                print(f"{change[0]}{change[7]:03}\t{change[6]}\t{change[1]}")
+            else:
+                print(f"{change[0]}\t{change[1]}")
+        return
+
+    # Patches are written as they're computed, so the first files
+    # show up before the last ones are even read.
+    out = sys.stdout.buffer
+    for change in changes:
+        for chunk in diff_patch(repo, change, worktree, args.context, args.algorithm):
+            out.write(chunk)
+
+def cmd_daemon(args):
+    from git_daemon import daemon_run, daemon_stop
+    if args.stop:
+        daemon_stop()
+    else:
+        daemon_run(args.detach)
@@ -0,0 +1,232 @@
+from git_objects import GitTree, GitTreeLeaf, GitBlob
+from git_object_helper import object_read, object_write
+from git_diff_helper import diff_split_lines, diff_is_binary, diff_blocks
+from git_trace_helper import trace_region, trace_counters
+
+# Three-way merges of trees, in the object store only.  The three trees
+# are walked together, and a subtree that's the same on two sides is
+# settled by its SHA, without reading it: if only one side changed it,
+# that side's tree is taken whole.  Only the directories both sides
+# changed are read, and only the files both sides changed are merged
+# line by line, so merging two branches that touched a few files each
+# costs a few trees, whatever the size of the tree.
+#
+# Conflicts don't stop the merge: the file gets conflict markers (or,
+# if it can't be merged, our version) in the tree, and is reported.
+
+MERGE_MARKER_SIZE = 7
+
+# Conflicts this many unchanged lines apart, or less, are joined.
+MERGE_CONFLICT_GAP = 3
+
+def merge_trees(repo, base, ours, theirs, labels=("ours", "theirs")):
+    """Merge trees ours and theirs, from their common ancestor tree base
+(any of them can be None, for an empty tree).  Return (tree, conflicts):
+the SHA of the merged tree, None if empty, and a list of (kind, path)
+for the paths with conflicts, kind being "content", "modify/delete",
+"add/add", "mode" or "file/directory".  labels name ours and theirs in
+conflict markers."""
+    conflicts = list()
+    with trace_region("merge/trees"):
+        tree = merge_tree_dir(repo, base, ours, theirs, "", labels, conflicts)
+    return (tree, conflicts)
+
+def merge_tree_dir(repo, base, ours, theirs, prefix, labels, conflicts):
+    # Settled by SHA: the same on both sides, or changed on one only.
+    if ours == theirs:
+        return ours
+    if base == ours:
+        return theirs
+    if base == theirs:
+        return ours
+
+    (b, o, t) = (merge_tree_read(repo, sha) for sha in (base, ours, theirs))
+    tree = GitTree()
+    for name in sorted(set(b) | set(o) | set(t)):
+        leaf = merge_tree_entry(repo, b.get(name), o.get(name), t.get(name),
+                                prefix + name, labels, conflicts)
+        if leaf is not None:
+            tree.items.append(GitTreeLeaf(leaf[0], name, leaf[1]))
+    if not tree.items:
+        return None # Everything in it was deleted.
+    return object_write(tree, repo)
+
+def merge_tree_read(repo, sha):
+    """Return the entries of tree sha as a dict name -> (mode, sha)."""
+    if sha is None:
+        return dict()
+    if trace_counters is not None:
+        trace_counters["merge_trees_read"] += 1
+    return { leaf.path: (leaf.mode, leaf.sha) for leaf in object_read(repo, sha).items }
+
+def merge_tree_entry(repo, b, o, t, path, labels, conflicts):
+    """Merge one entry, (mode, sha) or None on each side.  Return the
+merged (mode, sha), or None if it's gone."""
+    if o == t:
+        return o
+    if b == o:
+        return t
+    if b == t:
+        return o
+
+    def is_tree(e):
+        return e is not None and e[0].startswith(b"04")
+    if is_tree(o) or is_tree(t):
+        if (o is None or is_tree(o)) and (t is None or is_tree(t)):
+            # A directory on both sides, or deleted on one: merge what's
+            # inside, so changes on the other side are reported.
+            sha = merge_tree_dir(repo, b[1] if is_tree(b) else None, o and o[1], t and t[1],
+                                 path + "/", labels, conflicts)
+            return (b"040000", sha) if sha else None
+        conflicts.append(("file/directory", path))
+        return o or t
+
+    if is_tree(b):
+        b = None # A directory replaced by files on both sides.
+    if o is None or t is None:
+        # Changed on one side, deleted on the other: keep the changes.
+        conflicts.append(("modify/delete", path))
+        return o or t
+
+    # Changed on both sides: modes and contents each merge on their own.
+    mode = merge_pick(b and b[0], o[0], t[0])
+    if mode is None:
+        conflicts.append(("mode", path))
+        mode = o[0]
+    sha = merge_pick(b and b[1], o[1], t[1])
+    if sha is None:
+        sha = merge_blob(repo, b and b[1], o[1], t[1], mode, path, labels, conflicts)
+    return (mode, sha)
+
+def merge_pick(b, o, t):
+    """The trivial merge of one value: the side that changed it, or None
+if both changed it differently."""
+    if o == t or b == t:
+        return o
+    if b == o:
+        return t
+    return None
+
+def merge_blob(repo, base, ours, theirs, mode, path, labels, conflicts):
+    """Merge the contents of blobs ours and theirs line by line.  Return
+the SHA of the result."""
+    kind = "content" if base else "add/add"
+    if not mode.startswith(b"10"):
+        # Symlinks and submodules don't merge: keep ours.
+        conflicts.append((kind, path))
+        return ours
+
+    data = [ object_read(repo, sha).blobdata if sha else b"" for sha in (base, ours, theirs) ]
+    if any(diff_is_binary(d) for d in data):
+        conflicts.append((kind, path))
+        return ours
+    if trace_counters is not None:
+        trace_counters["merge_files"] += 1
+
+    (lines, conflicted) = merge_lines(*(diff_split_lines(d) for d in data), labels)
+    if conflicted:
+        conflicts.append((kind, path))
+    return object_write(GitBlob(b"".join(lines)), repo)
+
+def merge_lines(base, ours, theirs, labels=("ours", "theirs")):
+    """Three-way merge of the line lists ours and theirs, from base.
+Return (lines, conflicted): where both sides changed the same lines
+differently, lines has conflict markers."""
+    # The changes of each side, as (base start, base end, side start,
+    # side end, side), in base order.
+    changes = sorted([ c + (0,) for c in diff_blocks(base, ours) ] +
+                     [ c + (1,) for c in diff_blocks(base, theirs) ])
+    sides = (ours, theirs)
+
+    # The merge, as a list of parts: (None, lines) for lines no side
+    # changed, (lines,) for a change, (ours, theirs) for a conflict.
+    parts = list()
+    pos = 0
+    i = 0
+    while i < len(changes):
+        # Changes that overlap, or touch, go together.
+        (lo, hi) = changes[i][0:2]
+        j = i + 1
+        while j < len(changes) and changes[j][0] <= hi:
+            hi = max(hi, changes[j][1])
+            j += 1
+        group = changes[i:j]
+        i = j
+
+        parts.append((None, base[pos:lo]))
+        pos = hi
+        versions = list()
+        for side in (0, 1):
+            # This side's version of base[lo:hi].
+            version = list()
+            at = lo
+            for (c_lo, c_hi, s_lo, s_hi, s) in group:
+                if s == side:
+                    version.extend(base[at:c_lo])
+                    version.extend(sides[side][s_lo:s_hi])
+                    at = c_hi
+            version.extend(base[at:hi])
+            versions.append(version)
+
+        if len(set(c[4] for c in group)) == 1:
+            parts.append((versions[group[0][4]],)) # One side only.
+        elif versions[0] == versions[1]:
+            parts.append((versions[0],)) # The same change on both.
+        else:
+            merge_conflict(parts, versions[0], versions[1])
+    parts.append((None, base[pos:]))
+
+    ret = list()
+    conflicted = False
+    for part in merge_simplify(parts):
+        if len(part) == 1 or part[0] is None:
+            ret.extend(part[-1])
+            continue
+        conflicted = True
+        ret.append(b"<" * MERGE_MARKER_SIZE + b" " + labels[0].encode("utf8") + b"\n")
+        ret.extend(merge_terminated(part[0]))
+        ret.append(b"=" * MERGE_MARKER_SIZE + b"\n")
+        ret.extend(merge_terminated(part[1]))
+        ret.append(b">" * MERGE_MARKER_SIZE + b" " + labels[1].encode("utf8") + b"\n")
+    return (ret, conflicted)
+
+def merge_conflict(parts, ours, theirs):
+    """Add the conflict between lines ours and theirs to parts.  As git
+does, lines both have are taken out of it, which may split it in
+several."""
+    if not ours or not theirs:
+        parts.append((ours, theirs))
+        return
+    pos = 0
+    for (o_lo, o_hi, t_lo, t_hi) in diff_blocks(ours, theirs):
+        parts.append((None, ours[pos:o_lo]))
+        parts.append((ours[o_lo:o_hi], theirs[t_lo:t_hi]))
+        pos = o_hi
+    parts.append((None, ours[pos:]))
+
+def merge_simplify(parts):
+    """Join conflicts only a few unchanged lines apart, as git does:
+one conflict reads better than several small ones."""
+    def is_conflict(part):
+        return len(part) == 2 and part[0] is not None
+
+    ret = list()
+    for part in parts:
+        if part[0] is None and not part[1]:
+            continue
+        if is_conflict(part):
+            gap = list()
+            if len(ret) >= 2 and ret[-1][0] is None and len(ret[-1][1]) <= MERGE_CONFLICT_GAP:
+                gap = ret[-1][1]
+            if len(ret) >= 1 + bool(gap) and is_conflict(ret[-1 - bool(gap)]):
+                del ret[len(ret) - bool(gap):]
+                (o, t) = ret.pop()
+                part = (o + gap + part[0], t + gap + part[1])
+        ret.append(part)
+    return ret
+
+def merge_terminated(lines):
+    """lines, the last one ended with a newline, for a marker to follow."""
+    if lines and not lines[-1].endswith(b"\n"):
+        return lines[:-1] + [ lines[-1] + b"\n" ]
+    return lines
@@ -1,24 +1,56 @@
 
 
-import hashlib
 import os
 import zlib
 import re
 
 from git_objects import GitCommit, GitTree, GitTag, GitBlob
-from git_utilities import repo_file, repo_dir
+from git_utilities import repo_file, repo_object_dirs, repo_fsync_method, file_writeout
+from git_pack_helper import pack_object_read, pack_read_header_at, pack_find, pack_find_prefix, pack_bulk_write
+from git_trace_helper import trace_counters
+
+# hashlib and tempfile are only imported by the functions writing
+# objects: they take a while to load, and many commands only read.
 
 def object_read(repo, sha):
     """Read object sha from Git repository repo.  Return a
     GitObject whose exact type depends on the object."""
 
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
-
-    if not os.path.isfile(path):
+    raw = object_read_raw(repo, sha)
+    if not raw:
         return None
+    fmt, data = raw
 
-    with open (path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    # Pick constructor
+    match fmt:
+        case b'commit' : c=GitCommit
+        case b'tree'   : c=GitTree
+        case b'tag'    : c=GitTag
+        case b'blob'   : c=GitBlob
+        case _:
+            raise Exception(f"Unknown type {fmt.decode("ascii")} for object {sha}")
+
+    # Call constructor and return object
+    return c(data)
+
+def object_read_raw(repo, sha):
+    """Read object sha, without parsing it: return a pair (fmt, data),
+or None if there's no such object."""
+    path = object_loose_path(repo, sha)
+
+    if path is None:
+        # Not a loose object: it may be packed.
+        packed = pack_object_read(repo, sha)
+        if not packed:
+            return None
+        fmt, data = packed
+        if trace_counters is not None:
+            trace_counters["objects_read_packed"] += 1
+    else:
+        with open (path, "rb") as f:
+            raw = zlib.decompress(f.read())
+        if trace_counters is not None:
+            trace_counters["objects_read_loose"] += 1
 
         # Read object type
         x = raw.find(b' ')
@@ -29,37 +61,147 @@ def object_read(repo, sha):
         size = int(raw[x:y].decode("ascii"))
         if size != len(raw)-y-1:
             raise Exception(f"Malformed object {sha}: bad length")
+        data = raw[y+1:]
+
+    if trace_counters is not None:
+        trace_counters["bytes_inflated"] += len(data)
+    return fmt, data
 
-        # Pick constructor
-        match fmt:
-            case b'commit' : c=GitCommit
-            case b'tree'   : c=GitTree
-            case b'tag'    : c=GitTag
-            case b'blob'   : c=GitBlob
-            case _:
-                raise Exception(f"Unknown type {fmt.decode("ascii")} for object {sha}")
+def object_read_header(repo, sha):
+    """Return the type and size of object sha, as a pair (fmt, size), or
+None if there's no such object.  Only the start of the object is
+inflated."""
+    path = object_loose_path(repo, sha)
 
-        # Call constructor and return object
-        return c(raw[y+1:])
+    if path is None:
+        found = pack_find(repo, sha)
+        if not found:
+            return None
+        return pack_read_header_at(repo, *found)
+
+    # The header is the first few bytes: inflate until we have it.
+    d = zlib.decompressobj()
+    head = b''
+    with open(path, "rb") as f:
+        while b'\x00' not in head:
+            chunk = f.read(64)
+            if not chunk:
+                raise Exception(f"Malformed object {sha}: truncated")
+            head += d.decompress(chunk)
+
+    x = head.find(b' ')
+    y = head.find(b'\x00', x)
+    return head[0:x], int(head[x:y].decode("ascii"))
+
+def object_loose_path(repo, sha):
+    """Return the path of loose object sha, in repo's object directory
+or one it borrows from, or None if there's no such loose object."""
+    for objects in repo_object_dirs(repo):
+        path = os.path.join(objects, sha[0:2], sha[2:])
+        if os.path.isfile(path):
+            return path
+    return None
+
+def object_exists(repo, sha):
+    """Whether object sha is in the store, loose or packed, or in one
+it borrows from."""
+    return object_loose_path(repo, sha) is not None or pack_find(repo, sha) is not None
+
+def object_compression_level(repo):
+    """The zlib level for loose objects, from core.looseCompression or
+core.compression.  Like git, we favor speed by default."""
+    if repo.conf.has_option("core", "loosecompression"):
+        return repo.conf.getint("core", "loosecompression")
+    if repo.conf.has_option("core", "compression"):
+        return repo.conf.getint("core", "compression")
+    return zlib.Z_BEST_SPEED
 
 def object_write(obj, repo=None):
+    import hashlib
     # Serialize object data
     data = obj.serialize(repo)
     # Add header
     result = obj.fmt + b' ' + str(len(data)).encode() + b'\x00' + data
     # Compute hash
     sha = hashlib.sha1(result).hexdigest()
-
-    if repo:
-        # Compute path
+    if trace_counters is not None:
+        trace_counters["objects_hashed"] += 1
+        trace_counters["bytes_hashed"] += len(result)
+
+    if repo and repo.bulk_checkin:
+        # Bulk checkin: append the object to the pack being written.
+        if not object_exists(repo, sha):
+            pack_bulk_write(repo, obj.fmt, data, sha)
+    elif repo and not object_exists(repo, sha):
+        # Objects we have, or an alternate has, aren't written again.
         path=repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
-
-        if not os.path.exists(path):
-            with open(path, 'wb') as f:
-                # Compress and write
-                f.write(zlib.compress(result))
+        object_write_loose(repo, path, zlib.compress(result, object_compression_level(repo)))
     return sha
 
+def object_write_loose(repo, path, data):
+    # We never write to the final path directly: a crash, or another
+    # process reading the object, would see it half written.  Instead
+    # we write a temporary file next to it and rename it in place,
+    # which is atomic.
+    if repo.object_batch is not None and path in repo.object_batch:
+        return # Already written during this batch
+
+    if trace_counters is not None:
+        trace_counters["objects_written"] += 1
+        trace_counters["bytes_deflated"] += len(data)
+
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        f.flush()
+        if repo.object_batch is not None:
+            # Only start writing the data out: object_batch_end waits
+            # for all of it at once.  Where that can't be done, as git
+            # does, fall back to syncing each file.
+            if not file_writeout(f.fileno()):
+                os.fsync(f.fileno())
+        elif repo_fsync_method(repo) == "fsync":
+            os.fsync(f.fileno())
+    os.chmod(tmp, 0o444)
+
+    if repo.object_batch is not None:
+        repo.object_batch[path] = tmp
+    else:
+        os.replace(tmp, path)
+
+def object_batch_begin(repo):
+    """Start a batch of object writes.  With core.fsyncMethod=batch, new
+loose objects aren't synced one by one, nor moved in place, until
+object_batch_end: then one flush makes all of them durable, and they're
+renamed to their final path.  Objects written during a batch can't be
+read back before it ends.  Without batch fsync, this does nothing."""
+    if repo_fsync_method(repo) == "batch":
+        repo.object_batch = dict()
+
+def object_batch_end(repo):
+    """End a batch of object writes, as git's batch mode does: fsync a
+dummy file in the objects directory, which waits for the data written
+out so far and flushes the disk cache, then rename the objects in place
+without syncing anything else.  The data of the objects is on disk once
+this returns; their names are once the index or a reference naming them
+is synced, on filesystems that journal renames in order (ext4, xfs,
+btrfs), as git assumes too."""
+    batch = repo.object_batch
+    repo.object_batch = None
+    if not batch:
+        return
+
+    import tempfile
+    fd, dummy = tempfile.mkstemp(prefix="bulk_fsync_", dir=repo_file(repo, "objects"))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        os.unlink(dummy)
+    for path, tmp in batch.items():
+        os.replace(tmp, path)
+
 def object_hash(fd, fmt, repo=None):
     """ Hash object, writing it to repo if provided."""
     data = fd.read()
@@ -105,15 +247,22 @@ This function is aware of:
         # This limit is documented in man git-rev-parse
         name = name.lower()
         prefix = name[0:2]
-        path = repo_dir(repo, "objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
+        rem = name[2:]
+        for objects in repo_object_dirs(repo):
+            path = os.path.join(objects, prefix)
+            if not os.path.isdir(path):
+                continue
             for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
+                # Notice a string startswith() itself, so this works
+                # for full hashes.
+                if f.startswith(rem) and prefix + f not in candidates:
                     candidates.append(prefix + f)
 
+        # Packed objects too, unless we already have them loose.
+        for sha in pack_find_prefix(repo, name):
+            if sha not in candidates:
+                candidates.append(sha)
+
     # Try for references.
     as_tag = ref_resolve(repo, "refs/tags/" + name)
     if as_tag: # Did we find a tag?
@@ -27,6 +27,42 @@ class GitRepository (object):
             if vers != 0:
                 raise Exception(f"Unsupported repositoryformatversion: {vers}")
 
+        # The object directories: .git/objects, then those it borrows
+        # objects from (see objects/info/alternates), read on first use
+        # by repo_object_dirs.
+        self.object_dirs = None
+        # The packs of all object directories, loaded on first use by
+        # pack_list.
+        self.packs = None
+        # While a bulk checkin is in progress, the GitPackWriter new
+        # objects go to.
+        self.bulk_checkin = None
+        # During a batch (see object_batch_begin), loose objects waiting
+        # to be synced and moved in place: final path -> temporary path.
+        self.object_batch = None
+        # Packed objects recently used as delta bases, most recently
+        # used last: (pack path, offset) -> (fmt, data).  See
+        # pack_read_at.
+        self.delta_base_cache = dict()
+        self.delta_base_cache_size = 0
+        # Values computed from files of the repository, and the stat
+        # data of those files: name -> (key, value).  Only kept by
+        # long-running processes, None otherwise.  See repo_cached.
+        self.cache = None
+        # The references, loaded on first use by ref_snapshot: (full
+        # name -> contents, full name -> peeled SHA).
+        self.refs = None
+        # The commit-graph file, opened on first use by commit_graph
+        # (False if there's none).
+        self.commit_graph = None
+        # Commits walked so far: sha -> (generation, date, parents).
+        # Commits never change, so this is kept as long as the
+        # repository.  See commit_info.
+        self.commits = dict()
+        # While index_locked holds .git/index.lock, the lock file, which
+        # index_write writes the index to.
+        self.index_lock = None
+
 class GitObject (object):
 
     def __init__(self, data=None):
@@ -100,7 +136,7 @@ class GitIndexEntry (object):
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 flag_stage=None, name=None, flag_skip_worktree=False):
         # The last time a file's metadata changed.  This is a pair
         # (timestamp in seconds, nanoseconds)
         self.ctime = ctime
@@ -112,7 +148,8 @@ class GitIndexEntry (object):
         # The file's inode number
         self.ino = ino
         # The object type, either b1000 (regular), b1010 (symlink),
-        # b1110 (gitlink).
+        # b1110 (gitlink), or b0100 for the directories of a sparse
+        # index, which stand for a whole tree.
         self.mode_type = mode_type
         # The object permissions, an integer.
         self.mode_perms = mode_perms
@@ -126,21 +163,38 @@ class GitIndexEntry (object):
         self.sha = sha
         self.flag_assume_valid = flag_assume_valid
         self.flag_stage = flag_stage
-        # Name of the object (full path this time!)
+        # Outside of the sparse checkout: not in the worktree.  This is
+        # an extended flag, which requires index version 3.
+        self.flag_skip_worktree = flag_skip_worktree
+        # Name of the object (full path this time!)  Sparse directories
+        # end with a slash.
         self.name = name
 
 class GitIndex (object):
     version = None
     entries = []
+    # The cache-tree extension: a dict mapping a directory path ("" for
+    # the root) to the SHA of the tree object matching the index
+    # entries below it.  Directories missing from the dict have been
+    # invalidated since the last time a tree was written.
+    cache_tree = None
+    # The filesystem monitor extension: None, or a tuple (token,
+    # ignore_key, dirty).  The worktree matched the index as of token,
+    # except for the paths in the dirty set.  See status_fsmonitor.
+    fsmonitor = None
     # ext = None
     # sha = None
 
-    def __init__(self, version=2, entries=None):
+    def __init__(self, version=2, entries=None, cache_tree=None, fsmonitor=None):
         if not entries:
             entries = list()
+        if not cache_tree:
+            cache_tree = dict()
 
         self.version = version
         self.entries = entries
+        self.cache_tree = cache_tree
+        self.fsmonitor = fsmonitor
 
 
 class GitIgnore(object):
@@ -149,4 +203,66 @@ class GitIgnore(object):
 
     def __init__(self, absolute, scoped):
         self.absolute = absolute
-        self.scoped = scoped
\ No newline at end of file
+        self.scoped = scoped
+
+
+class GitPack (object):
+    """A pack file, and its index."""
+
+    def __init__(self, path, index):
+        # Path of the pack, without the .pack/.idx extension
+        self.path = path
+        # Raw contents of the .idx file (version 2).  We binary search
+        # it in place rather than parsing every entry.
+        self.index = index
+        # Number of objects: the last entry of the fan-out table.
+        self.count = int.from_bytes(index[8 + 255*4: 8 + 256*4], "big")
+        # The pack itself, mmap()ed on first read.
+        self.data = None
+
+class GitCommitGraph (object):
+    """A commit-graph file, with the parents, date and generation number
+of commits."""
+
+    def __init__(self, path, data, chunks):
+        self.path = path
+        # Contents of the file, mmap()ed.  Like pack indexes, it's
+        # searched in place.
+        self.data = data
+        # Offsets of the chunks: id (like b'OIDL') -> offset.
+        self.chunks = chunks
+        # Number of commits: the last entry of the fan-out table.
+        start = chunks[b'OIDF'] + 255*4
+        self.count = int.from_bytes(data[start:start+4], "big")
+        # Positions of the parents of the commits read, for when they're
+        # read in turn: sha -> position.
+        self.positions = dict()
+
+class GitFsMonitor (object):
+    """An inotify watch over a worktree, kept by the daemon."""
+
+    def __init__(self, fd, worktree):
+        # The inotify file descriptor
+        self.fd = fd
+        self.worktree = worktree
+        # Watched directories: watch descriptor -> path relative to the
+        # worktree ("" for the worktree itself).
+        self.watches = dict()
+        # Tokens are "<instance>:<seq>".  A new instance (after events
+        # were lost) makes all the previous tokens useless; None means
+        # the monitor gave up, and every answer is "look everywhere".
+        self.instance = None
+        self.seq = 0
+        # Paths changed since the instance started -> seq of their last
+        # change.
+        self.changed = dict()
+
+class GitPackWriter (object):
+    """A pack being written by a bulk checkin."""
+
+    def __init__(self, path, file):
+        # Temporary path of the pack
+        self.path = path
+        self.file = file
+        # Objects written so far: sha -> (offset, crc32)
+        self.entries = dict()
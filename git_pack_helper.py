@@ -0,0 +1,440 @@
+import os
+import mmap
+import zlib
+
+from git_objects import GitPack, GitPackWriter
+from git_utilities import repo_dir, repo_object_dirs, repo_fsync_method, file_fsync_dir
+from git_trace_helper import trace_counters
+
+# Object types, as stored in pack entry headers.
+PACK_TYPES = { 1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag' }
+PACK_TYPE_IDS = { fmt: t for (t, fmt) in PACK_TYPES.items() }
+PACK_OFS_DELTA = 6
+PACK_REF_DELTA = 7
+
+# Layout of a version 2 pack index: an 8 bytes header, a 256 entries
+# fan-out table, then one table for each of SHAs (20 bytes), CRCs and
+# offsets (4 bytes), then 8 bytes offsets for packs over 2GB.
+PACK_IDX_HEADER = b'\xfftOc' + (2).to_bytes(4, "big")
+PACK_IDX_SHAS = 8 + 256 * 4
+
+# Size of the delta base cache, in bytes of object data.
+PACK_DELTA_BASE_CACHE_LIMIT = 32 << 20
+
+def pack_list(repo):
+    """Return the packs of repo, and of the object directories it
+borrows from, reading their indexes the first time."""
+    if repo.packs is None:
+        repo.packs = list()
+        for objects in repo_object_dirs(repo):
+            path = os.path.join(objects, "pack")
+            if not os.path.isdir(path):
+                continue
+            for f in sorted(os.listdir(path)):
+                if f.endswith(".idx") and os.path.isfile(os.path.join(path, f[:-4] + ".pack")):
+                    repo.packs.append(pack_open(os.path.join(path, f[:-4])))
+    return repo.packs
+
+def pack_open(path):
+    with open(path + ".idx", "rb") as f:
+        index = f.read()
+    if index[0:8] != PACK_IDX_HEADER:
+        raise Exception(f"Unsupported pack index {path}.idx: only version 2 is supported")
+    return GitPack(path, index)
+
+def pack_index_sha(pack, pos):
+    start = PACK_IDX_SHAS + 20 * pos
+    return pack.index[start:start+20]
+
+def pack_index_bisect(pack, sha):
+    """Return the position of the first SHA (20 raw bytes) in pack's
+index that is not less than sha."""
+    # The fan-out table tells us where SHAs starting with each byte
+    # begin and end, so we only need to search that slice.
+    first = sha[0]
+    lo = int.from_bytes(pack.index[8 + (first-1)*4: 8 + first*4], "big") if first else 0
+    hi = int.from_bytes(pack.index[8 + first*4: 8 + (first+1)*4], "big")
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if pack_index_sha(pack, mid) < sha:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def pack_index_offset(pack, pos):
+    start = PACK_IDX_SHAS + 24 * pack.count + 4 * pos
+    offset = int.from_bytes(pack.index[start:start+4], "big")
+    if offset & 0x80000000:
+        # Large offset: the real one is in the 8 bytes table.
+        start = PACK_IDX_SHAS + 28 * pack.count + 8 * (offset & 0x7fffffff)
+        offset = int.from_bytes(pack.index[start:start+8], "big")
+    return offset
+
+def pack_find(repo, sha):
+    """Return (pack, offset) for the object sha, or None if it isn't in
+any pack."""
+    raw = bytes.fromhex(sha)
+    for pack in pack_list(repo):
+        pos = pack_index_bisect(pack, raw)
+        if pos < pack.count and pack_index_sha(pack, pos) == raw:
+            return (pack, pack_index_offset(pack, pos))
+    return None
+
+def pack_find_prefix(repo, prefix):
+    """Return the SHAs of packed objects starting with prefix, a
+lowercase hex string."""
+    ret = list()
+    low = bytes.fromhex(prefix + "0" * (40 - len(prefix)))
+    for pack in pack_list(repo):
+        pos = pack_index_bisect(pack, low)
+        while pos < pack.count:
+            sha = pack_index_sha(pack, pos).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            pos += 1
+    return ret
+
+def pack_object_read(repo, sha):
+    """Read object sha from the packs.  Return a pair (fmt, data), or
+None if the object isn't packed."""
+    found = pack_find(repo, sha)
+    if not found:
+        return None
+    return pack_read_at(repo, *found)
+
+def pack_data(pack):
+    """The contents of pack, mmap()ed the first time."""
+    if pack.data is None:
+        with open(pack.path + ".pack", "rb") as f:
+            pack.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return pack.data
+
+def pack_read_at(repo, pack, offset):
+    data = pack_data(pack)
+
+    # Deltas may be based on other deltas: follow the chain down to a
+    # full object, or one in the delta base cache, then apply the
+    # deltas back up.
+    deltas = list()
+    while True:
+        cached = pack_delta_base_cache_get(repo, pack, offset)
+        if cached:
+            fmt, ret = cached
+            break
+
+        t, size, pos = pack_entry_header(data, offset)
+        if t == PACK_OFS_DELTA:
+            c = data[pos]
+            pos += 1
+            distance = c & 0x7f
+            while c & 0x80:
+                c = data[pos]
+                pos += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+            deltas.append((offset, pack_inflate(data, pos, size)))
+            offset -= distance
+        elif t == PACK_REF_DELTA:
+            base = data[pos:pos+20].hex()
+            deltas.append((offset, pack_inflate(data, pos + 20, size)))
+            found = pack_find(repo, base)
+            if found:
+                fmt, ret = pack_read_at(repo, *found)
+                pack_delta_base_cache_put(repo, found[0], found[1], fmt, ret)
+            else:
+                # A thin pack's base can be a loose object.
+                from git_object_helper import object_read_raw
+                raw = object_read_raw(repo, base)
+                if raw is None:
+                    raise Exception(f"Missing delta base {base} in {pack.path}.pack")
+                fmt, ret = raw
+            break
+        elif t in PACK_TYPES:
+            fmt = PACK_TYPES[t]
+            ret = pack_inflate(data, pos, size)
+            if deltas:
+                pack_delta_base_cache_put(repo, pack, offset, fmt, ret)
+            break
+        else:
+            raise Exception(f"Unknown pack entry type {t} in {pack.path}.pack")
+
+    # Objects in the middle of the chain are bases too: other deltas
+    # are likely built on them, so they're cached as well.
+    for (i, (delta_offset, delta)) in enumerate(reversed(deltas)):
+        ret = pack_delta_apply(ret, delta)
+        if i < len(deltas) - 1:
+            pack_delta_base_cache_put(repo, pack, delta_offset, fmt, ret)
+    return (fmt, ret)
+
+def pack_delta_base_cache_get(repo, pack, offset):
+    key = (pack.path, offset)
+    ret = repo.delta_base_cache.pop(key, None)
+    if ret:
+        # Most recently used go last.
+        repo.delta_base_cache[key] = ret
+        if trace_counters is not None:
+            trace_counters["delta_base_cache_hits"] += 1
+    return ret
+
+def pack_delta_base_cache_put(repo, pack, offset, fmt, data):
+    key = (pack.path, offset)
+    if key in repo.delta_base_cache or len(data) > PACK_DELTA_BASE_CACHE_LIMIT:
+        return
+    repo.delta_base_cache[key] = (fmt, data)
+    repo.delta_base_cache_size += len(data)
+    # Evict the least recently used bases, which come first.
+    while repo.delta_base_cache_size > PACK_DELTA_BASE_CACHE_LIMIT:
+        (_, old) = repo.delta_base_cache.pop(next(iter(repo.delta_base_cache)))
+        repo.delta_base_cache_size -= len(old)
+
+def pack_read_header_at(repo, pack, offset):
+    """Like pack_read_at, but return the pair (fmt, size) only.  A
+delta starts with the size of its result, and its type is its base's,
+so only a few bytes of each delta in the chain are inflated."""
+    data = pack_data(pack)
+    size = None
+    while True:
+        t, entry_size, pos = pack_entry_header(data, offset)
+        if t in PACK_TYPES:
+            return PACK_TYPES[t], (entry_size if size is None else size)
+
+        if t == PACK_OFS_DELTA:
+            c = data[pos]
+            pos += 1
+            distance = c & 0x7f
+            while c & 0x80:
+                c = data[pos]
+                pos += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+            base_offset = offset - distance
+        elif t == PACK_REF_DELTA:
+            base = data[pos:pos+20].hex()
+            pos += 20
+        else:
+            raise Exception(f"Unknown pack entry type {t} in {pack.path}.pack")
+
+        if size is None:
+            # The delta starts with two varints, the sizes of its base
+            # and of its result: 20 bytes are plenty.
+            head = zlib.decompressobj().decompress(data[pos:pos+64], 20)
+            _, p = pack_delta_varint(head, 0)
+            size, _ = pack_delta_varint(head, p)
+
+        if t == PACK_OFS_DELTA:
+            offset = base_offset
+        else:
+            found = pack_find(repo, base)
+            if not found:
+                from git_object_helper import object_read_header
+                header = object_read_header(repo, base)
+                if header is None:
+                    raise Exception(f"Missing delta base {base} in {pack.path}.pack")
+                return header[0], size
+            pack, offset = found
+            data = pack_data(pack)
+
+def pack_entry_header(data, offset):
+    """Parse the entry header at offset: return (type, size, position
+of the data)."""
+    # The first byte holds the type on bits 4-6, and the low 4 bits of
+    # the size; then, as long as the high bit is set, 7 more bits of
+    # size per byte.
+    c = data[offset]
+    t = (c >> 4) & 0x7
+    size = c & 0x0f
+    shift = 4
+    offset += 1
+    while c & 0x80:
+        c = data[offset]
+        size |= (c & 0x7f) << shift
+        shift += 7
+        offset += 1
+    return t, size, offset
+
+def pack_entry_header_encode(t, size):
+    c = (t << 4) | (size & 0x0f)
+    size >>= 4
+    ret = b''
+    while size:
+        ret += bytes([ c | 0x80 ])
+        c = size & 0x7f
+        size >>= 7
+    return ret + bytes([ c ])
+
+def pack_inflate(data, pos, size):
+    return pack_inflate_end(data, pos, size)[0]
+
+def pack_inflate_end(data, pos, size):
+    """Inflate the entry data at pos, of size bytes.  Return (data, the
+position after it), where the next entry starts."""
+    # We don't know the compressed size, so we feed the decompressor
+    # until the zlib stream ends.
+    d = zlib.decompressobj()
+    ret = b''
+    chunk = max(size, 4096)
+    while not d.eof:
+        if pos >= len(data):
+            raise Exception("Malformed pack entry: truncated")
+        piece = data[pos:pos+chunk]
+        ret += d.decompress(piece)
+        pos += len(piece)
+    if len(ret) != size:
+        raise Exception("Malformed pack entry: bad length")
+    return (ret, pos - len(d.unused_data))
+
+def pack_delta_varint(delta, pos):
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return ret, pos
+
+def pack_delta_apply(base, delta):
+    base_size, pos = pack_delta_varint(delta, 0)
+    if base_size != len(base):
+        raise Exception("Malformed delta: bad base length")
+    size, pos = pack_delta_varint(delta, pos)
+
+    ret = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from base: bits 0-3 say which offset bytes follow,
+            # bits 4-6 which size bytes.
+            offset = 0
+            for i in range(0, 4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            length = 0
+            for i in range(0, 3):
+                if op & (0x10 << i):
+                    length |= delta[pos] << (8 * i)
+                    pos += 1
+            if length == 0:
+                length = 0x10000
+            ret += base[offset:offset+length]
+        elif op:
+            # Insert the next op bytes.
+            ret += delta[pos:pos+op]
+            pos += op
+        else:
+            raise Exception("Malformed delta: reserved opcode 0")
+
+    if len(ret) != size:
+        raise Exception("Malformed delta: bad result length")
+    return bytes(ret)
+
+def pack_compression_level(repo):
+    if repo.conf.has_option("pack", "compression"):
+        return repo.conf.getint("pack", "compression")
+    if repo.conf.has_option("core", "compression"):
+        return repo.conf.getint("core", "compression")
+    return zlib.Z_DEFAULT_COMPRESSION
+
+def pack_bulk_begin(repo):
+    """Start a bulk checkin: until pack_bulk_end, object_write streams
+new objects into a single new pack instead of one loose file each.
+Objects written this way can't be read back before pack_bulk_end."""
+    import tempfile
+    path = repo_dir(repo, "objects", "pack", mkdir=True)
+    fd, tmp = tempfile.mkstemp(prefix="tmp_pack_", dir=path)
+    f = os.fdopen(fd, "wb")
+    # The object count is fixed up once we know it.
+    f.write(b"PACK" + (2).to_bytes(4, "big") + (0).to_bytes(4, "big"))
+    repo.bulk_checkin = GitPackWriter(tmp, f)
+
+def pack_bulk_write(repo, fmt, data, sha):
+    writer = repo.bulk_checkin
+    if sha in writer.entries:
+        return
+    entry = pack_entry_header_encode(PACK_TYPE_IDS[fmt], len(data))
+    entry += zlib.compress(data, pack_compression_level(repo))
+    if trace_counters is not None:
+        trace_counters["objects_written"] += 1
+        trace_counters["bytes_deflated"] += len(entry)
+    writer.entries[sha] = (writer.file.tell(), zlib.crc32(entry))
+    writer.file.write(entry)
+
+def pack_bulk_end(repo):
+    """Finish the bulk checkin: write the pack's index, and move both
+in place.  Return the new pack's path, or None if it was empty."""
+    import hashlib
+    writer = repo.bulk_checkin
+    repo.bulk_checkin = None
+    writer.file.close()
+
+    if not writer.entries:
+        os.unlink(writer.path)
+        return None
+
+    # Fix the object count, and compute the trailing checksum.  That
+    # means reading the pack back, but that's sequential and cheap
+    # compared with compressing it.
+    checksum = hashlib.sha1()
+    with open(writer.path, "r+b") as f:
+        f.seek(8)
+        f.write(len(writer.entries).to_bytes(4, "big"))
+        f.seek(0)
+        while chunk := f.read(1 << 20):
+            checksum.update(chunk)
+        f.write(checksum.digest())
+        if repo_fsync_method(repo):
+            f.flush()
+            os.fsync(f.fileno())
+    checksum = checksum.digest()
+
+    shas = sorted(writer.entries.keys())
+    fanout = [ 0 ] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+
+    index = PACK_IDX_HEADER
+    total = 0
+    for count in fanout:
+        total += count
+        index += total.to_bytes(4, "big")
+    index += b''.join(bytes.fromhex(sha) for sha in shas)
+    index += b''.join(writer.entries[sha][1].to_bytes(4, "big") for sha in shas)
+    large = list()
+    for sha in shas:
+        offset = writer.entries[sha][0]
+        if offset < 0x80000000:
+            index += offset.to_bytes(4, "big")
+        else:
+            index += (0x80000000 | len(large)).to_bytes(4, "big")
+            large.append(offset)
+    index += b''.join(offset.to_bytes(8, "big") for offset in large)
+    index += checksum
+    index += hashlib.sha1(index).digest()
+
+    # Packs are named after their checksum.  The index goes in place
+    # last: a pack without an index is just ignored by readers.
+    path = os.path.join(os.path.dirname(writer.path), "pack-" + checksum.hex())
+    os.replace(writer.path, path + ".pack")
+    with open(path + ".idx.tmp", "wb") as f:
+        f.write(index)
+        if repo_fsync_method(repo):
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(path + ".idx.tmp", path + ".idx")
+    if repo_fsync_method(repo):
+        file_fsync_dir(os.path.dirname(path))
+
+    if repo.packs is not None:
+        repo.packs.append(pack_open(path))
+    return path
+
+def pack_bulk_abort(repo):
+    """Give up the bulk checkin: nothing written since pack_bulk_begin
+is kept."""
+    writer = repo.bulk_checkin
+    repo.bulk_checkin = None
+    writer.file.close()
+    os.unlink(writer.path)
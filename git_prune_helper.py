@@ -0,0 +1,110 @@
+import os
+import time
+
+from git_utilities import repo_dir
+from git_object_helper import object_read_raw, object_read_header
+from git_fsck_helper import fsck_roots, fsck_links
+from git_trace_helper import trace_region, trace_counters
+
+# Removing unreachable loose objects.  Only trees, commits and tags are
+# read to find what they point to: blobs are marked by name, and a tree
+# already marked isn't read again, so commits sharing most of their
+# trees cost as much as their differences.
+#
+# Objects younger than the grace period are kept even if unreachable:
+# another command may have just written them and not yet pointed a ref
+# or the index to them.
+
+PRUNE_EXPIRE_DEFAULT = "2.weeks.ago"
+
+PRUNE_UNITS = { "second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 7 * 86400 }
+
+def prune_expire(value):
+    """Return the cutoff time of expiry value: "now", "never", or like
+"2.weeks.ago"."""
+    if value == "now":
+        return float("inf")
+    if value == "never":
+        return float("-inf")
+
+    parts = value.split(".")
+    if parts[-1] == "ago":
+        parts = parts[:-1]
+    if len(parts) != 2 or not parts[0].isdigit() or parts[1].rstrip("s") not in PRUNE_UNITS:
+        raise Exception(f"Bad expiry date: {value}")
+    return time.time() - int(parts[0]) * PRUNE_UNITS[parts[1].rstrip("s")]
+
+def prune_mark(repo):
+    """Return the set of the SHAs reachable from the refs, HEAD and the
+index."""
+    seen = set()
+    stack = fsck_roots(repo)
+    while stack:
+        (fmt, sha) = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        if fmt == "blob":
+            continue
+
+        raw = object_read_raw(repo, sha)
+        if raw is None:
+            continue # Missing: fsck's business, not ours.
+        if trace_counters is not None:
+            trace_counters["prune_objects_read"] += 1
+        stack.extend(link for link in fsck_links(*raw) if link[1] not in seen)
+    return seen
+
+def prune(repo, expire=PRUNE_EXPIRE_DEFAULT, dry_run=False):
+    """Delete the loose objects of repo that are unreachable and older
+than expire, and leftover temporary files.  Return (pruned, stats):
+pruned is the list of (sha, type) deleted (or that would be, if dry_run),
+stats a dict of counts."""
+    cutoff = prune_expire(expire)
+    with trace_region("prune/mark"):
+        reachable = prune_mark(repo)
+
+    stats = { "reachable": len(reachable), "loose": 0, "pruned": 0, "bytes": 0, "recent": 0, "temporary": 0 }
+    pruned = list()
+    path = repo_dir(repo, "objects")
+    with trace_region("prune/sweep"):
+        for d in sorted(os.listdir(path)):
+            dir_path = os.path.join(path, d)
+            if len(d) != 2 or not os.path.isdir(dir_path):
+                continue
+            for f in sorted(os.listdir(dir_path)):
+                file_path = os.path.join(dir_path, f)
+                st = os.lstat(file_path)
+
+                # Left by an object_write that didn't finish.
+                if f.startswith("tmp_obj_"):
+                    if st.st_mtime <= cutoff:
+                        stats["temporary"] += 1
+                        if not dry_run:
+                            os.unlink(file_path)
+                    continue
+
+                if len(f) != 38:
+                    continue
+                stats["loose"] += 1
+                sha = d + f
+                if sha in reachable:
+                    continue
+                if st.st_mtime > cutoff:
+                    stats["recent"] += 1
+                    continue
+
+                try:
+                    fmt = object_read_header(repo, sha)[0].decode("ascii")
+                except Exception:
+                    fmt = "corrupt"
+                pruned.append((sha, fmt))
+                stats["pruned"] += 1
+                stats["bytes"] += st.st_size
+                if not dry_run:
+                    os.unlink(file_path)
+
+            if not dry_run and not os.listdir(dir_path):
+                os.rmdir(dir_path)
+
+    return (pruned, stats)
@@ -1,53 +1,211 @@
 
 import os
-from git_utilities import repo_file, repo_dir
+from git_utilities import repo_path, repo_file, repo_dir, repo_fsync_method, file_write_locked
 from git_objects import GitTag
 
+# References live in two places: one file each under .git/refs (loose
+# refs), and all together in .git/packed-refs, one "<sha> <name>" line
+# each, sorted by name, each annotated tag followed by a "^<sha>" line
+# with the object it peels to.  A loose ref overrides a packed one of
+# the same name.  Refs are read once, the first time one is needed, into
+# a snapshot (see ref_snapshot): lookups and listings are then just
+# dictionary accesses, however many refs there are.
+
+PACKED_REFS_HEADER = "# pack-refs with: peeled fully-peeled sorted \n"
+
 def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
+    data = ref_read(repo, ref)
 
     # Sometimes, an indirect reference may be broken.  This is normal
     # in one specific case: we're looking for HEAD on a new repository
     # with no commits.  In that case, .git/HEAD points to "ref:
     # refs/heads/main", but .git/refs/heads/main doesn't exist yet
     # (since there's no commit for it to refer to).
-    if not os.path.isfile(path):
+    if data is None:
         return None
 
-    with open(path, 'r') as fp:
-        data = fp.read()[:-1]
-        # Drop final \n ^^^^^
     if data.startswith("ref: "):
         return ref_resolve(repo, data[5:])
     else:
         return data
 
-def ref_list(repo, path=None):
-    if not path:
+def ref_read(repo, ref):
+    """Return the contents of ref: a SHA, or "ref: <target>" for a
+symbolic ref.  None if there's no such ref."""
+    if ref.startswith("refs/"):
+        return ref_snapshot(repo)[0].get(ref)
+
+    # HEAD and its friends are only ever loose.
+    path = repo_file(repo, ref)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as fp:
+        return fp.read().rstrip("\n")
+
+def ref_snapshot(repo):
+    """Return the refs of repo as a pair of dicts: full name -> contents
+(see ref_read), and full name -> peeled SHA for packed annotated tags."""
+    if repo.refs is None:
+        (packed, peeled) = ref_packed_read(repo)
+        refs = dict(packed)
+
         path = repo_dir(repo, "refs")
+        for (root, _, files) in os.walk(path) if path else []:
+            for f in files:
+                if f.endswith(".lock"):
+                    continue
+                name = os.path.relpath(os.path.join(root, f), repo.gitdir).replace(os.sep, "/")
+                with open(os.path.join(root, f), 'r') as fp:
+                    refs[name] = fp.read().rstrip("\n")
+                # The peeled value is stale if the loose ref moved.
+                if name in peeled and refs[name] != packed[name]:
+                    del peeled[name]
+        repo.refs = (refs, peeled)
+    return repo.refs
+
+def ref_packed_read(repo):
+    """Return the refs of .git/packed-refs as a pair of dicts, as
+ref_snapshot."""
+    refs = dict()
+    peeled = dict()
+    path = repo_file(repo, "packed-refs")
+    if not os.path.isfile(path):
+        return (refs, peeled)
+
+    name = None
+    with open(path, 'r') as fp:
+        for line in fp:
+            line = line.rstrip("\n")
+            if not line or line[0] == "#":
+                continue
+            if line[0] == "^":
+                peeled[name] = line[1:]
+            else:
+                (sha, name) = line.split(" ", 1)
+                refs[name] = sha
+    return (refs, peeled)
+
+def ref_packed_write(repo, refs):
+    """Replace .git/packed-refs with refs, a dict full name -> SHA,
+peeling annotated tags."""
+    peeled = { name: tag_peel(repo, sha) for (name, sha) in refs.items() }
+    with file_write_locked(repo_file(repo, "packed-refs"), fsync=repo_fsync_method(repo) is not None) as fp:
+        fp.write(ref_packed_serialize(refs, peeled))
+
+def ref_packed_serialize(refs, peeled):
+    lines = [ PACKED_REFS_HEADER ]
+    for name in sorted(refs):
+        lines.append(f"{refs[name]} {name}\n")
+        if peeled.get(name, refs[name]) != refs[name]:
+            lines.append(f"^{peeled[name]}\n")
+    return "".join(lines).encode("ascii")
+
+def ref_pack(repo, everything=False, prune=True):
+    """Move refs into .git/packed-refs: tags and refs already packed,
+or every ref if everything.  Symbolic refs stay loose.  Unless prune,
+the loose files are left too.  Return how many refs are packed."""
+    (refs, _) = ref_snapshot(repo)
+    (packed, _) = ref_packed_read(repo)
+
+    new = dict()
+    for (name, data) in refs.items():
+        if data.startswith("ref: "):
+            continue
+        if everything or name.startswith("refs/tags/") or name in packed:
+            new[name] = data
+    ref_packed_write(repo, new)
+
+    if prune:
+        dirs = set()
+        for (name, sha) in new.items():
+            path = repo_path(repo, *name.split("/"))
+            if not os.path.isfile(path):
+                continue
+            # Unless it moved in the meantime.
+            with open(path, 'r') as fp:
+                if fp.read().rstrip("\n") != sha:
+                    continue
+            os.unlink(path)
+            dirs.add(os.path.dirname(name))
+
+        # Directories left empty go too, but for the standard ones.
+        for d in sorted(dirs, key=len, reverse=True):
+            while d not in ("refs", "refs/heads", "refs/tags"):
+                try:
+                    os.rmdir(repo_path(repo, *d.split("/")))
+                except OSError:
+                    break
+                d = os.path.dirname(d)
+
+    repo.refs = None
+    return len(new)
+
+def ref_list(repo):
+    """Return the refs of repo, resolved, as nested dicts: {"heads":
+{"main": sha}, ...}.  Sorted by full name, as git shows them."""
     ret = dict()
-    # Git shows refs sorted.  To do the same, we sort the output of
-    # listdir
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
+    (refs, _) = ref_snapshot(repo)
+    for name in sorted(refs):
+        sha = ref_resolve(repo, name)
+        if sha is None:
+            continue # A broken symbolic ref.
+        parts = name.split("/")[1:]
+        d = ret
+        for part in parts[:-1]:
+            d = d.setdefault(part, dict())
+        d[parts[-1]] = sha
+    return ret
+
+def ref_peeled(repo, ref):
+    """Return what ref points to once its tags are followed, from
+packed-refs if it's there."""
+    (_, peeled) = ref_snapshot(repo)
+    if ref in peeled:
+        return peeled[ref]
+    return tag_peel(repo, ref_resolve(repo, ref))
+
+def tag_peel(repo, sha):
+    """Follow object sha while it's a tag."""
+    from git_object_helper import object_read_header, object_read
+    while True:
+        header = object_read_header(repo, sha)
+        if header is None or header[0] != b'tag':
+            return sha
+        sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
 
+def ref_flatten(refs, prefix="refs"):
+    """Return the refs of a ref_list as a list of (full name, sha)."""
+    ret = list()
+    for k, v in refs.items():
+        if type(v) == dict:
+            ret.extend(ref_flatten(v, f"{prefix}/{k}"))
+        elif v:
+            ret.append((f"{prefix}/{k}", v))
     return ret
 
+def ref_symbolic(repo, ref):
+    """Return the ref that ref (eg HEAD) points to, or None if it's not
+a symbolic ref."""
+    data = ref_read(repo, ref)
+    if data is None or not data.startswith("ref: "):
+        return None
+    return data[5:]
+
 
-def show_ref(repo, refs, with_hash=True, prefix=""):
+def show_ref(repo, refs, with_hash=True, prefix="", dereference=False):
     if prefix:
         prefix = prefix + '/'
     for k, v in refs.items():
         if type(v) == str and with_hash:
             print (f"{v} {prefix}{k}")
+            if dereference and prefix.startswith("refs/tags/"):
+                peeled = ref_peeled(repo, prefix + k)
+                if peeled != v:
+                    print (f"{peeled} {prefix}{k}^{{}}")
         elif type(v) == str:
             print (f"{prefix}{k}")
         else:
-            show_ref(repo, v, with_hash=with_hash, prefix=f"{prefix}{k}")
+            show_ref(repo, v, with_hash=with_hash, prefix=f"{prefix}{k}", dereference=dereference)
 
 def tag_create(repo, name, ref, create_tag_object=False):
     from git_object_helper import object_find, object_write
@@ -75,5 +233,205 @@ def tag_create(repo, name, ref, create_tag_object=False):
         ref_create(repo, "tags/" + name, sha)
 
 def ref_create(repo, ref_name, sha):
-    with open(repo_file(repo, "refs/" + ref_name), 'w') as fp:
-        fp.write(sha + "\n")
+    ref_transaction(repo, [ ("refs/" + ref_name, sha, REF_ZERO) ])
+
+def ref_write(repo, ref, sha):
+    """Point ref (a path under .git, eg refs/heads/main or HEAD) to sha,
+atomically, through ref.lock."""
+    path = repo_file(repo, *ref.split("/"), mkdir=True)
+    with file_write_locked(path, fsync=repo_fsync_method(repo) is not None) as fp:
+        fp.write((sha + "\n").encode("ascii"))
+    if repo.refs is not None and ref.startswith("refs/"):
+        repo.refs[0][ref] = sha
+        repo.refs[1].pop(ref, None)
+
+# As an old value in a transaction: the ref must not exist.
+REF_ZERO = "0" * 40
+
+def ref_transaction(repo, updates):
+    """Apply updates, a list of (ref, new, old), all or nothing.  new is
+a SHA, None to delete ref, or False to only check it.  old is what ref
+must point to beforehand: a SHA, REF_ZERO if it must not exist, or None
+not to check.  A symbolic ref (HEAD) updates the ref it points to.
+
+Each ref is locked (ref.lock, as ref_write does), then checked, with
+every lock held, so no other process can change them in between.  Only
+then is anything changed: packed-refs, rewritten once if some deleted
+refs are packed, then each ref, by renaming its lock in place."""
+    fsync = repo_fsync_method(repo) is not None
+    repo.refs = None # Read fresh values.
+
+    resolved = list()
+    for (ref, new, old) in updates:
+        while (data := ref_read(repo, ref)) and data.startswith("ref: "):
+            ref = data[5:]
+        ref_check_name(ref)
+        resolved.append((ref, new, old))
+    seen = set()
+    for (ref, _, _) in resolved:
+        if ref in seen:
+            raise Exception(f"Multiple updates for ref {ref} not allowed.")
+        seen.add(ref)
+    ref_check_conflicts(repo, [ ref for (ref, new, _) in resolved if new ])
+
+    locks = dict() # ref -> open lock file
+    packed_lock = None
+    try:
+        for (ref, new, _) in resolved:
+            path = repo_path(repo, *ref.split("/"))
+            # Even to check or delete a ref, which may not exist: the
+            # lock must be there for no one to create it meanwhile.
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                locks[ref] = open(path + ".lock", "xb")
+            except FileExistsError:
+                raise Exception(f"Unable to create {path}.lock: File exists.  Another my_git process seems to be running; if not, remove the file.")
+        if any(new is None for (_, new, _) in resolved):
+            packed_lock = open(repo_path(repo, "packed-refs.lock"), "xb")
+
+        # Everything is locked: the values we read now stay valid.
+        repo.refs = None
+        for (ref, new, old) in resolved:
+            current = ref_read(repo, ref)
+            if new is None and current is None:
+                raise Exception(f"Cannot delete {ref}: no such ref.")
+            if old == REF_ZERO and current is not None:
+                raise Exception(f"Cannot update {ref}: it already exists.")
+            if old not in (None, REF_ZERO) and current != old:
+                raise Exception(f"Cannot update {ref}: it is at {current or 'nothing'}, not {old}.")
+
+        for (ref, new, _) in resolved:
+            if new:
+                locks[ref].write((new + "\n").encode("ascii"))
+                locks[ref].flush()
+                if fsync:
+                    os.fsync(locks[ref].fileno())
+
+        # Deleted refs leave packed-refs first: they mustn't reappear
+        # from there once their loose file is gone.
+        if packed_lock:
+            (packed, peeled) = ref_packed_read(repo)
+            deleted = [ ref for (ref, new, _) in resolved if new is None and ref in packed ]
+            if deleted:
+                for ref in deleted:
+                    del packed[ref]
+                packed_lock.write(ref_packed_serialize(packed, peeled))
+                packed_lock.flush()
+                if fsync:
+                    os.fsync(packed_lock.fileno())
+                packed_lock.close()
+                os.replace(repo_path(repo, "packed-refs.lock"), repo_path(repo, "packed-refs"))
+            else:
+                packed_lock.close()
+                os.unlink(repo_path(repo, "packed-refs.lock"))
+            packed_lock = None
+    except BaseException:
+        for (ref, f) in locks.items():
+            f.close()
+            os.unlink(repo_path(repo, *ref.split("/")) + ".lock")
+        ref_prune_dirs(repo, [ ref for (ref, new, _) in resolved if not new ])
+        if packed_lock:
+            packed_lock.close()
+            os.unlink(repo_path(repo, "packed-refs.lock"))
+        repo.refs = None
+        raise
+
+    # Committed: nothing below can fail but the filesystem.
+    for (ref, new, _) in resolved:
+        path = repo_path(repo, *ref.split("/"))
+        locks[ref].close()
+        if new:
+            os.replace(path + ".lock", path)
+        else:
+            if new is None and os.path.isfile(path):
+                os.unlink(path)
+            os.unlink(path + ".lock")
+    ref_prune_dirs(repo, [ ref for (ref, new, _) in resolved if not new ])
+    repo.refs = None
+
+def ref_prune_dirs(repo, refs):
+    """Remove the directories of refs left empty, up to refs/<kind>."""
+    for ref in refs:
+        parts = ref.split("/")[:-1]
+        while len(parts) > 2:
+            try:
+                os.rmdir(repo_path(repo, *parts))
+            except OSError:
+                break # Not empty.
+            parts.pop()
+
+def ref_check_name(ref):
+    """Raise an exception unless ref is a valid name for a ref, as in
+git check-ref-format."""
+    parts = ref.split("/")
+    if ref == "HEAD":
+        return
+    bad = (not ref.startswith("refs/") or len(parts) < 3 or ref.endswith("/")
+           or ".." in ref or "@{" in ref or ref.endswith(".")
+           or any(c in ref for c in " ~^:?*[\\\x7f") or any(ord(c) < 32 for c in ref)
+           or any(not p or p.startswith(".") or p.endswith(".lock") for p in parts))
+    if bad:
+        raise Exception(f"Invalid ref name {ref}.")
+
+def ref_check_conflicts(repo, names):
+    """Raise an exception if one of the refs names can't exist alongside
+the other refs: refs/heads/a and refs/heads/a/b can't both exist."""
+    (refs, _) = ref_snapshot(repo)
+    existing = set(refs) | set(names)
+    prefixes = set()
+    for name in existing:
+        d = os.path.dirname(name)
+        while d and d not in prefixes:
+            prefixes.add(d)
+            d = os.path.dirname(d)
+    for name in names:
+        if name in prefixes:
+            raise Exception(f"Cannot create {name}: refs exist below it.")
+        d = os.path.dirname(name)
+        while d:
+            if d in existing:
+                raise Exception(f"Cannot create {name}: {d} exists.")
+            d = os.path.dirname(d)
+
+def ref_updates_parse(repo, text):
+    """Parse the commands of update-ref --stdin, one per line:
+
+    create <ref> <new>
+    update <ref> <new> [<old>]
+    delete <ref> [<old>]
+    verify <ref> [<old>]
+
+into updates for ref_transaction.  Values may be any name rev-parse
+takes; each is resolved once."""
+    from git_object_helper import object_find, object_exists
+    names = dict()
+    def value(v, new):
+        if v == REF_ZERO or (not new and len(v) == 40):
+            return v # Old values don't have to exist anymore.
+        if v not in names:
+            if len(v) == 40 and object_exists(repo, v.lower()):
+                names[v] = v.lower()
+            else:
+                names[v] = object_find(repo, v)
+        return names[v]
+
+    updates = list()
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        words = line.split()
+        match words:
+            case [ "create", ref, new ]:
+                if new == REF_ZERO:
+                    raise Exception(f"create {ref}: zero new value")
+                updates.append((ref, value(new, True), REF_ZERO))
+            case [ "update", ref, new, *old ] if len(old) <= 1:
+                new = None if new == REF_ZERO else value(new, True)
+                updates.append((ref, new, value(old[0], False) if old else None))
+            case [ "delete", ref, *old ] if len(old) <= 1:
+                updates.append((ref, None, value(old[0], False) if old else None))
+            case [ "verify", ref, *old ] if len(old) <= 1:
+                updates.append((ref, False, value(old[0], False) if old else REF_ZERO))
+            case _:
+                raise Exception(f"Bad update-ref command: {line}")
+    return updates
@@ -0,0 +1,346 @@
+import os
+import mmap
+import heapq
+import itertools
+
+from git_objects import GitCommitGraph
+from git_object_helper import object_read
+from git_trace_helper import trace_region, trace_counters
+
+# Walking the history of commits.  Each walk is a priority queue,
+# newest commits first: a commit comes out after everything above it
+# that's queued, so the marks it carries (reached from this side, from
+# that side, or both) are final when its parents get them.  Walks stop
+# as soon as what's left in the queue can't change the answer, instead
+# of going down to the root commits.
+#
+# "Newest" is by generation number when git wrote a commit-graph file,
+# and by committer date otherwise, as git does.  Generation numbers are
+# never lower than those of parents, so they also give a hard cutoff: a
+# commit is never an ancestor of one with a lower generation number.
+# They're the corrected commit dates (dates, raised where needed to be
+# above those of parents) if the file has them, else the length of the
+# longest path down to a root commit.  Commits are parsed once, from the commit-graph if
+# they're in it, and kept with the repository, for the next walks.
+
+# The generation number of commits outside the commit-graph.  A
+# commit-graph only has commits whose parents it has, so none of its
+# commits descends from those.
+REV_GENERATION_INFINITY = (1 << 63) - 1
+
+# How many commits rev_list walks on once everything left to walk is
+# excluded, in case clock skew puts an included one further down.  The
+# same as git.
+REV_SLOP = 5
+
+# Marks of the walks: reached from the first side, from the second side
+# (or uninteresting, for rev_list), below a commit reached from both.
+REV_PARENT1 = 1
+REV_PARENT2 = 2
+REV_STALE = 4
+
+# Layout of a commit-graph file: an 8 bytes header ("CGPH", version 1,
+# SHA-1, chunk count, base graph count), the table of contents (12 bytes
+# per chunk: id and offset), then the chunks.  Those we use are the
+# fan-out table (OIDF), the sorted commit SHAs (OIDL), 36 bytes of data
+# per commit (CDAT: tree, two parent positions, topological level and
+# date), the parents of octopus merges (EDGE), and the corrected commit
+# dates, as 4 bytes offsets from the dates (GDA2), or for large ones,
+# an index into a table of 8 bytes offsets (GDO2).
+COMMIT_GRAPH_SIGNATURE = b'CGPH'
+COMMIT_GRAPH_NO_PARENT = 0x70000000
+COMMIT_GRAPH_EXTRA_EDGES = 0x80000000
+COMMIT_GRAPH_LAST_EDGE = 0x80000000
+COMMIT_GRAPH_OFFSET_OVERFLOW = 0x80000000
+
+def commit_graph(repo):
+    """Return the commit-graph of repo, opening it the first time, or
+None if it has none (that we can read)."""
+    if repo.commit_graph is None:
+        path = os.path.join(repo.gitdir, "objects", "info", "commit-graph")
+        repo.commit_graph = commit_graph_open(path) or False
+    return repo.commit_graph or None
+
+def commit_graph_open(path):
+    try:
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None # None, or empty.
+
+    # Like git, we ignore a commit-graph we can't use: it's only a cache.
+    if data[0:4] != COMMIT_GRAPH_SIGNATURE or data[4] != 1 or data[5] != 1 or data[7] != 0:
+        return None
+    chunks = dict()
+    for i in range(data[6]):
+        start = 8 + 12 * i
+        chunks[data[start:start+4]] = int.from_bytes(data[start+4:start+12], "big")
+    if not all(c in chunks for c in (b'OIDF', b'OIDL', b'CDAT')):
+        return None
+    return GitCommitGraph(path, data, chunks)
+
+def commit_graph_sha(graph, pos):
+    start = graph.chunks[b'OIDL'] + 20 * pos
+    return graph.data[start:start+20]
+
+def commit_graph_find(graph, sha):
+    """Return the position of sha (20 raw bytes) in graph, or None."""
+    fanout = graph.chunks[b'OIDF']
+    first = sha[0]
+    lo = int.from_bytes(graph.data[fanout + (first-1)*4:fanout + first*4], "big") if first else 0
+    hi = int.from_bytes(graph.data[fanout + first*4:fanout + (first+1)*4], "big")
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if commit_graph_sha(graph, mid) < sha:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < graph.count and commit_graph_sha(graph, lo) == sha:
+        return lo
+    return None
+
+def commit_graph_entry(graph, pos):
+    """Return (generation, date, parent positions) of the commit at pos."""
+    data = graph.data
+    start = graph.chunks[b'CDAT'] + 36 * pos
+    parent1 = int.from_bytes(data[start+20:start+24], "big")
+    parent2 = int.from_bytes(data[start+24:start+28], "big")
+    value = int.from_bytes(data[start+28:start+36], "big")
+
+    parents = list()
+    if parent1 != COMMIT_GRAPH_NO_PARENT:
+        parents.append(parent1)
+    if parent2 & COMMIT_GRAPH_EXTRA_EDGES:
+        # The second and next parents are in the EDGE chunk, the last
+        # one marked.
+        edge = graph.chunks[b'EDGE'] + 4 * (parent2 & ~COMMIT_GRAPH_EXTRA_EDGES)
+        while True:
+            parent = int.from_bytes(data[edge:edge+4], "big")
+            parents.append(parent & ~COMMIT_GRAPH_LAST_EDGE)
+            if parent & COMMIT_GRAPH_LAST_EDGE:
+                break
+            edge += 4
+    elif parent2 != COMMIT_GRAPH_NO_PARENT:
+        parents.append(parent2)
+
+    # 30 bits of topological level, 34 bits of date.
+    date = value & ((1 << 34) - 1)
+    generation = value >> 34
+    if b'GDA2' in graph.chunks:
+        start = graph.chunks[b'GDA2'] + 4 * pos
+        offset = int.from_bytes(data[start:start+4], "big")
+        if offset & COMMIT_GRAPH_OFFSET_OVERFLOW:
+            start = graph.chunks[b'GDO2'] + 8 * (offset & ~COMMIT_GRAPH_OFFSET_OVERFLOW)
+            offset = int.from_bytes(data[start:start+8], "big")
+        generation = date + offset
+    return (generation, date, parents)
+
+def commit_info(repo, sha):
+    """Return (generation, date, parents) for commit sha: its generation
+number (REV_GENERATION_INFINITY if unknown), committer date and parent
+SHAs."""
+    info = repo.commits.get(sha)
+    if info is not None:
+        return info
+
+    graph = commit_graph(repo)
+    pos = None
+    if graph:
+        pos = graph.positions.pop(sha, None)
+        if pos is None:
+            pos = commit_graph_find(graph, bytes.fromhex(sha))
+    if pos is not None:
+        (generation, date, positions) = commit_graph_entry(graph, pos)
+        parents = [ commit_graph_sha(graph, p).hex() for p in positions ]
+        for (parent, p) in zip(parents, positions):
+            if parent not in repo.commits:
+                graph.positions[parent] = p
+        info = (generation, date, parents)
+    else:
+        obj = object_read(repo, sha)
+        if obj is None or obj.fmt != b'commit':
+            raise Exception(f"Not a commit: {sha}")
+        parents = obj.kvlm.get(b'parent', [])
+        if type(parents) != list:
+            parents = [ parents ]
+        # The committer line ends with "<timestamp> <tz>".
+        date = int(obj.kvlm[b'committer'].split()[-2])
+        info = (REV_GENERATION_INFINITY, date, [ p.decode("ascii") for p in parents ])
+        if trace_counters is not None:
+            trace_counters["rev_commits_parsed"] += 1
+
+    repo.commits[sha] = info
+    if trace_counters is not None:
+        trace_counters["rev_commits"] += 1
+    return info
+
+def rev_key(repo, sha, tie, dates_only=False):
+    """The order of walks: newest first, by generation then date, and
+first queued first (tie is a counter)."""
+    (generation, date, _) = commit_info(repo, sha)
+    return (0 if dates_only else -generation, -date, tie, sha)
+
+def rev_paint(repo, one, twos, min_generation=0):
+    """Mark the commits reachable from one with REV_PARENT1, from twos
+with REV_PARENT2, and those below a commit that has both with
+REV_STALE.  Return (bases, marks): bases are the commits reached from
+both sides first (the merge bases, and maybe some of their ancestors),
+marks a dict sha -> marks.  The walk stops when only stale commits
+are left to walk, or, with min_generation, at the first commit with a
+lower generation number."""
+    marks = { one: REV_PARENT1 }
+    for two in twos:
+        marks[two] = marks.get(two, 0) | REV_PARENT2
+    tie = itertools.count()
+    queue = [ rev_key(repo, sha, next(tie)) for sha in marks ]
+    heapq.heapify(queue)
+    queued = set(marks)
+    live = set(sha for sha in marks if not marks[sha] & REV_STALE)
+
+    bases = list()
+    while live:
+        (generation, _, _, sha) = heapq.heappop(queue)
+        queued.discard(sha)
+        live.discard(sha)
+        if -generation < min_generation:
+            break
+
+        flags = marks[sha] & (REV_PARENT1 | REV_PARENT2 | REV_STALE)
+        if flags == REV_PARENT1 | REV_PARENT2:
+            # Reached from both sides: a base.  Everything below it is
+            # too, and of no interest.
+            if sha not in bases:
+                bases.append(sha)
+            flags |= REV_STALE
+        for parent in commit_info(repo, sha)[2]:
+            old = marks.get(parent, 0)
+            if old & flags == flags:
+                continue
+            marks[parent] = old | flags
+            if parent not in queued:
+                heapq.heappush(queue, rev_key(repo, parent, next(tie)))
+                queued.add(parent)
+            if marks[parent] & REV_STALE:
+                live.discard(parent)
+            else:
+                live.add(parent)
+
+    # A base found early can turn out to be below a later one.
+    bases = [ sha for sha in bases if not marks[sha] & REV_STALE ]
+    return (bases, marks)
+
+def merge_bases(repo, one, twos):
+    """Return the best common ancestors of commit one and (any of)
+commits twos, newest first: those that aren't ancestors of another."""
+    if one in twos:
+        return [ one ]
+    with trace_region("rev/merge-base"):
+        (bases, _) = rev_paint(repo, one, twos)
+        bases = rev_remove_redundant(repo, bases)
+    return sorted(bases, key=lambda sha: -commit_info(repo, sha)[1])
+
+def rev_remove_redundant(repo, commits):
+    """Return commits, without those that are ancestors of others."""
+    redundant = set()
+    for sha in commits:
+        if sha in redundant:
+            continue
+        others = [ o for o in commits if o != sha and o not in redundant ]
+        if not others:
+            break
+        min_generation = min(commit_info(repo, c)[0] for c in [ sha ] + others)
+        (_, marks) = rev_paint(repo, sha, others, min_generation)
+        if marks[sha] & REV_PARENT2:
+            redundant.add(sha)
+        redundant.update(o for o in others if marks[o] & REV_PARENT1)
+    return [ sha for sha in commits if sha not in redundant ]
+
+def is_ancestor(repo, one, two):
+    """Return whether commit one is an ancestor of (or is) commit two."""
+    if one == two:
+        return True
+    generation = commit_info(repo, one)[0]
+    if generation > commit_info(repo, two)[0]:
+        return False
+
+    # As git does: paint down from two and one until only stale commits
+    # are left, then see if two's paint got to one.  Nothing below one's
+    # generation number can lead to one.
+    with trace_region("rev/is-ancestor"):
+        (_, marks) = rev_paint(repo, two, [ one ], generation)
+    return bool(marks[one] & REV_PARENT1)
+
+def rev_list(repo, include, exclude):
+    """Return the commits reachable from the commits include but not from
+the commits exclude, newest first."""
+    # As git does, this walk goes by date only, which is the order
+    # commits are listed in.  Excluded commits, and everything below
+    # them, get REV_PARENT2.
+    marks = dict()
+    for sha in include:
+        marks[sha] = 0
+    for sha in exclude:
+        marks[sha] = REV_PARENT2
+    tie = itertools.count()
+    queue = [ rev_key(repo, sha, next(tie), True) for sha in marks ]
+    heapq.heapify(queue)
+    queued = set(marks)
+    live = set(sha for sha in marks if not marks[sha])
+
+    ret = list()
+    slop = REV_SLOP
+    last = None # Date of the last commit listed
+    with trace_region("rev/list"):
+        while queue:
+            (_, date, _, sha) = heapq.heappop(queue)
+            queued.discard(sha)
+            live.discard(sha)
+            flags = marks[sha]
+            for parent in commit_info(repo, sha)[2]:
+                old = marks.get(parent)
+                if old is not None and (old or not flags):
+                    continue # Nothing new.
+                marks[parent] = flags
+                if parent not in queued:
+                    # A commit walked as included, and excluded after
+                    # all, walks again, to exclude its parents too.
+                    heapq.heappush(queue, rev_key(repo, parent, next(tie), True))
+                    queued.add(parent)
+                if flags:
+                    live.discard(parent)
+                else:
+                    live.add(parent)
+
+            if not flags:
+                ret.append(sha)
+                last = -date
+                continue
+            # Once everything queued is excluded, what's below is too;
+            # unless a date out of order hides an included commit.
+            if live or (queue and last is not None and -queue[0][1] >= last):
+                slop = REV_SLOP
+            else:
+                slop -= 1
+                if not slop:
+                    break
+
+    return [ sha for sha in ret if not marks[sha] ]
+
+def rev_range_parse(repo, revs):
+    """Parse revs, as rev-list takes them: <commit>, ^<commit> to leave
+out what it reaches, and <a>..<b> for ^<a> <b>.  Return (include,
+exclude): include a list of (name, commit) for the commits to list,
+exclude a list of commits."""
+    from git_object_helper import object_find
+    include = list()
+    exclude = list()
+    for rev in revs:
+        if ".." in rev:
+            (a, b) = rev.split("..", 1)
+            exclude.append(object_find(repo, a or "HEAD", fmt=b"commit"))
+            include.append((b or "HEAD", object_find(repo, b or "HEAD", fmt=b"commit")))
+        elif rev.startswith("^"):
+            exclude.append(object_find(repo, rev[1:], fmt=b"commit"))
+        else:
+            include.append((rev, object_find(repo, rev, fmt=b"commit")))
+    return (include, exclude)
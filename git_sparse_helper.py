@@ -0,0 +1,217 @@
+import os
+from git_objects import GitIndexEntry
+from git_utilities import repo_file, repo_dir, repo_cached, repo_config_set, file_write_locked
+from git_object_helper import object_read
+from git_index_helper import index_read, index_write, index_locked, index_entry_refresh
+
+# Cone mode sparse checkout.  The cone is a set of directories, which
+# are checked out with everything below them; so are the files of the
+# root and of the directories leading to the cone, and nothing else.
+# Like git, we keep it in .git/info/sparse-checkout as patterns:
+#
+#     /*          the files of the root,
+#     !/*/        but none of its directories,
+#     /src/       except src, without its subdirectories,
+#     !/src/*/
+#     /src/lib/   and src/lib, recursively.
+#
+# Each directory outside of the cone is a single entry of the index (a
+# "sparse directory", whose name ends with a slash) holding the SHA of
+# its tree, so the index grows with the cone, not with the repository.
+
+def sparse_cone(repo):
+    """Return the cone of repo as a set of directories, or None if it
+isn't a sparse checkout."""
+    if not repo.conf.getboolean("core", "sparsecheckout", fallback=False):
+        return None
+    if not repo.conf.getboolean("core", "sparsecheckoutcone", fallback=True):
+        raise Exception("Only cone mode sparse checkouts are supported.")
+    path = repo_file(repo, "info/sparse-checkout")
+    return repo_cached(repo, "sparse", [ path ], lambda: sparse_cone_read(path))
+
+def sparse_cone_read(path):
+    cone = set()
+    parents = set()
+    if not os.path.exists(path):
+        return cone
+
+    with open(path, "r") as f:
+        for line in f.read().splitlines():
+            line = line.strip()
+            if not line or line[0] == "#" or line in ("/*", "!/*/"):
+                continue
+            if line.startswith("!/") and line.endswith("/*/"):
+                parents.add(line[2:-3])
+            elif line.startswith("/") and line.endswith("/"):
+                cone.add(line[1:-1])
+            else:
+                raise Exception(f"Not a cone mode pattern: {line}")
+
+    # Directories whose subdirectories are excluded are only there to
+    # lead to the cone.
+    return cone - parents
+
+def sparse_cone_write(repo, cone):
+    parents = set()
+    for d in cone:
+        d = os.path.dirname(d)
+        while d:
+            parents.add(d)
+            d = os.path.dirname(d)
+
+    lines = [ "/*", "!/*/" ]
+    for d in sorted(cone | parents):
+        lines.append(f"/{d}/")
+        if d in parents:
+            lines.append(f"!/{d}/*/")
+
+    repo_dir(repo, "info", mkdir=True)
+    with file_write_locked(repo_file(repo, "info/sparse-checkout")) as f:
+        f.write("".join(l + "\n" for l in lines).encode("utf8"))
+
+def sparse_dir_outside(cone, path):
+    """Return True if nothing below directory path is in cone."""
+    if cone is None:
+        return False
+    for d in cone:
+        if path == d or path.startswith(d + "/") or d.startswith(path + "/"):
+            return False
+    return True
+
+def sparse_dir_top(cone, path):
+    """Return the topmost directory outside of cone among directory path
+and its parents, or None if they're all in the cone."""
+    prefix = ""
+    for part in path.split("/") if path else []:
+        prefix = prefix + "/" + part if prefix else part
+        if sparse_dir_outside(cone, prefix):
+            return prefix
+    return None
+
+def sparse_entry(path, sha):
+    """Return the sparse directory entry of directory path, whose tree is
+sha."""
+    return GitIndexEntry(ctime=(0, 0), mtime=(0, 0), dev=0, ino=0,
+                         mode_type=0b0100, mode_perms=0, uid=0, gid=0,
+                         fsize=0, sha=sha, flag_assume_valid=False,
+                         flag_stage=0, flag_skip_worktree=True, name=path + "/")
+
+def sparse_expand(repo, cone, path, sha, cache_tree):
+    """Yield the entries standing for tree sha at directory path: files,
+and sparse directories for the subdirectories outside of cone.  Files
+are marked skip-worktree, since they aren't checked out yet."""
+    cache_tree[path] = sha
+    for item in object_read(repo, sha).items:
+        name = path + "/" + item.path
+        if item.mode.startswith(b"04"):
+            if sparse_dir_outside(cone, name):
+                cache_tree[name] = item.sha
+                yield sparse_entry(name, item.sha)
+            else:
+                yield from sparse_expand(repo, cone, name, item.sha, cache_tree)
+        else:
+            mode = int(item.mode, 8)
+            yield GitIndexEntry(ctime=(0, 0), mtime=(0, 0), dev=0, ino=0,
+                                mode_type=mode >> 12, mode_perms=mode & 0o777,
+                                uid=0, gid=0, fsize=0, sha=item.sha,
+                                flag_assume_valid=False, flag_stage=0,
+                                flag_skip_worktree=True, name=name)
+
+def sparse_apply(repo, cone):
+    """Make the worktree and the index match cone (None for a full
+checkout): check out the files entering it, remove those leaving it, and
+collapse the directories now outside of it."""
+    from git_status_helper import index_worktree_diff
+    from git_tree_helper import blob_checkout, index_entry_mode, worktree_prune_dirs
+    with index_locked(repo):
+        index = index_read(repo)
+
+        # Sparse directories (partly) in the new cone are expanded, only as
+        # deep as needed.
+        entries = list()
+        for e in index.entries:
+            if e.mode_type == 0b0100 and not sparse_dir_outside(cone, e.name[:-1]):
+                entries.extend(sparse_expand(repo, cone, e.name[:-1], e.sha, index.cache_tree))
+            else:
+                entries.append(e)
+
+        entering = list()
+        leaving = list()
+        for e in entries:
+            if e.mode_type == 0b0100:
+                continue
+            inside = sparse_dir_top(cone, os.path.dirname(e.name)) is None
+            if inside and e.flag_skip_worktree:
+                entering.append(e)
+            elif not inside and not e.flag_skip_worktree:
+                leaving.append(e)
+
+        # Check everything before touching anything.
+        dirty = [ path for (status, path, *_) in index_worktree_diff(repo, index, leaving) if status == "M" ]
+        if dirty:
+            raise Exception(f"Local changes would be lost: {', '.join(dirty)}")
+        present = [ e.name for e in entering if os.path.lexists(os.path.join(repo.worktree, e.name)) ]
+        if present:
+            raise Exception(f"Untracked files would be overwritten: {', '.join(present)}")
+
+        for e in entering:
+            full_path = os.path.join(repo.worktree, e.name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            blob_checkout(repo, e.sha, index_entry_mode(e), full_path)
+            index_entry_refresh(e, os.lstat(full_path))
+            e.flag_skip_worktree = False
+
+        dirs = set()
+        for e in leaving:
+            full_path = os.path.join(repo.worktree, e.name)
+            if os.path.lexists(full_path):
+                os.unlink(full_path)
+            dirs.add(os.path.dirname(e.name))
+            e.flag_skip_worktree = True
+        worktree_prune_dirs(repo, dirs)
+
+        index.entries = entries
+        if cone is not None:
+            sparse_collapse(repo, index, cone)
+        index_write(repo, index)
+
+def sparse_collapse(repo, index, cone):
+    """Replace the entries of each directory outside of cone by a single
+sparse directory."""
+    from git_commit_helper import tree_from_index
+
+    # The trees of those directories are in the cache-tree, unless some
+    # entries below them changed since the last commit: then they're
+    # written as they would be for a commit.
+    tree_from_index(repo, index)
+
+    entries = list()
+    collapsed = set()
+    for e in index.entries:
+        if e.mode_type == 0b0100:
+            top = sparse_dir_top(cone, e.name[:-1])
+        else:
+            top = sparse_dir_top(cone, os.path.dirname(e.name))
+
+        if top is None:
+            entries.append(e)
+        elif top not in collapsed:
+            # Entries are sorted, so the directory comes first.
+            collapsed.add(top)
+            entries.append(sparse_entry(top, index.cache_tree[top]))
+    index.entries = entries
+
+def sparse_set(repo, dirs):
+    # Directories below another one are already in the cone.
+    dirs = set(d.strip("/") for d in dirs)
+    cone = set(d for d in dirs if not any(d.startswith(o + "/") for o in dirs))
+
+    sparse_apply(repo, cone)
+    sparse_cone_write(repo, cone)
+    repo_config_set(repo, "core", "sparsecheckout", "true")
+    repo_config_set(repo, "core", "sparsecheckoutcone", "true")
+    repo_config_set(repo, "index", "sparse", "true")
+
+def sparse_disable(repo):
+    sparse_apply(repo, None)
+    repo_config_set(repo, "core", "sparsecheckout", "false")
@@ -1,9 +1,12 @@
 
 import os
-from git_utilities import repo_file
+from git_utilities import repo_file, FileLockedError
 from git_object_helper import object_find, object_read, object_hash
-from git_index_helper import index_read
+from git_index_helper import index_read, index_write, index_entries_under
 from git_gitignore_helper import gitignore_read, check_ignore
+from git_tree_helper import tree_index_diff, index_entry_mode
+from git_diff_helper import diff_renames, diff_renames_enabled
+from git_trace_helper import trace_counters, trace_region
 
 
 def branch_get_active(repo):
@@ -22,28 +25,6 @@ def cmd_status_branch(repo):
     else:
         print(f"HEAD detached at {object_find(repo, 'HEAD')}")
 
-def tree_to_dict(repo, ref, prefix=""):
-    ret = dict()
-    tree_sha = object_find(repo, ref, fmt=b"tree")
-    tree = object_read(repo, tree_sha)
-
-    for leaf in tree.items:
-        full_path = os.path.join(prefix, leaf.path)
-
-        # We read the object to extract its type (this is uselessly
-        # expensive: we could just open it as a file and read the
-        # first few bytes)
-        is_subtree = leaf.mode.startswith(b'04')
-
-        # Depending on the type, we either store the path (if it's a
-        # blob, so a regular file), or recurse (if it's another tree,
-        # so a subdir)
-        if is_subtree:
-            ret.update(tree_to_dict(repo, leaf.sha, full_path))
-        else:
-            ret[full_path] = leaf.sha
-    return ret
-
 def cmd_status_head_index(repo, index):
     # Check if HEAD points to a valid commit
     try:
@@ -63,73 +44,157 @@ def cmd_status_head_index(repo, index):
     
     print("Changes to be committed:")
 
-    head = tree_to_dict(repo, "HEAD")
-    for entry in index.entries:
-        if entry.name in head:
-            if head[entry.name] != entry.sha:
-                print("  modified:", entry.name)
-            del head[entry.name] # Delete the key
-        else:
-            print("  added:   ", entry.name)
+    # Walk HEAD's tree and the index together: only the directories
+    # that changed since the last commit are read.
+    head = object_find(repo, "HEAD", fmt=b"tree")
+    with trace_region("status/head-index"):
+        changes = tree_index_diff(repo, head, index)
+        if diff_renames_enabled(repo, "status"):
+            changes = diff_renames(repo, changes)
+        for change in changes:
+            match change[0]:
+                case "A": print("  added:   ", change[1])
+                case "M": print("  modified:", change[1])
+                case "D": print("  deleted: ", change[1])
+                case "R": print("  renamed: ", change[6], "->", change[1])
+                case "C": print("  copied:  ", change[6], "->", change[1])
+
+def index_worktree_diff(repo, index, entries=None):
+    """Compare the index with the worktree, and yield a change tuple
+(as tree_diff does) for each entry whose file was modified or deleted.
+Only entries are looked at, if given.  The SHA of modified files is
+computed, but not written to the store."""
+    for entry in (index.entries if entries is None else entries):
+        # Outside of the sparse checkout: not in the worktree.
+        if entry.flag_skip_worktree:
+            continue
 
-    # Keys still in HEAD are files that we haven't met in the index,
-    # and thus have been deleted.
-    for entry in head.keys():
-        print("  deleted: ", entry)
+        full_path = os.path.join(repo.worktree, entry.name)
+        mode = index_entry_mode(entry)
+
+        # That file *name* is in the index
+
+        if not os.path.exists(full_path):
+            yield ("D", entry.name, mode, entry.sha, None, None)
+            continue
+
+        stat = os.stat(full_path)
+        if trace_counters is not None:
+            trace_counters["files_stat"] += 1
+
+        # Compare metadata
+        ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
+        mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
+        if (stat.st_ctime_ns == ctime_ns) and (stat.st_mtime_ns == mtime_ns):
+            if trace_counters is not None:
+                trace_counters["stat_cache_hits"] += 1
+        else:
+            # If different, deep compare.
+            # @FIXME This *will* crash on symlinks to dir.
+            with open(full_path, "rb") as fd:
+                new_sha = object_hash(fd, b"blob", None)
+            # If the hashes are the same, the files are actually the same.
+            if entry.sha != new_sha:
+                yield ("M", entry.name, mode, entry.sha, mode, new_sha)
 
 def cmd_status_index_worktree(repo, index):
     print("Changes not staged for commit:")
 
     ignore = gitignore_read(repo)
 
-    gitdir_prefix = repo.gitdir + os.path.sep
+    # If the filesystem monitor can tell what changed, we only look
+    # there.  Otherwise, paths is None and we look everywhere.
+    (token, ignore_key, paths) = status_fsmonitor(repo, index, ignore)
 
-    all_files = list()
+    # Paths that may show up in the next status: everything we report.
+    dirty = set()
 
     # We begin by walking the filesystem
-    for (root, _, files) in os.walk(repo.worktree, True):
-        if root==repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+    with trace_region("status/walk"):
+        if paths is None:
+            all_files = status_walk(repo, [ "" ])
+            entries = None
+        else:
+            all_files = status_walk(repo, paths)
+            entries = index_entries_under(index, paths)
 
     # We now traverse the index, and compare real files with the cached
     # versions.
 
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
-
-        # That file *name* is in the index
-
-        if not os.path.exists(full_path):
-            print("  deleted: ", entry.name)
-        else:
-            stat = os.stat(full_path)
-
-            # Compare metadata
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
-                # If different, deep compare.
-                # @FIXME This *will* crash on symlinks to dir.
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    # If the hashes are the same, the files are actually the same.
-                    same = entry.sha == new_sha
-
-                    if not same:
-                        print("  modified:", entry.name)
-
-        if entry.name in all_files:
-            all_files.remove(entry.name)
+    with trace_region("status/index-worktree"):
+        for (status, path, _, _, _, _) in index_worktree_diff(repo, index, entries):
+            dirty.add(path)
+            match status:
+                case "M": print("  modified:", path)
+                case "D": print("  deleted: ", path)
 
     print()
     print("Untracked files:")
 
-    for f in all_files:
-        # @TODO If a full directory is untracked, we should display
-        # its name without its contents.
-        if not check_ignore(ignore, f):
-            print(" ", f)
+    with trace_region("status/untracked"):
+        tracked = set(entry.name for entry in (index.entries if entries is None else entries))
+        for f in sorted(all_files):
+            if f in tracked:
+                continue
+            # @TODO If a full directory is untracked, we should display
+            # its name without its contents.
+            if not check_ignore(ignore, f):
+                dirty.add(f)
+                print(" ", f)
+
+    # Remember the token, so next time we only look at what changed
+    # since now, and at what we just reported.  Like git, we only
+    # update the index if nobody else is writing it.
+    if token is not None and index.fsmonitor != (token, ignore_key, dirty):
+        index.fsmonitor = (token, ignore_key, dirty)
+        try:
+            index_write(repo, index)
+        except FileLockedError:
+            pass # We'll look again next time.
+
+def status_walk(repo, paths):
+    """Return the files of the worktree at or below paths, relative to
+the worktree, except those of the .git directory."""
+    gitdir_prefix = repo.gitdir + os.path.sep
+    ret = set()
+    for p in paths:
+        top = os.path.join(repo.worktree, p)
+        if not os.path.isdir(top) or os.path.islink(top):
+            if os.path.lexists(top):
+                ret.add(p)
+            continue
+        for (root, _, files) in os.walk(top, True):
+            if root==repo.gitdir or root.startswith(gitdir_prefix):
+                continue
+            for f in files:
+                full_path = os.path.join(root, f)
+                ret.add(os.path.relpath(full_path, repo.worktree))
+    return ret
+
+def status_fsmonitor(repo, index, ignore):
+    """Ask the filesystem monitor what changed since the token of the
+index.  Return (token, ignore_key, paths): the new token (None if
+there's no monitor), a key of the ignore rules, and the paths status
+must look at, or None if it must look everywhere."""
+    from git_fsmonitor import fsmonitor_query
+
+    # Files nobody touched may still have become visible if the ignore
+    # rules changed: the token is only good for the same rules.
+    import hashlib
+    rules = repr((ignore.absolute, sorted(ignore.scoped.items())))
+    ignore_key = hashlib.sha1(rules.encode("utf8")).hexdigest()
+
+    old = index.fsmonitor
+    if old is not None and old[1] != ignore_key:
+        old = None
+
+    with trace_region("status/fsmonitor"):
+        answer = fsmonitor_query(repo, old[0] if old else None)
+    if answer is None:
+        return (None, ignore_key, None)
+    (token, paths) = answer
+    if paths is None or old is None:
+        return (token, ignore_key, None)
+    if trace_counters is not None:
+        trace_counters["fsmonitor_paths"] += len(paths)
+    return (token, ignore_key, set(paths) | old[2])
@@ -0,0 +1,160 @@
+import os
+from git_objects import GitIndexEntry
+from git_object_helper import object_find, object_read, object_hash
+from git_index_helper import (index_read, index_write, index_locked, index_entries_under, index_entry_refresh,
+                              index_cache_tree_invalidate, index_fsmonitor_invalidate)
+from git_tree_helper import tree_diff, blob_checkout, index_entry_mode, worktree_prune_dirs
+from git_ref_helper import ref_resolve, ref_write
+from git_sparse_helper import sparse_cone, sparse_dir_top, sparse_entry
+from git_trace_helper import trace_function
+
+# Switching the worktree from one commit to another.  tree_diff skips
+# identical subtrees, and we only write or delete the paths it reports,
+# so moving between two nearby commits costs as much as their diff, not
+# as the size of the tree.  Local changes to other paths are carried
+# over, as git does; local changes to those paths make us refuse before
+# anything is written.
+
+@trace_function("switch")
+def switch(repo, target, head):
+    """Check out the commit target in the worktree and the index, then
+point HEAD to head: "ref: refs/heads/<branch>", or a SHA."""
+    with index_locked(repo):
+        index = index_read(repo)
+        cone = sparse_cone(repo)
+
+        old = ref_resolve(repo, "HEAD")
+        old_tree = object_find(repo, old, fmt=b"tree") if old else None
+        new_tree = object_find(repo, target, fmt=b"tree")
+
+        # Changes below a sparse directory only change its tree.
+        changes = list()
+        sparse_dirs = set()
+        for change in tree_diff(repo, old_tree, new_tree):
+            top = sparse_dir_top(cone, os.path.dirname(change[1])) if cone is not None else None
+            if top is None:
+                changes.append(change)
+            else:
+                sparse_dirs.add(top)
+
+        entries = { e.name: e for e in index_entries_under(index, [ c[1] for c in changes ]) }
+        switch_check(repo, index, changes, entries)
+
+        # Deletions first: a file may replace a directory, or the reverse.
+        removed = set()
+        dirs = set()
+        for (status, path, _, _, _, _) in changes:
+            if status == "D":
+                full_path = os.path.join(repo.worktree, path)
+                if os.path.lexists(full_path):
+                    os.unlink(full_path)
+                removed.add(path)
+                dirs.add(os.path.dirname(path))
+        worktree_prune_dirs(repo, dirs)
+        index.entries = [ e for e in index.entries if e.name not in removed ]
+
+        for (status, path, _, _, mode, sha) in changes:
+            if status == "D":
+                continue
+            full_path = os.path.join(repo.worktree, path)
+            if os.path.lexists(full_path):
+                os.unlink(full_path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            blob_checkout(repo, sha, mode, full_path)
+
+            e = entries.get(path)
+            if e is None:
+                e = GitIndexEntry(flag_assume_valid=False, flag_stage=0, name=path)
+                index.entries.append(e)
+            m = int(mode, 8)
+            e.mode_type = m >> 12
+            e.mode_perms = m & 0o777
+            e.sha = sha
+            index_entry_refresh(e, os.lstat(full_path))
+
+        for (_, path, _, _, _, _) in changes:
+            index_cache_tree_invalidate(index, path)
+            index_fsmonitor_invalidate(index, path)
+
+        index.entries.sort(key=lambda e: e.name)
+        for path in sparse_dirs:
+            switch_sparse_dir(repo, index, path, new_tree)
+
+        index_write(repo, index)
+    ref_write(repo, "HEAD", head)
+
+def switch_check(repo, index, changes, entries):
+    """Raise an exception if applying changes (from HEAD to the target)
+would lose work: staged changes, changes to the worktree, or untracked
+files, of the paths involved."""
+    from git_status_helper import index_worktree_diff
+
+    staged = list()
+    for (status, path, old_mode, old_sha, new_mode, new_sha) in changes:
+        e = entries.get(path)
+        have = (index_entry_mode(e), e.sha) if e else (None, None)
+        # The index must match HEAD, or already match the target.
+        if have != (old_mode, old_sha) and have != (new_mode, new_sha):
+            staged.append(path)
+    if staged:
+        raise Exception(f"Your staged changes would be overwritten: {', '.join(staged)}")
+
+    # Modified files (stat first, then hash), as status finds them.
+    # Deleted ones don't matter: git doesn't care either.
+    tracked = [ e for e in entries.values() if not e.flag_skip_worktree ]
+    dirty = [ path for (status, path, *_) in index_worktree_diff(repo, index, tracked) if status == "M" ]
+    if dirty:
+        raise Exception(f"Your local changes would be overwritten: {', '.join(dirty)}")
+
+    untracked = list()
+    for (status, path, _, _, _, new_sha) in changes:
+        full_path = os.path.join(repo.worktree, path)
+        if status == "A" and path not in entries and os.path.isfile(full_path):
+            with open(full_path, "rb") as fd:
+                if object_hash(fd, b"blob", None) != new_sha:
+                    untracked.append(path)
+    if untracked:
+        raise Exception(f"Untracked files would be overwritten: {', '.join(untracked)}")
+
+    # A directory where a file goes must only hold files this switch
+    # deletes: it goes away with them.  Anything else would be lost.
+    deleted = set(path for (status, path, *_) in changes if status == "D")
+    blocked = list()
+    for (status, path, *_) in changes:
+        full_path = os.path.join(repo.worktree, path)
+        if status == "D" or os.path.islink(full_path) or not os.path.isdir(full_path):
+            continue
+        for (dirpath, _, filenames) in os.walk(full_path):
+            rel = os.path.relpath(dirpath, repo.worktree).replace(os.sep, "/")
+            if any(f"{rel}/{f}" not in deleted for f in filenames):
+                blocked.append(path)
+                break
+    if blocked:
+        raise Exception(f"Updating these directories would lose untracked files in them: {', '.join(blocked)}")
+
+def switch_sparse_dir(repo, index, path, tree):
+    """Point the sparse directory path to its tree in tree, adding or
+removing it as needed."""
+    from bisect import bisect_left
+
+    # Find its tree, one level at a time.
+    sha = tree
+    for part in path.split("/"):
+        leaf = [ i for i in object_read(repo, sha).items if i.path == part and i.mode.startswith(b"04") ]
+        if not leaf:
+            sha = None
+            break
+        sha = leaf[0].sha
+
+    index_cache_tree_invalidate(index, path + "/")
+    i = bisect_left(index.entries, path + "/", key=lambda e: e.name)
+    present = i < len(index.entries) and index.entries[i].name == path + "/"
+    if sha is None:
+        if present:
+            del index.entries[i]
+    else:
+        index.cache_tree[path] = sha
+        if present:
+            index.entries[i].sha = sha
+        else:
+            index.entries.insert(i, sparse_entry(path, sha))
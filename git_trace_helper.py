@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Performance tracing, in the spirit of git's trace2.  Set
+# MY_GIT_TRACE_PERF to a file name (or to 1 for stderr) and every
+# command appends JSON events to it, one per line: nested regions with
+# their duration, then the counters, then the total time.
+#
+# Tracing is decided once, when this module is imported.  When it's
+# off, trace_region returns a shared no-op context manager, and
+# trace_counters is None: hot code checks it before counting, so the
+# whole thing costs a comparison.
+
+TRACE_TARGET = os.environ.get("MY_GIT_TRACE_PERF")
+if TRACE_TARGET in (None, "", "0", "false"):
+    TRACE_TARGET = None
+
+trace_counters = Counter() if TRACE_TARGET else None
+
+trace_events = list()
+trace_depth = 0
+trace_start = time.perf_counter_ns()
+
+TRACE_NOOP = nullcontext()
+
+def trace_region(name):
+    """Return a context manager timing the region name, eg
+"status/walk".  Regions nest."""
+    if TRACE_TARGET is None:
+        return TRACE_NOOP
+    return trace_region_enabled(name)
+
+@contextmanager
+def trace_region_enabled(name):
+    global trace_depth
+    start = time.perf_counter_ns()
+    trace_event("region_enter", name=name, depth=trace_depth)
+    trace_depth += 1
+    try:
+        yield
+    finally:
+        trace_depth -= 1
+        trace_event("region_leave", name=name, depth=trace_depth,
+                    elapsed=(time.perf_counter_ns() - start) / 1e9)
+
+def trace_function(name):
+    """Decorator timing every call of a function as region name.  When
+tracing is off, the function is returned unchanged."""
+    def decorate(fn):
+        if TRACE_TARGET is None:
+            return fn
+        import functools
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace_region_enabled(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def trace_event(event, **fields):
+    if TRACE_TARGET is None:
+        return
+    fields["event"] = event
+    fields["t"] = (time.perf_counter_ns() - trace_start) / 1e9
+    trace_events.append(fields)
+
+def trace_flush():
+    """Write the events collected so far, with the counters and the
+total time.  Called at exit."""
+    import json
+    trace_event("counters", **trace_counters)
+    trace_event("exit", elapsed=(time.perf_counter_ns() - trace_start) / 1e9)
+
+    pid = os.getpid()
+    lines = "".join(json.dumps(dict(pid=pid, **e)) + "\n" for e in trace_events)
+    trace_events.clear()
+
+    if TRACE_TARGET in ("1", "2", "true"):
+        sys.stderr.write(lines)
+    else:
+        # A single append, so traces of concurrent processes don't
+        # interleave mid-line.
+        with open(TRACE_TARGET, "a") as f:
+            f.write(lines)
+
+if TRACE_TARGET:
+    import atexit
+    trace_event("start", argv=sys.argv)
+    atexit.register(trace_flush)
@@ -1,7 +1,9 @@
 
 import os
+from bisect import bisect_left
 from git_object_helper import *
 from git_objects import *
+from git_trace_helper import trace_counters
 
 def tree_parse_one(raw, start=0):
     # Find the space terminator of the mode
@@ -42,7 +44,7 @@ def tree_parse(raw):
 # value, which is compared using the default rules.  So we just return
 # the leaf name, with an extra / if it's a directory.
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b"10"):
+    if not leaf.mode.startswith(b"04"):
         return leaf.path
     else:
         return leaf.path + "/"
@@ -51,7 +53,8 @@ def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
     ret = b''
     for i in obj.items:
-        ret += i.mode
+        # Modes are read as six bytes, but git writes trees' as five.
+        ret += i.mode[1:] if i.mode.startswith(b"04") else i.mode
         ret += b' '
         ret += i.path.encode("utf8")
         ret += b'\x00'
@@ -80,15 +83,178 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
         else: # This is a branch, recurse
             ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
 
-def tree_checkout(repo, tree, path):
+def tree_checkout(repo, tree, path, cone=None, prefix=""):
+    """Write the contents of tree to directory path.  If cone (see
+git_sparse_helper) is given, directories outside of it are skipped
+without being read."""
+    from git_sparse_helper import sparse_dir_outside
     for item in tree.items:
-        obj = object_read(repo, item.sha)
         dest = os.path.join(path, item.path)
+        name = os.path.join(prefix, item.path)
 
-        if obj.fmt == b'tree':
+        if item.mode.startswith(b"04"):
+            if cone is not None and sparse_dir_outside(cone, name):
+                continue
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
-            # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
\ No newline at end of file
+            tree_checkout(repo, object_read(repo, item.sha), dest, cone, name)
+        elif item.mode.startswith(b"16"):
+            os.mkdir(dest) # A submodule: git leaves an empty directory.
+        else:
+            blob_checkout(repo, item.sha, item.mode, dest)
+
+def blob_checkout(repo, sha, mode, dest):
+    """Write blob sha to file dest, with tree leaf mode mode."""
+    data = object_read(repo, sha).blobdata
+    if mode.startswith(b"12"):
+        os.symlink(data, dest)
+        return
+    with open(dest, 'wb') as f:
+        f.write(data)
+    if mode == b"100755":
+        os.chmod(dest, 0o755)
+
+def worktree_prune_dirs(repo, dirs):
+    """Remove the directories of dirs, and their parents, that are now
+empty."""
+    for d in sorted(dirs, key=len, reverse=True):
+        while d:
+            try:
+                os.rmdir(os.path.join(repo.worktree, d))
+            except OSError:
+                break # Not empty (or already gone).
+            d = os.path.dirname(d)
+
+# The diff engine.  Both functions below are generators: they yield one
+# tuple (status, path, old_mode, old_sha, new_mode, new_sha) per
+# changed path, in path order, where status is "A" (added), "M"
+# (modified) or "D" (deleted), and the missing side of an addition or
+# deletion is None.  Since a tree's SHA is a hash of its whole
+# contents, two subtrees with the same SHA are identical and we never
+# need to read them: the cost of a diff is proportional to what
+# changed, not to the size of the trees.
+
+def tree_diff(repo, old, new, recursive=True, prefix=""):
+    """Compare the trees whose SHAs are old and new (either may be None
+for an empty tree).  Unless recursive, differing subtrees are reported
+as a single entry instead of being descended into."""
+    if old == new:
+        return
+
+    old_items = object_read(repo, old).items if old else []
+    new_items = object_read(repo, new).items if new else []
+
+    # Both lists are sorted in tree order, so we walk them together
+    # like the merge step of a merge sort.
+    i = 0
+    j = 0
+    while i < len(old_items) or j < len(new_items):
+        o = old_items[i] if i < len(old_items) else None
+        n = new_items[j] if j < len(new_items) else None
+
+        if n is None or (o is not None and tree_leaf_sort_key(o) < tree_leaf_sort_key(n)):
+            n = None
+            i += 1
+        elif o is None or tree_leaf_sort_key(o) > tree_leaf_sort_key(n):
+            o = None
+            j += 1
+        else:
+            i += 1
+            j += 1
+
+        yield from tree_diff_leaf(repo, o, n, recursive, prefix)
+
+def tree_diff_leaf(repo, old, new, recursive, prefix):
+    path = os.path.join(prefix, (old or new).path)
+
+    if old and new and old.sha == new.sha and old.mode == new.mode:
+        return # Same object, nothing to see here.
+
+    # Sort keys matched, so if one side is a tree both are.
+    is_tree = (old or new).mode.startswith(b"04")
+
+    if recursive and is_tree:
+        yield from tree_diff(repo,
+                             old.sha if old else None,
+                             new.sha if new else None,
+                             recursive, path)
+    elif old is None:
+        yield ("A", path, None, None, new.mode, new.sha)
+    elif new is None:
+        yield ("D", path, old.mode, old.sha, None, None)
+    else:
+        yield ("M", path, old.mode, old.sha, new.mode, new.sha)
+
+def tree_index_diff(repo, tree, index):
+    """Compare the tree whose SHA is tree (or None) with the entries of
+index, which must be sorted by name.  Directories whose cache-tree SHA
+matches the tree's are skipped without being read."""
+    names = [ e.name for e in index.entries ]
+    yield from tree_index_diff_dir(repo, tree, index, names, 0, len(names), "")
+
+def tree_index_diff_dir(repo, tree, index, names, lo, hi, prefix):
+    # The entries under prefix are names[lo:hi].
+    if tree and index.cache_tree.get(prefix) == tree:
+        if trace_counters is not None:
+            trace_counters["cache_tree_hits"] += 1
+        return
+
+    items = object_read(repo, tree).items if tree else []
+    base = prefix + "/" if prefix else ""
+
+    i = 0
+    pos = lo
+    while i < len(items) or pos < hi:
+        # The next index "leaf" is either a file directly in this
+        # directory, or a subdirectory spanning the entries from pos to
+        # end.  Since "0" comes right after "/", bisecting for
+        # "<subdir>0" finds the end of the subdirectory.
+        subdir = None
+        if pos < hi:
+            rest = names[pos][len(base):]
+            slash = rest.find("/")
+            if slash == -1:
+                index_key = rest
+                end = pos + 1
+            else:
+                subdir = rest[:slash]
+                index_key = subdir + "/"
+                end = bisect_left(names, base + subdir + "0", pos, hi)
+
+        leaf = items[i] if i < len(items) else None
+
+        if pos >= hi or (leaf and tree_leaf_sort_key(leaf) < index_key):
+            # Only in the tree: deleted.
+            path = base + leaf.path
+            if leaf.mode.startswith(b"04"):
+                yield from tree_diff(repo, leaf.sha, None, True, path)
+            else:
+                yield ("D", path, leaf.mode, leaf.sha, None, None)
+            i += 1
+        elif leaf is None or tree_leaf_sort_key(leaf) > index_key:
+            # Only in the index: added.
+            for e in index.entries[pos:end]:
+                if e.mode_type == 0b0100:
+                    yield from tree_diff(repo, None, e.sha, True, e.name[:-1])
+                else:
+                    yield ("A", e.name, None, None, index_entry_mode(e), e.sha)
+            pos = end
+        elif subdir is not None:
+            e = index.entries[pos]
+            if e.mode_type == 0b0100:
+                # A sparse directory: it's a tree too.
+                yield from tree_diff(repo, leaf.sha, e.sha, True, base + subdir)
+            else:
+                yield from tree_index_diff_dir(repo, leaf.sha, index, names, pos, end, base + subdir)
+            i += 1
+            pos = end
+        else:
+            e = index.entries[pos]
+            mode = index_entry_mode(e)
+            if e.sha != leaf.sha or mode != leaf.mode:
+                yield ("M", e.name, leaf.mode, leaf.sha, mode, e.sha)
+            i += 1
+            pos = end
+
+def index_entry_mode(entry):
+    """Return the tree leaf mode (eg b"100644") of an index entry."""
+    return f"{entry.mode_type:02o}{entry.mode_perms:04o}".encode("ascii")
@@ -1,5 +1,7 @@
 import os
+import sys
 import configparser
+from contextlib import contextmanager
 
 def repo_path(repo, *path):
 	"""Compute path under repo's gitdir."""
@@ -30,6 +32,129 @@ def repo_dir(repo, *path, mkdir=False):
 	else:
 		return None
 
+# How deep alternates of alternates go, as in git.
+REPO_ALTERNATES_DEPTH = 5
+
+def repo_object_dirs(repo):
+	"""Return the object directories of repo: its own .git/objects, then
+those listed in objects/info/alternates, and theirs, in order.  Each
+directory is listed once, whatever the number of paths to it: stores
+that borrow from each other don't loop."""
+	if repo.object_dirs is None:
+		own = os.path.realpath(repo_path(repo, "objects"))
+		repo.object_dirs = [ own ]
+		repo_alternates_read(own, repo.object_dirs, 0)
+	return repo.object_dirs
+
+def repo_alternates_read(objects, dirs, depth):
+	try:
+		with open(os.path.join(objects, "info", "alternates"), "r") as f:
+			lines = f.read().splitlines()
+	except FileNotFoundError:
+		return
+	# A bad alternate only loses us its objects, as in git: warn, and
+	# go on without it.
+	if depth >= REPO_ALTERNATES_DEPTH:
+		print(f"warning: {objects}: ignoring alternate object stores, nesting too deep", file=sys.stderr)
+		return
+	for line in lines:
+		if not line.strip() or line.startswith("#"):
+			continue
+		# Relative paths are from the object directory listing them.
+		path = os.path.realpath(os.path.join(objects, line.strip()))
+		if path in dirs:
+			continue
+		if not os.path.isdir(path):
+			print(f"warning: object directory {path} does not exist; check .git/objects/info/alternates", file=sys.stderr)
+			continue
+		dirs.append(path)
+		repo_alternates_read(path, dirs, depth + 1)
+
+@contextmanager
+def file_write_locked(path, fsync=False):
+	"""Replace the file at path atomically.  Yield a file open on
+path.lock: when the block exits, it is renamed over path, or removed if
+the block raised.  Like git, we refuse to go on if path.lock exists,
+since that means another process is writing path right now."""
+	f = file_lock(path)
+	try:
+		yield f
+	except BaseException:
+		file_lock_rollback(f, path)
+		raise
+	file_lock_commit(f, path, fsync)
+
+class FileLockedError(Exception):
+	"""Raised by file_lock when path.lock exists already: someone else
+is writing path."""
+	pass
+
+def file_lock(path):
+	"""Take the lock on path: create path.lock, and return it, open for
+writing.  file_lock_commit or file_lock_rollback release it."""
+	lock = path + ".lock"
+	try:
+		return open(lock, "xb")
+	except FileExistsError:
+		raise FileLockedError(f"Unable to create {lock}: File exists.  Another my_git process seems to be running; if not, remove the file.")
+
+def file_lock_commit(f, path, fsync=False):
+	"""Rename the lock f on path, and what was written to it, over
+path."""
+	try:
+		f.flush()
+		if fsync:
+			os.fsync(f.fileno())
+		f.close()
+		os.replace(path + ".lock", path)
+	except BaseException:
+		file_lock_rollback(f, path)
+		raise
+
+def file_lock_rollback(f, path):
+	"""Drop the lock f on path, and what was written to it."""
+	f.close()
+	os.unlink(path + ".lock")
+
+def file_fsync_dir(path):
+	"""Make the entries of directory path (eg, renames) durable."""
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+# Linux's sync_file_range, which Python doesn't have: None until looked
+# up in libc, False if there's none.
+file_sync_file_range = None
+SYNC_FILE_RANGE_WRITE = 2
+
+def file_writeout(fd):
+	"""Start writing the data of file fd out to disk, without waiting for
+it nor flushing the disk cache.  Return False if the system can't."""
+	global file_sync_file_range
+	if file_sync_file_range is None:
+		try:
+			import ctypes
+			libc = ctypes.CDLL(None, use_errno=True)
+			libc.sync_file_range.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint ]
+			file_sync_file_range = libc.sync_file_range
+		except (OSError, AttributeError):
+			file_sync_file_range = False # Not Linux, or no libc.
+	if not file_sync_file_range:
+		return False
+	return file_sync_file_range(fd, 0, 0, SYNC_FILE_RANGE_WRITE) == 0
+
+def repo_fsync_method(repo):
+	"""How new files are made durable, from core.fsyncMethod: None
+(leave it to the OS, the default), "fsync" (each file as it is written)
+or "batch" (objects are synced all at once, see object_batch_begin)."""
+	if repo.conf.has_option("core", "fsyncmethod"):
+		method = repo.conf.get("core", "fsyncmethod")
+		if method in ("fsync", "batch"):
+			return method
+	return None
+
 def repo_create(path):
 	"""Create a new repository at path."""
 
@@ -77,10 +202,37 @@ def repo_default_config():
 
 	return ret
 
+def repo_config_set(repo, section, option, value):
+	"""Set option in section of the repository configuration, or remove
+it if value is None, and write it back."""
+	if value is None:
+		if repo.conf.has_section(section):
+			repo.conf.remove_option(section, option)
+	else:
+		if not repo.conf.has_section(section):
+			repo.conf.add_section(section)
+		repo.conf.set(section, option, value)
+
+	import io
+	with io.StringIO() as text:
+		repo.conf.write(text)
+		data = text.getvalue()
+	with file_write_locked(repo_file(repo, "config")) as f:
+		f.write(data.encode("utf8"))
+
+# Repositories returned by repo_find, by worktree, when a long-running
+# process (the daemon, see git_daemon.py) keeps them from one call to
+# the next, with their caches: worktree -> (config key, packs key,
+# repo, commit-graph key, alternates key).  None otherwise, and every
+# call reads the repository anew.
+repo_keep = None
+
 def repo_find(path=".", required=True):
 	path = os.path.realpath(path)
 
 	if os.path.isdir(os.path.join(path, ".git")):
+		if repo_keep is not None:
+			return repo_find_kept(path)
 		from git_objects import GitRepository
 		return GitRepository(path)
 
@@ -101,6 +253,71 @@ def repo_find(path=".", required=True):
 
 
 
+def repo_find_kept(path):
+	from git_objects import GitRepository
+	gitdir = os.path.join(path, ".git")
+	config = file_stat_key(os.path.join(gitdir, "config"))
+	alternates = file_stat_key(os.path.join(gitdir, "objects", "info", "alternates"))
+	graph = file_stat_key(os.path.join(gitdir, "objects", "info", "commit-graph"))
+
+	kept = repo_keep.get(path)
+	if kept is None or kept[0] != config:
+		# New, or its configuration changed: (re)load it.
+		repo = GitRepository(path)
+		repo.cache = dict()
+	else:
+		repo = kept[2]
+		if kept[4] != alternates:
+			# Other object directories to borrow from.
+			repo.object_dirs = None
+		if kept[3] != graph:
+			# The commits we have parsed may now be in the commit-graph,
+			# and must get their generation number from it too.
+			repo.commit_graph = None
+			repo.commits = dict()
+		# Refs are cheap to read, and change all the time: each command
+		# takes a new snapshot.
+		repo.refs = None
+
+	# The pack directories of the repository and of those it borrows
+	# from.
+	packs = tuple(file_stat_key(os.path.join(d, "pack")) for d in repo_object_dirs(repo))
+	if kept is not None and kept[1] != packs:
+		# Packs were added or removed: list them again.
+		repo.packs = None
+	repo_keep[path] = (config, packs, repo, graph, alternates)
+	return repo
+
+def file_stat_key(path):
+	"""Return what identifies the current version of the file at path,
+for caches: writing or replacing it changes it.  None if there's no
+such file."""
+	try:
+		st = os.stat(path)
+	except FileNotFoundError:
+		return None
+	return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+def repo_cached(repo, name, paths, load):
+	"""Return load(), or, if repo keeps a cache, the value it returned
+last time, as long as none of the files in paths changed since.  The
+value is shared: callers must not modify it."""
+	if repo.cache is None:
+		return load()
+
+	# Stat before loading: if a file changes while we read it, the
+	# next call sees a different key, and loads it again.
+	key = tuple((p, file_stat_key(p)) for p in paths)
+	hit = repo.cache.get(name)
+	if hit and hit[0] == key:
+		return hit[1]
+
+	value = load()
+	repo.cache[name] = (key, value)
+	return value
+
+
+
 def kvlm_parse(raw, start=0, dct=None):
 	if not dct:
 		dct = dict()
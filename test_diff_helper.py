@@ -0,0 +1,23 @@
+import unittest
+
+from git_diff_helper import diff_blocks
+
+def lines(text):
+    return [ (w + "\n").encode("ascii") for w in text.split() ]
+
+class TestDiffHistogram(unittest.TestCase):
+
+    def test_lines_on_one_side_split_matches(self):
+        # The blocks of git diff --no-index --histogram
+        # --no-indent-heuristic on these files: 14 lines changed.  With
+        # the lines only one side has set aside, histogram anchored on
+        # lines that weren't neighbours, for 24 lines changed.
+        a = lines("l0 l0 l0 l2 l1 l3 l0 l0 l3 l0 l0 l1 l1 l1 l1 l1 l2 l3 l2 l0 "
+                  "l2 l2 l1 l0 l0 l2 l0 l3 l3 l3")
+        b = lines("l0 l0 l0 l2 l1 l3 l0 l0 l2 new3 l1 l3 l0 l0 l1 l1 l0 l2 l2 l1 "
+                  "l0 l0 l2 l0 new1 l2 new0 l2 l3 l3 l3 l3")
+        self.assertEqual(list(diff_blocks(a, b)),
+                         [ (8, 8, 8, 11), (13, 19, 16, 16), (27, 27, 24, 29) ])
+
+if __name__ == "__main__":
+    unittest.main()